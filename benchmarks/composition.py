@@ -0,0 +1,67 @@
+"""
+Benchmark how long it takes to build pipelines, as the number of nodes grows.
+
+Composition should grow linearly with the number of nodes, so the time per node reported for each
+size should stay roughly constant.
+
+Usage:
+    $ python -m benchmarks.composition
+"""
+import time
+
+from metafunctions import node
+from metafunctions import star
+from metafunctions import locate_error
+from metafunctions import chain
+
+SIZES = (250, 500, 1000, 2000, 4000)
+
+
+@node
+def f(x):
+    return x
+
+
+def nested(size):
+    """Build a deeply nested pipeline, rendering it at every step (as star and locate_error do)."""
+    cmp = f
+    for i in range(size // 2):
+        cmp = (cmp | f) + f
+        str(cmp)
+
+
+def starred(size):
+    """Wrap a growing pipeline in star and locate_error at every step."""
+    cmp = f
+    for i in range(size // 2):
+        cmp = locate_error(star(cmp) + f, use_color=False) | f
+
+
+def chained(size):
+    """Build a flat chain from a generator of steps."""
+    chain(f for i in range(size))
+
+
+def measure(benchmark, size, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        benchmark(size)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    for benchmark in (nested, starred, chained):
+        print("{}:".format(benchmark.__name__))
+        for size in SIZES:
+            seconds = measure(benchmark, size)
+            print(
+                "  {:>5} nodes: {:8.4f}s ({:6.2f}us per node)".format(
+                    size, seconds, seconds / size * 1e6
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
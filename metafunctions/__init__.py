@@ -7,6 +7,16 @@ from metafunctions.api import (
     store,
     recall,
     concurrent,
+    threaded,
     mmap,
+    imap,
+    cached,
+    disk_cached,
     locate_error,
+    compile,
+    optimize,
+    iterative,
+    intern,
+    chain,
+    merge,
 )
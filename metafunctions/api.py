@@ -1,35 +1,65 @@
 """
 Utility functions for use in function pipelines.
 """
+import os
 import functools
 import typing as tp
+from collections.abc import Iterable
 
 from metafunctions.core import MetaFunction
 from metafunctions.core import SimpleFunction
+from metafunctions.core import FunctionChain
 from metafunctions.core import FunctionMerge
 from metafunctions.core import CallState
 from metafunctions import util
 from metafunctions.core.concurrent import ConcurrentMerge
+from metafunctions.core.concurrent import ThreadedMerge
 from metafunctions.map import MergeMap
+from metafunctions.map import ParallelMergeMap
+from metafunctions.map import LazyMergeMap
+from metafunctions.map import ReducingMergeMap
+from metafunctions.map import ArrayMergeMap
+from metafunctions.map import ColumnarMergeMap
+from metafunctions.map import NO_INITIAL
+from metafunctions.cache import CachedFunction
+from metafunctions.cache import DiskCachedFunction
+from metafunctions.compiler import compile_meta_function
+from metafunctions.compiler import optimize_meta_function
+from metafunctions.compiler import intern_meta_function
+from metafunctions.engine import IterativeFunction
 from metafunctions import operators
+from metafunctions import exceptions
 
 
-def node(_func=None, *, name=None):
+def node(_func=None, *, name=None, batched=False, impure=False):
     """Turn the decorated function into a MetaFunction.
 
     Args:
         _func: Internal use. This will be the decorated function if node is used as a decorator
         with no params.
+        batched: Declare that the function accepts a batch of inputs (e.g., a list or numpy array)
+        and returns a batch of results of the same length, in the same order. `mmap` and `imap`
+        call batched functions once per batch, rather than once per item.
+        impure: Declare that the function has side effects, or may return different results when
+        called with the same input, so that `compile` never shares its calls.
 
     Usage:
 
     @node
     def f(x):
        <do something cool>
+
+    @node(batched=True)
+    def g(xs):
+        return numpy.sqrt(xs)
     """
 
     def decorator(function):
         newfunc = SimpleFunction(function, name=name)
+        if batched:
+            newfunc._batched = True
+        if impure:
+            newfunc._impure = True
         return newfunc
 
     if not _func:
@@ -52,29 +82,26 @@ def star(meta_function: MetaFunction) -> MetaFunction:
     star calls its Metafunction with *x instead of x.
     """
     fname = str(meta_function)
-    # This convoluted inline `if` just decides whether we should add brackets or not.
-    @node(
-        name="star{}".format(fname)
-        if fname.startswith("(")
-        else "star({})".format(fname)
-    )
+
     @functools.wraps(meta_function)
     def wrapper(args, **kwargs):
         return meta_function(*args, **kwargs)
 
-    return wrapper
+    # This convoluted inline `if` just decides whether we should add brackets or not.
+    name = "star{}".format(fname) if fname.startswith("(") else "star({})".format(fname)
+    return _Built(wrapper, name, (star, meta_function))
 
 
 def store(key):
     """Store the received output in the meta data dictionary under the given key."""
 
-    @node(name="store('{}')".format(key))
     @bind_call_state
     def storer(call_state, val):
         call_state.data[key] = val
         return val
 
-    return storer
+    storer._keeps_call_state = False
+    return _Built(storer, "store('{}')".format(key), (store, key))
 
 
 def recall(key, from_call_state: CallState = None):
@@ -82,38 +109,338 @@ def recall(key, from_call_state: CallState = None):
     specify a different call_state than the current one.
     """
 
-    @node(name="recall('{}')".format(key))
     @bind_call_state
     def recaller(call_state, *_):
         if from_call_state:
             return from_call_state.data[key]
         return call_state.data[key]
 
-    return recaller
+    recaller._keeps_call_state = False
+    parameters = (recall, key, from_call_state)
+    return _Built(recaller, "recall('{}')".format(key), parameters)
 
 
-def concurrent(function: FunctionMerge) -> ConcurrentMerge:
+def concurrent(
+    function: FunctionMerge, pool_size: int = None, max_tasks_per_worker: int = None
+) -> ConcurrentMerge:
     """
     Upgrade the specified FunctionMerge object to a ConcurrentMerge, which runs each of its
     component functions in separate processes. See ConcurrentMerge documentation for more
     information.
 
+    If `pool_size` is given, the component functions are run by a pool of that many long lived
+    worker processes, instead of a new process per function per call. Each worker is replaced after
+    calling `max_tasks_per_worker` functions, if given. Call `close()` on the result to shut the
+    pool down (this also happens automatically at exit).
+
     Usage:
 
     c = concurrent(long_running_function + other_long_running_function)
     c(input_data) # The two functions run in parallel
+
+    pooled = concurrent(mmap(short_running_function), pool_size=4)
+    """
+    return ConcurrentMerge(function, pool_size, max_tasks_per_worker)
+
+
+def threaded(function: FunctionMerge) -> ThreadedMerge:
     """
-    return ConcurrentMerge(function)
+    Upgrade the specified FunctionMerge object to a ThreadedMerge, which runs each of its component
+    functions in a thread from a shared, bounded pool. This is the thread based equivalent of
+    `concurrent`, for functions that spend their time waiting on I/O or in code that releases the
+    GIL. See ThreadedMerge documentation for more information.
 
+    Usage:
 
-def mmap(function: tp.Callable, operator: tp.Callable = operators.concat) -> MergeMap:
+    t = threaded(fetch_companies & fetch_customers)
+    t(input_data) # The two functions run in parallel threads
+    """
+    return ThreadedMerge(function)
+
+
+def mmap(
+    function: tp.Callable,
+    operator: tp.Callable = operators.concat,
+    workers: int = None,
+    chunksize: int = None,
+    reduce: tp.Callable = None,
+    initial=NO_INITIAL,
+    batch_size: int = None,
+    dtype=None,
+    vectorized: bool = False,
+    columns: tp.Union[bool, str] = False,
+) -> tp.Union[
+    MergeMap, ReducingMergeMap, ParallelMergeMap, ArrayMergeMap, ColumnarMergeMap
+]:
     """
     Upgrade the specified function to a MergeMap, which calls its single function once per input,
     as per the builtin `map` (https://docs.python.org/3.6/library/functions.html#map).
 
+    If `reduce` is given, results are folded into a single value as they're produced, as per
+    `functools.reduce(reduce, results, initial)`, instead of being collected and passed to
+    `operator`. Memory use then doesn't grow with the number of inputs.
+
+    If `workers` is given, the function is instead called in a pool of that many worker processes,
+    which each receive `chunksize` inputs at a time (by default, the input is split into about four
+    chunks per worker). Results are returned in input order. Call `close()` on the result to shut
+    the pool down (this also happens automatically at exit). With `reduce`, each worker folds the
+    results of its chunk, and those are folded in turn, so `reduce` must be associative.
+
+    If `function` is batched (see `node`), it's called once per `batch_size` inputs (1024 by
+    default), rather than once per input.
+
+    If `dtype` is given, or `vectorized` is true, results are returned as a numpy array (of that
+    dtype), which is filled as results are produced. With `vectorized`, array inputs (e.g., numpy
+    arrays) are passed to `function` whole, rather than an item at a time, so it must be a ufunc,
+    or a pipeline of them. See ArrayMergeMap for details. These options require numpy.
+
+    If `columns` is given, `function` must return records (e.g., tuples), whose fields are
+    collected into columns, which are passed to `operator` instead of the records. Columns are
+    lists if `columns` is True, or array.arrays if it's a string of typecodes, one per field.
+
     Consider the name 'mmap' to be a placeholder for now.
+
+    Usage:
+
+    parallel = mmap(cpu_heavy_function, workers=8)
+    parallel(records) # Same result as mmap(cpu_heavy_function)(records)
+
+    total = mmap(price, reduce=operator.add, initial=0)
+
+    roots = mmap(node(numpy.sqrt) + 1, vectorized=True)
+
+    ids, prices = mmap(parse_id & parse_price, columns="qd")(rows)
+    """
+    if reduce is not None and operator is not operators.concat:
+        raise exceptions.CompositionError(
+            "mmap accepts an operator or a reduce function, not both"
+        )
+    if reduce is None and initial is not NO_INITIAL:
+        raise exceptions.CompositionError("initial requires a reduce function")
+
+    function = MetaFunction.make_meta(function)
+    if dtype is not None or vectorized:
+        if (
+            operator is not operators.concat
+            or reduce is not None
+            or workers is not None
+        ):
+            raise exceptions.CompositionError(
+                "Array output can't be combined with an operator, reduce or workers"
+            )
+        return ArrayMergeMap(function, dtype, vectorized, batch_size)
+    if columns:
+        if reduce is not None or workers is not None:
+            raise exceptions.CompositionError(
+                "Columns can't be combined with reduce or workers"
+            )
+        typecodes = None if columns is True else columns
+        return ColumnarMergeMap(function, operator, typecodes, batch_size)
+    if workers is not None:
+        return ParallelMergeMap(
+            function, operator, workers, chunksize, reduce, initial, batch_size
+        )
+    if chunksize is not None:
+        raise exceptions.CompositionError("chunksize requires workers")
+    if reduce is not None:
+        return ReducingMergeMap(function, reduce, initial, batch_size)
+    return MergeMap(function, operator, batch_size)
+
+
+def imap(function: tp.Callable, batch_size: int = None) -> LazyMergeMap:
+    """
+    Upgrade the specified function to a LazyMergeMap, the streaming equivalent of `mmap`. It
+    accepts any iterables (e.g., generators or open files), and returns an iterator that calls the
+    function on each input as results are requested, so inputs needn't fit in memory. Batched
+    functions are called on `batch_size` inputs at a time, as with `mmap`.
+
+    Usage:
+
+    process_log = imap(parse_line) | imap(process_entry) | write_entries
+    process_log(open("huge.log"))
+    """
+    return LazyMergeMap(MetaFunction.make_meta(function), batch_size)
+
+
+def cached(
+    function: tp.Callable,
+    maxsize: int = 128,
+    ttl: float = None,
+    key: tp.Callable = None,
+) -> CachedFunction:
+    """
+    Upgrade the specified function to a CachedFunction, which stores the results of up to `maxsize`
+    recent calls (or of every call, if maxsize is None) and returns them when it's called with the
+    same arguments again. Results are discarded `ttl` seconds after they're computed, if ttl is
+    given. `key` is called with each call's arguments, and returns the value used to look up its
+    result; by default, the (hashable) arguments themselves are used. Call `cache_info()` on the
+    result for hit, miss and eviction counts.
+
+    Functions that use call_state (e.g., `store`, `recall` or `bind_call_state` functions) can't be
+    cached.
+
+    Usage:
+
+    enrich = parse | cached(lookup_user, maxsize=1024, ttl=60) | render
+    enrich(request)
+    enrich.functions[1].cache_info()
+    """
+    return CachedFunction(function, maxsize, ttl, key)
+
+
+def disk_cached(
+    function: tp.Callable, directory: str, max_bytes: int = None, name: str = None
+) -> DiskCachedFunction:
+    """
+    Upgrade the specified function to a DiskCachedFunction, which stores its results in files in
+    `directory`, and returns them when it's called with the same arguments again, even in another
+    process or a later run. Results are looked up by a hash of the function (or of `name`, if
+    given) and of its pickled arguments. When the cache directory grows past `max_bytes`, the least
+    recently used results are removed.
+
+    Results are stored under a hash of the function's code, so a cache is invalidated when that code
+    changes. Give a new `name` when the function's behaviour changes in some other way.
+
+    Usage:
+
+    prepare = disk_cached(load | parse | clean, "~/.cache/nightly", max_bytes=10 * 2 ** 30)
+    nightly = prepare | analyze
+    """
+    return DiskCachedFunction(function, os.path.expanduser(directory), max_bytes, name)
+
+
+def chain(*functions) -> FunctionChain:
+    """
+    Build a FunctionChain that calls the given functions in order. `chain(a, b, c)` is equivalent
+    to `a | b | c`, but the chain is built in a single pass, instead of being copied once per `|`.
+    Use it to build pipelines with many steps.
+
+    `functions` may also be a single iterable (e.g., a list or a generator) of functions. Iterators
+    are consumed without being stored first.
+
+    Usage:
+        cmp = chain(step(config) for config in configs)
+    """
+    return FunctionChain(*FunctionChain._flatten(_meta_functions(functions)))
+
+
+def merge(operator: tp.Callable, *functions, function_join_str=None) -> FunctionMerge:
+    """
+    Build a FunctionMerge that calls each of the given functions and passes all of their results
+    to `operator`. `merge(operators.concat, a, b, c)` is equivalent to `a & b & c`, but the merge
+    is built in a single pass. Like `&`, merges of `operator` in `functions` are flattened into the
+    new merge, so `operator` must accept any number of arguments.
+
+    As with `chain`, `functions` may be a single iterable of functions. Use `function_join_str` to
+    set the string used to join the names of `functions` in the merge's name.
+
+    Usage:
+        cmp = merge(operators.concat, (step(config) for config in configs))
+    """
+    return FunctionMerge(
+        operator,
+        tuple(FunctionMerge._flatten(operator, _meta_functions(functions))),
+        function_join_str=function_join_str,
+    )
+
+
+def _meta_functions(functions: tuple) -> tp.Iterator[MetaFunction]:
+    """Yield MetaFunctions for `functions`, as binary operations do for their operands. A single
+    iterable in `functions` (other than a function or a string) is iterated over.
+    """
+    if len(functions) == 1 and _is_function_iterable(functions[0]):
+        functions = functions[0]
+    empty = True
+    for f in functions:
+        empty = False
+        if callable(f):
+            yield MetaFunction.make_meta(f)
+        else:
+            yield MetaFunction.defer_value(f)
+    if empty:
+        raise exceptions.CompositionError("At least one function is required")
+
+
+def _is_function_iterable(value) -> bool:
+    return (
+        isinstance(value, Iterable)
+        and not callable(value)
+        and not isinstance(value, (str, bytes))
+    )
+
+
+def compile(
+    meta_function: MetaFunction, share_subexpressions: bool = False
+) -> MetaFunction:
     """
-    return MergeMap(MetaFunction.make_meta(function), operator)
+    Compile the given MetaFunction, flattening its chains and merges into a single generated python
+    function. The result behaves exactly like `meta_function` (including error locations reported
+    by `locate_error`), but with much less overhead per call. Parts of the pipeline that use
+    call_state (e.g., `store`, `recall`, or `bind_call_state` functions) are left uncompiled.
+
+    If `share_subexpressions` is True, a function that would be called more than once with the
+    same input during a call is only called once, and its result is reused. For example, `load` and
+    `parse` are called once, rather than twice, in `(load | parse | f) + (load | parse | g)`. Mark
+    functions that must be called every time as impure (see `node`). Functions that receive a
+    shared result (`f` and `g`, above) must not modify it.
+
+    Usage:
+        fast = compile(a | b + c | d)
+        fast(x)
+    """
+    return compile_meta_function(meta_function, share_subexpressions)
+
+
+def optimize(meta_function: MetaFunction) -> MetaFunction:
+    """
+    Return a MetaFunction that behaves like `meta_function`, with the same name and error locations,
+    but less overhead per call. Chains of arithmetic operators (e.g., `a + b + c + d`, which is
+    built as `((a + b) + c) + d`) become a single merge, merges and chains of constants are
+    evaluated once, in advance, and chains of a single function are replaced with that function.
+
+    The result can also be compiled (see `compile`).
+
+    Usage:
+        fast = optimize(a + b + c + d)
+        fast(x)
+    """
+    return optimize_meta_function(meta_function)
+
+
+def iterative(meta_function: MetaFunction) -> IterativeFunction:
+    """
+    Return a MetaFunction that behaves like `meta_function`, but calls the chains and merges in it
+    with a loop and an explicit stack, instead of by recursion. Pipelines can then be nested tens
+    of thousands of levels deep (far past python's recursion limit), and each level of nesting
+    costs less to call.
+
+    Functions that aren't chains or merges (e.g., mmaps, or compiled functions) are called as
+    usual, so very deeply nested pipelines should only be built from chains and merges.
+
+    Usage:
+        cmp = a
+        for _ in range(50000):
+            cmp = cmp + 1
+        iterative(cmp)(x)
+    """
+    return IterativeFunction(meta_function)
+
+
+def intern(meta_function: MetaFunction, table: dict = None) -> MetaFunction:
+    """
+    Return a MetaFunction equal to `meta_function` in which equal parts are shared with every other
+    interned MetaFunction. MetaFunctions compare (and hash) by structure, so separately built
+    pipelines, like two copies of `a | b`, are equal, but they're separate objects until they're
+    interned.
+
+    `table` is a dict in which interned MetaFunctions are kept. By default, a table that doesn't
+    keep them alive is shared by all calls. Interned functions share any state they have (e.g.,
+    the cache of a `cached` function, or the worker pool of a `concurrent` one).
+
+    Usage:
+        pipelines = {tenant: intern(build_pipeline(tenant)) for tenant in tenants}
+    """
+    return intern_meta_function(meta_function, table)
 
 
 def locate_error(
@@ -128,15 +455,24 @@ def locate_error(
         cmp()
     """
 
+    # If meta_function doesn't need call_state, we call it without tracking, and only work out where
+    # an exception happened after the fact.
+    tracked = meta_function._requires_call_state
+
     def with_location(*args, call_state, **kwargs):
         new_e = None
         try:
-            return meta_function(*args, call_state=call_state, **kwargs)
+            if tracked:
+                return meta_function(*args, call_state=call_state, **kwargs)
+            return meta_function(*args, **kwargs)
         except Exception as e:
             if hasattr(e, "location") and e.location:
                 # If the exception has location info attached
                 location = e.location
             else:
+                if not tracked:
+                    call_state.push(meta_function)
+                    meta_function._restore_call_state(call_state, e.__traceback__)
                 location = call_state.highlight_active_function()
 
             if use_color:
@@ -149,4 +485,23 @@ def locate_error(
         raise new_e
 
     with_location._receives_call_state = True
-    return node(with_location, name=str(meta_function))
+    with_location._keeps_call_state = False
+    parameters = (locate_error, meta_function, use_color)
+    return _Built(with_location, str(meta_function), parameters)
+
+
+class _Built(SimpleFunction):
+    def __init__(self, function: tp.Callable, name: str, parameters: tuple):
+        """A SimpleFunction built by one of the functions above (e.g., `store`), whose function is a
+        new closure each time. It's equal to others built from the same `parameters`: the building
+        function, and its arguments.
+        """
+        super().__init__(function, name)
+        self._parameters = parameters
+
+    def _repr(self):
+        # We're an ordinary SimpleFunction, as far as users are concerned
+        return "SimpleFunction({!r})".format(self._function)
+
+    def _structure(self):
+        return (self._name, self._parameters), ()
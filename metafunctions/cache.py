@@ -0,0 +1,450 @@
+import typing as tp
+import os
+import time
+import types
+import pickle
+import functools
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from collections import namedtuple
+
+from metafunctions.core import MetaFunction
+from metafunctions.core import manage_call_state
+from metafunctions import exceptions
+
+CacheInfo = namedtuple("CacheInfo", "hits misses evictions maxsize currsize")
+
+# Separates positional from keyword arguments in default cache keys
+_KWARGS_MARK = object()
+
+
+class CachedFunction(MetaFunction):
+    _requires_call_state = False
+
+    def __init__(
+        self,
+        function: tp.Callable,
+        maxsize: int = 128,
+        ttl: float = None,
+        key: tp.Callable = None,
+    ):
+        """
+        A CachedFunction calls its function at most once for each distinct set of arguments, and
+        returns the stored result on subsequent calls, as `functools.lru_cache` does.
+
+        At most `maxsize` results are kept (or any number, if maxsize is None); when the cache is
+        full, the least recently used result is evicted. Results older than `ttl` seconds are
+        evicted the next time they're requested. `key`, if given, is called with the arguments of
+        each call, and must return the hashable value used to look up its result. By default, the
+        arguments themselves are used, so they must be hashable.
+
+        Functions that use call_state can't be cached, because their results depend on (or
+        affect) the call_state they receive, not just their arguments.
+        """
+        super().__init__()
+        function = _cacheable(function)
+        if maxsize is not None and maxsize < 1:
+            raise exceptions.CompositionError("maxsize must be at least 1")
+        if ttl is not None and ttl <= 0:
+            raise exceptions.CompositionError("ttl must be positive")
+
+        self._function = function
+        self._functions = (function,)
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._key = key
+
+        # {key: (result, expiry time)}, least recently used first
+        self._cache = OrderedDict()
+        # Functions that run in threads (see `threaded`) may share a cache
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @manage_call_state
+    def __call__(self, *args, call_state=None, **kwargs):
+        key = self._make_key(args, kwargs)
+        now = time.monotonic() if self._ttl is not None else None
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                result, expires = entry
+                if expires is None or now < expires:
+                    self._cache.move_to_end(key)
+                    self._hits += 1
+                    return result
+                del self._cache[key]
+                self._evictions += 1
+            self._misses += 1
+
+        if call_state is not None:
+            kwargs["call_state"] = call_state
+        result = self._function(*args, **kwargs)
+
+        with self._lock:
+            self._cache[key] = (result, None if now is None else now + self._ttl)
+            self._cache.move_to_end(key)
+            if self._maxsize is not None and len(self._cache) > self._maxsize:
+                self._cache.popitem(last=False)
+                self._evictions += 1
+        return result
+
+    def _make_key(self, args, kwargs):
+        if self._key is not None:
+            return self._key(*args, **kwargs)
+        if not kwargs:
+            return args
+        return args + (_KWARGS_MARK,) + tuple(sorted(kwargs.items()))
+
+    def cache_info(self) -> CacheInfo:
+        """Return the number of hits, misses and evictions since the cache was last cleared, and
+        its maximum and current size.
+        """
+        with self._lock:
+            return CacheInfo(
+                self._hits,
+                self._misses,
+                self._evictions,
+                self._maxsize,
+                len(self._cache),
+            )
+
+    def cache_clear(self):
+        """Discard all cached results, and reset the cache statistics."""
+        with self._lock:
+            self._cache.clear()
+            self._hits = self._misses = self._evictions = 0
+
+    def _render(self):
+        return self._render_wrapped("cached(", self._function)
+
+    def _repr(self):
+        return "{self.__class__.__name__}({self._function!r}, maxsize={self._maxsize}, ttl={self._ttl}, key={self._key})".format(
+            self=self
+        )
+
+    def _structure(self):
+        return (self._maxsize, self._ttl, self._key), self.functions
+
+    def _with_functions(self, functions):
+        return CachedFunction(functions[0], self._maxsize, self._ttl, self._key)
+
+
+class DiskCachedFunction(MetaFunction):
+    _requires_call_state = False
+    _SUFFIX = ".pickle"
+
+    def __init__(
+        self,
+        function: tp.Callable,
+        directory: str,
+        max_bytes: int = None,
+        name: str = None,
+    ):
+        """
+        A DiskCachedFunction stores the pickled results of its function in files in `directory`, so
+        that they survive between runs, and can be shared by several processes (including the
+        children of a `concurrent` merge) at once.
+
+        Each result is stored under a hash of our function's identity and of the pickled arguments
+        it was called with. The identity is `name`, if given, and otherwise a description of the
+        function's structure, and of each function in it: its name, module and code, and the values
+        it was created with (closure variables, default arguments, the arguments of a partial,
+        etc.). Changing any of those changes the identity, but changing something a function refers
+        to (e.g., a global variable) doesn't, so give a new `name` (or clear the cache) when that
+        happens. A `name` is required if part of the function can't be described (e.g., an object
+        that can't be pickled).
+
+        When the files in `directory` take up more than `max_bytes`, the least recently used ones
+        are removed, whichever function they belong to. Arguments and results must be picklable.
+        """
+        super().__init__()
+        function = _cacheable(function)
+        if max_bytes is not None and max_bytes < 1:
+            raise exceptions.CompositionError("max_bytes must be at least 1")
+
+        self._function = function
+        self._functions = (function,)
+        self._directory = os.path.abspath(directory)
+        self._max_bytes = max_bytes
+        self._name = name
+        identity = name if name is not None else _identity(function)
+        self._prefix = _digest(identity.encode()) + "-"
+
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        # The number of bytes in the cache directory the last time we looked, plus what we've
+        # written since. Other processes may have added more, so we look again before evicting.
+        self._size = None
+
+    @manage_call_state
+    def __call__(self, *args, call_state=None, **kwargs):
+        path = self._path(args, kwargs)
+        try:
+            with open(path, "rb") as f:
+                result = pickle.load(f)
+        except FileNotFoundError:
+            pass
+        else:
+            _touch(path)
+            with self._lock:
+                self._hits += 1
+            return result
+
+        with self._lock:
+            self._misses += 1
+        if call_state is not None:
+            kwargs["call_state"] = call_state
+        result = self._function(*args, **kwargs)
+        self._store(path, result)
+        return result
+
+    def _path(self, args, kwargs):
+        data = pickle.dumps((args, sorted(kwargs.items())), pickle.HIGHEST_PROTOCOL)
+        return os.path.join(
+            self._directory, self._prefix + _digest(data) + self._SUFFIX
+        )
+
+    def _store(self, path, result):
+        """Write `result` to `path`. Readers never see partially written files, because each one is
+        written to a temporary file, which is then renamed.
+        """
+        data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        os.makedirs(self._directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self._directory, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        if self._max_bytes is None:
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += len(data)
+            if self._size > self._max_bytes:
+                self._evict()
+
+    def _entries(self):
+        """Return a list of (path, size, last use time) for each result in our directory."""
+        entries = []
+        with os.scandir(self._directory) as files:
+            for entry in files:
+                if not entry.name.endswith(self._SUFFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Another process evicted it
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict(self):
+        """Remove the least recently used results until our directory fits in max_bytes."""
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        self._size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self._size <= self._max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            else:
+                self._evictions += 1
+            self._size -= size
+
+    def cache_info(self) -> CacheInfo:
+        """Return the number of hits, misses and evictions in this process since the cache was
+        last cleared, along with max_bytes, and the number of bytes in the cache directory.
+        """
+        try:
+            size = sum(size for _, size, _ in self._entries())
+        except FileNotFoundError:
+            size = 0
+        with self._lock:
+            return CacheInfo(
+                self._hits, self._misses, self._evictions, self._max_bytes, size
+            )
+
+    def cache_clear(self):
+        """Remove our function's results from the cache directory (leaving those of any other
+        functions that share it), and reset the cache statistics.
+        """
+        with self._lock:
+            try:
+                entries = self._entries()
+            except FileNotFoundError:
+                entries = ()
+            for path, _, _ in entries:
+                if os.path.basename(path).startswith(self._prefix):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            self._size = None
+            self._hits = self._misses = self._evictions = 0
+
+    def _render(self):
+        return self._render_wrapped("disk_cached(", self._function)
+
+    def _repr(self):
+        return "{self.__class__.__name__}({self._function!r}, directory={self._directory!r}, max_bytes={self._max_bytes}, name={self._name!r})".format(
+            self=self
+        )
+
+    def _structure(self):
+        # Our prefix identifies the results we share with equal functions
+        parameters = (self._directory, self._max_bytes, self._prefix)
+        return parameters, self.functions
+
+    def _with_functions(self, functions):
+        rebuilt = DiskCachedFunction(
+            functions[0], self._directory, self._max_bytes, self._name
+        )
+        # Share results with the original function
+        rebuilt._prefix = self._prefix
+        return rebuilt
+
+
+def _cacheable(function) -> MetaFunction:
+    function = MetaFunction.make_meta(function)
+    if function._requires_call_state:
+        raise exceptions.CompositionError(
+            "{} uses call_state, so it can't be cached".format(function)
+        )
+    return function
+
+
+def _touch(path):
+    """Mark the cached result at `path` as recently used."""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def _identity(function) -> str:
+    """Return a description of `function` that's the same in every process that builds it from the
+    same code and values (unlike its repr, which contains addresses).
+    """
+    return _describe(function, frozenset())
+
+
+# Values that are described by their repr
+_SIMPLE_TYPES = (type(None), bool, int, float, complex, str, bytes)
+# Functions implemented in C, which are described by name (and the object they're bound to, if any)
+_BUILTIN_TYPES = (
+    types.BuiltinFunctionType,
+    types.MethodDescriptorType,
+    types.WrapperDescriptorType,
+    types.MethodWrapperType,
+    types.ClassMethodDescriptorType,
+)
+
+
+def _describe(value, seen: frozenset) -> str:
+    """Describe `value`, including everything that affects what it does if it's a function (e.g., the
+    contents of a closure, or the arguments of a partial). Sets and dicts are described in sorted
+    order, so that descriptions don't depend on the hash seed. `seen` contains the ids of the values
+    that contain this one, so that values that contain themselves can be described.
+    """
+    if isinstance(value, _SIMPLE_TYPES):
+        return "{}:{!r}".format(type(value).__name__, value)
+    if id(value) in seen:
+        return "<recursive>"
+    seen = seen | {id(value)}
+
+    def describe_all(values):
+        return ", ".join(_describe(v, seen) for v in values)
+
+    if isinstance(value, MetaFunction):
+        parameters, functions = value._structure()
+        return "{}[{}]({}; {})".format(
+            type(value).__qualname__,
+            value,
+            describe_all(parameters),
+            describe_all(functions),
+        )
+    if isinstance(value, (tuple, list)):
+        return "{}({})".format(type(value).__name__, describe_all(value))
+    if isinstance(value, (set, frozenset)):
+        items = sorted(_describe(v, seen) for v in value)
+        return "{}({})".format(type(value).__name__, ", ".join(items))
+    if isinstance(value, dict):
+        items = sorted(
+            "{}: {}".format(_describe(k, seen), _describe(v, seen))
+            for k, v in value.items()
+        )
+        return "dict({})".format(", ".join(items))
+    if isinstance(value, functools.partial):
+        return "partial({}; {}; {})".format(
+            _describe(value.func, seen),
+            describe_all(value.args),
+            _describe(value.keywords, seen),
+        )
+    if isinstance(value, types.FunctionType):
+        cells = []
+        for cell in value.__closure__ or ():
+            try:
+                cells.append(cell.cell_contents)
+            except ValueError:
+                # The variable hasn't been assigned yet
+                cells.append(None)
+        return "{}({}; {}; {}; {})".format(
+            _qualified_name(value),
+            _describe(value.__code__, seen),
+            _describe(value.__defaults__, seen),
+            _describe(value.__kwdefaults__, seen),
+            describe_all(cells),
+        )
+    if isinstance(value, types.MethodType):
+        return "method({}; {})".format(
+            _describe(value.__func__, seen), _describe(value.__self__, seen)
+        )
+    if isinstance(value, types.CodeType):
+        return "code({}; {}; {})".format(
+            hashlib.sha256(value.co_code).hexdigest(),
+            _describe(value.co_names, seen),
+            describe_all(value.co_consts),
+        )
+    if isinstance(value, type):
+        return _qualified_name(value)
+    if isinstance(value, _BUILTIN_TYPES):
+        bound_to = getattr(value, "__self__", None)
+        if bound_to is None or isinstance(bound_to, types.ModuleType):
+            return _qualified_name(value)
+        return "{}({})".format(_qualified_name(value), _describe(bound_to, seen))
+
+    # Anything else (e.g., an instance of a class with a __call__ method) is described by its
+    # pickle, which contains its type and its state
+    try:
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        raise exceptions.CompositionError(
+            "{!r} can't be identified, so results can't be cached for it. Give disk_cached a "
+            "name instead.".format(value)
+        ) from e
+    return "{}:{}".format(_qualified_name(type(value)), _digest(data))
+
+
+def _qualified_name(value) -> str:
+    return "{}.{}".format(
+        getattr(value, "__module__", None),
+        getattr(value, "__qualname__", type(value).__qualname__),
+    )
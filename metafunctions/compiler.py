@@ -0,0 +1,520 @@
+"""
+Compile MetaFunction pipelines into flat python functions.
+"""
+import builtins
+import functools
+import itertools
+import weakref
+import typing as tp
+
+from metafunctions.core import MetaFunction
+from metafunctions.core import SimpleFunction
+from metafunctions.core import DeferredValue
+from metafunctions.core import FunctionChain
+from metafunctions.core import FunctionMerge
+from metafunctions.core import manage_call_state
+from metafunctions.map import MergeMap
+from metafunctions.map import ReducingMergeMap
+from metafunctions.map import ColumnarMergeMap
+from metafunctions import operators
+from metafunctions import exceptions
+
+
+class CompiledFunction(MetaFunction):
+    _PUSH = "push"
+    _POP = "pop"
+    _requires_call_state = False
+
+    def __init__(self, meta_function: MetaFunction, share_subexpressions: bool = False):
+        """A CompiledFunction is a MetaFunction whose functions have been flattened into a single,
+        generated python function. Chains become sequential assignments, and merges become direct
+        calls to their merge_func, so a call no longer passes through a call_state managing wrapper
+        for every node in the tree.
+
+        If `share_subexpressions` is True, identical calls (the same function, called with the same
+        input) are only made once, e.g., the `a | b` prefix shared by both branches of
+        `(a | b | c) + (a | b | d)`. Calls to impure functions (see `node`) are never shared, and
+        functions that receive a shared result must not modify it.
+
+        Only trees made of FunctionChains, FunctionMerges, SimpleFunctions and DeferredValues that
+        never use call_state can be compiled (see `is_compilable`). Use `compile_meta_function` to
+        compile the eligible parts of an arbitrary MetaFunction.
+
+        A CompiledFunction has the same str as the MetaFunction it was built from, and when called
+        with a call_state it restores the call_state the original would have left behind on error,
+        so error locations are unchanged.
+        """
+        if not self.is_compilable(meta_function):
+            raise exceptions.CompositionError(
+                "{} cannot be compiled".format(meta_function)
+            )
+        super().__init__()
+        self._meta_function = meta_function
+        self._batched = meta_function._batched
+        self._functions = (meta_function,)
+
+        # call_state operations the uncompiled function would perform, in order, and a map of
+        # {line number: number of operations performed before that line runs}
+        self._events = []
+        self._line_events = {}
+        self._lines = ["def compiled(*args, **kwargs):"]
+        self._namespace = {}
+        self._share_subexpressions = share_subexpressions
+        # {id(object): its name in our namespace}, and {expression: the variable it's assigned to}
+        self._names = {}
+        self._expressions = {}
+
+        result = self._compile_node(meta_function, "*args")
+        self._lines.append("return {}".format(result))
+        source = "\n    ".join(self._lines)
+
+        filename = "<compiled {}>".format(meta_function)
+        exec(builtins.compile(source, filename, "exec"), self._namespace)
+        self._compiled = self._namespace["compiled"]
+        self._code = self._compiled.__code__
+        self._source = source
+
+        # A FunctionMerge that receives the arguments we're called with behaves differently when
+        # it receives more than one of them. We leave that case to the uncompiled function.
+        entry = meta_function
+        while type(entry) is FunctionChain:
+            entry = entry.functions[0]
+        self._single_arg_only = type(entry) in (FunctionMerge, FoldedMerge)
+
+    @manage_call_state
+    def __call__(self, *args, call_state=None, **kwargs):
+        if self._single_arg_only and len(args) > 1:
+            if call_state is not None:
+                kwargs["call_state"] = call_state
+            return self._meta_function(*args, **kwargs)
+        if call_state is None:
+            return self._compiled(*args, **kwargs)
+
+        try:
+            return self._compiled(*args, **kwargs)
+        except Exception as e:
+            self._restore_call_state(call_state, e.__traceback__)
+            raise
+
+    def _render(self):
+        return (self._meta_function,), self._meta_function._rendered().spans
+
+    def _repr(self):
+        return "{self.__class__.__name__}({self._meta_function!r}{share})".format(
+            self=self,
+            share=", share_subexpressions=True" if self._share_subexpressions else "",
+        )
+
+    def _structure(self):
+        return (self._share_subexpressions,), self.functions
+
+    def _with_functions(self, functions):
+        return CompiledFunction(functions[0], self._share_subexpressions)
+
+    @classmethod
+    def is_compilable(cls, function) -> bool:
+        """Return True if `function` is a MetaFunction tree that CompiledFunction can flatten."""
+        if type(function) is DeferredValue:
+            return True
+        if type(function) is SimpleFunction:
+            return not getattr(function._function, "_receives_call_state", False)
+        if type(function) in (FunctionChain, FunctionMerge, FoldedMerge):
+            return bool(function.functions) and all(
+                cls.is_compilable(f) for f in function.functions
+            )
+        return False
+
+    def _name(self, prefix, obj):
+        # Each object gets one name, so that identical calls generate identical expressions
+        try:
+            return self._names[id(obj)]
+        except KeyError:
+            pass
+        name = "_{}{}".format(prefix, len(self._namespace))
+        self._namespace[name] = obj
+        self._names[id(obj)] = name
+        return name
+
+    def _emit(self, expression, shareable=True):
+        """Add a line assigning `expression` to a new variable, and return the variable name. If
+        we're sharing subexpressions and `expression` has already been assigned, return the name
+        of the variable it was assigned to instead.
+        """
+        share = self._share_subexpressions and shareable
+        if share and expression in self._expressions:
+            return self._expressions[expression]
+        name = "_r{}".format(len(self._lines))
+        self._lines.append("{} = {}".format(name, expression))
+        # The first line of the function body is line 2
+        self._line_events[len(self._lines)] = len(self._events)
+        if share:
+            self._expressions[expression] = name
+        return name
+
+    def _compile_node(self, function, arg):
+        """Generate code that calls `function` with `arg`, and return the name of its result."""
+        if type(function) is DeferredValue:
+            # DeferredValues are called without touching call_state
+            return self._name("c", function._value)
+
+        self._events.append((self._PUSH, function))
+        if type(function) is SimpleFunction:
+            f = self._name("f", function._function)
+            result = self._emit("{}({}, **kwargs)".format(f, arg), not function._impure)
+        elif type(function) is FunctionChain:
+            result = arg
+            for f in function.functions:
+                result = self._compile_node(f, result)
+        else:
+            results = [self._compile_node(f, arg) for f in function.functions]
+            merge = self._name("m", function._merge_func)
+            expression = "{}({})".format(merge, ", ".join(results))
+            result = self._emit(expression)
+        self._events.append((self._POP,))
+        return result
+
+    def _child_span(self, count, child):
+        if child is self._meta_function:
+            return 0, self._rendered().length
+        # We stand in for our meta_function, whose functions are pushed directly beneath us
+        return self._meta_function._child_span(count, child)
+
+    def _restore_call_state(self, call_state, traceback):
+        """Given the traceback of an exception raised by our compiled function, bring call_state
+        into the state the uncompiled function would have left it in. `self` is already pushed,
+        and stands in for our meta_function's own node.
+        """
+        compiled = traceback
+        while compiled is not None and compiled.tb_frame.f_code is not self._code:
+            compiled = compiled.tb_next
+        if compiled is None:
+            # The exception wasn't raised by compiled code, so it must have come from our
+            # meta_function, which we call directly in some cases.
+            return super()._restore_call_state(call_state, traceback)
+
+        for event in self._events[1 : self._line_events[compiled.tb_lineno]]:
+            if event[0] == self._PUSH:
+                call_state.push(event[1])
+            else:
+                call_state.pop()
+
+
+class FoldedMerge(FunctionMerge):
+    def __init__(self, operator: tp.Callable, functions: tuple, function_join_str=""):
+        """A FoldedMerge stands in for a left-nested tree of FunctionMerges that apply the same
+        operator, e.g., `(a + b) + c`. It calls every function in the tree, and folds their results
+        with `operator` from left to right, as the tree would, without the intermediate merges.
+
+        All but the last of our functions belong to the first merge in the tree. So if we're called
+        with two arguments, they receive the first, and the last function receives the second.
+        """
+        super().__init__(operators.fold(operator), functions, function_join_str)
+
+    def _get_call_iterators(self, args):
+        if len(args) <= 1:
+            return super()._get_call_iterators(args)
+        if len(args) > 2:
+            raise exceptions.CallError(
+                "{} takes 1 or <= 2 arguments, but {} were given".format(
+                    self, len(args)
+                )
+            )
+        first_merge = itertools.repeat(args[0], len(self.functions) - 1)
+        return itertools.chain(first_merge, args[1:]), iter(self.functions)
+
+    def _with_functions(self, functions):
+        return FoldedMerge(
+            self._merge_func.operator, functions, self._function_join_str
+        )
+
+
+def compile_meta_function(
+    function: MetaFunction, share_subexpressions: bool = False
+) -> MetaFunction:
+    """Return a MetaFunction equivalent to `function`, in which every compilable part of the tree has
+    been replaced with a CompiledFunction. Functions that require call_state (and the MetaFunctions
+    containing them) are rebuilt around their compiled components. `share_subexpressions` is
+    passed to each CompiledFunction.
+    """
+    if CompiledFunction.is_compilable(function):
+        if isinstance(function, (FunctionChain, FunctionMerge)):
+            return CompiledFunction(function, share_subexpressions)
+        # There's nothing to gain by compiling a single function
+        return function
+    if type(function) is CompiledFunction:
+        # It's already compiled
+        return function
+    return _rebuild(
+        function,
+        functools.partial(
+            compile_meta_function, share_subexpressions=share_subexpressions
+        ),
+    )
+
+
+def optimize_meta_function(function: MetaFunction) -> MetaFunction:
+    """Return a MetaFunction equivalent to `function`, with the same name (and error locations),
+    that does less work per call:
+
+    * Left-nested arithmetic merges (e.g., `a + b + c`, which is `(a + b) + c`) are flattened into
+      a single FunctionMerge that folds its functions' results from left to right.
+    * Merges and chains of constants are replaced with their value.
+    * Chains of a single function are replaced with that function.
+    * Consecutive MergeMaps (e.g., `mmap(f) | mmap(g)`) are fused into a single MergeMap (like
+      `mmap(f | g)`), so that intermediate results aren't collected.
+    """
+    return _optimize(function, entry=True, root=True)[0]
+
+
+# Merge functions that take two arguments, and can be folded from left to right
+_FOLDABLE_OPERATORS = (operators.add, operators.sub, operators.mul, operators.truediv)
+
+
+def _optimize(function, entry=False, root=False):
+    """Return an optimized copy of `function` (or function itself, if there's nothing to optimize),
+    and the position of its name within `function`'s name.
+
+    `entry` is True if `function` may receive more than one positional argument (e.g., if it's the
+    first function in the pipeline). FunctionMerges distribute multiple arguments among their
+    functions, so they're left as they are in that case.
+    """
+    if type(function) is FunctionChain:
+        return _optimize_chain(function, entry, root)
+    if type(function) is FunctionMerge:
+        return _optimize_merge(function, entry)
+    optimized = []
+
+    def optimize(f):
+        # Our functions' names are part of ours, so they must keep them
+        optimized.append(_optimize(f, entry=True, root=True)[0])
+        return optimized[-1]
+
+    rebuilt = _rebuild(function, optimize)
+    if all(new is old for new, old in zip(optimized, function.functions)):
+        return function, 0
+    return rebuilt, 0
+
+
+def _optimize_chain(chain, entry, root):
+    optimized = [
+        _optimize(f, entry=entry and i == 0) for i, f in enumerate(chain.functions)
+    ]
+    functions = [f for f, _ in optimized]
+    if all(type(f) is DeferredValue for f in functions):
+        # Each function ignores its input, so only the last one matters
+        return _constant(functions[-1]._value, chain), 0
+    functions, spans = _fuse_maps(chain, functions, _spans(chain, optimized))
+    if len(functions) == 1 and not root:
+        return functions[0], spans[0][0]
+    if len(functions) == len(chain.functions) and all(
+        new is old for new, old in zip(functions, chain.functions)
+    ):
+        return chain, 0
+    new_chain = FunctionChain(*functions)
+    _set_rendering(new_chain, chain, spans)
+    return new_chain, 0
+
+
+# MergeMaps that can be the last of a group of fused maps (see `_fuse_maps`)
+_FUSIBLE_MAPS = (MergeMap, ReducingMergeMap, ColumnarMergeMap)
+
+
+def _fuse_maps(chain, functions, spans):
+    """Given the (optimized) functions of `chain`, and the spans of their names within its name, replace
+    each run of consecutive MergeMaps, e.g., `mmap(f) | mmap(g) | mmap(h)`, with a single MergeMap
+    that calls the functions of all of them, like `mmap(f | g | h)`. Return the new functions and
+    their spans.
+
+    Only MergeMaps that merge with `concat` can be fused with the MergeMap that follows them,
+    because their results are otherwise only ever seen by that MergeMap. The last MergeMap of a run
+    may merge (or reduce) its results in any way.
+    """
+    new_functions, new_spans = [], []
+    run = []
+    for f, span in zip(functions, spans):
+        if run and _fuses(run[-1][0], f):
+            run.append((f, span))
+            continue
+        if run:
+            _add_run(run, new_functions, new_spans)
+        run = [(f, span)]
+    if run:
+        _add_run(run, new_functions, new_spans)
+    return new_functions, new_spans
+
+
+def _fuses(first, second) -> bool:
+    """Return True if MergeMaps `first | second` can be fused into a single MergeMap."""
+    return (
+        type(first) is MergeMap
+        and first._merge_func is operators.concat
+        and type(second) in _FUSIBLE_MAPS
+        # Batched functions must be called with a batch of inputs, not with one at a time
+        and first._batch_size is None
+        and second._batch_size is None
+        # Fused functions are called in a different order, which functions that use call_state
+        # may notice
+        and not first._requires_call_state
+        and not second._requires_call_state
+        # and so may impure functions, whose side effects would happen in a different order
+        and not _contains_impure(first)
+        and not _contains_impure(second)
+    )
+
+
+def _contains_impure(function: MetaFunction) -> bool:
+    """Return True if `function`, or any function it contains, is impure (see `node`)."""
+    return any(f._impure for f in function._bottom_up())
+
+
+def _add_run(run, functions, spans):
+    if len(run) == 1:
+        functions.append(run[0][0])
+        spans.append(run[0][1])
+        return
+
+    maps = [m for m, _ in run]
+    start, end = run[0][1][0], run[-1][1][1]
+    # The chain of the maps' functions is named like the maps themselves, e.g. `mmap(f) | mmap(g)`,
+    # so that each function's name can be found within it. So is the fused map that calls it.
+    parts, function_spans = [], []
+    length = 0
+    for m in maps:
+        if parts:
+            parts.append(" | ")
+            length += len(" | ")
+        function_start, function_end = m._rendered().spans[0]
+        function_spans.append((length + function_start, length + function_end))
+        parts.append(m)
+        length += m._rendered().length
+
+    chain = FunctionChain(*(m.functions[0] for m in maps))
+    chain._rename(parts, function_spans)
+    if CompiledFunction.is_compilable(chain):
+        # The chain is called once per item, so its overhead matters
+        chain = CompiledFunction(chain)
+    fused = _rebuild(maps[-1], lambda f: chain)
+    fused._rename((chain,), ((0, length),))
+
+    functions.append(fused)
+    spans.append((start, end))
+
+
+def _optimize_merge(merge, entry):
+    optimized = [_optimize(f) for f in merge.functions]
+    functions = [f for f, _ in optimized]
+    if not entry and all(type(f) is DeferredValue for f in functions):
+        try:
+            return (
+                _constant(merge._merge_func(*(f._value for f in functions)), merge),
+                0,
+            )
+        except Exception:
+            # Leave the error to be raised (and located) when we're called
+            pass
+
+    merge_func = merge._merge_func
+    spans = _spans(merge, optimized)
+    first = functions[0]
+    if (
+        merge_func in _FOLDABLE_OPERATORS
+        and len(functions) == 2
+        and type(first) in (FunctionMerge, FoldedMerge)
+        and _folds(first, merge_func)
+    ):
+        # Our first function's functions take its place
+        start = spans[0][0]
+        first_spans = [(start + s, start + e) for s, e in first._rendered().spans]
+        functions = list(first.functions) + functions[1:]
+        spans = first_spans + spans[1:]
+        new_merge = FoldedMerge(merge_func, tuple(functions), merge._function_join_str)
+    elif all(new is old for new, old in zip(functions, merge.functions)):
+        return merge, 0
+    else:
+        new_merge = FunctionMerge(
+            merge_func, tuple(functions), merge._function_join_str
+        )
+    _set_rendering(new_merge, merge, spans)
+    return new_merge, 0
+
+
+def _folds(merge, operator) -> bool:
+    """Return True if `merge` applies `operator` to its functions' results, from left to right."""
+    if merge._merge_func is operator:
+        return len(merge.functions) == 2
+    return merge._merge_func == operators.fold(operator)
+
+
+def _spans(function, optimized):
+    """Return the span of each optimized function's name within `function`'s name."""
+    spans = []
+    for (f, start), (old_start, _) in zip(optimized, function._rendered().spans):
+        start += old_start
+        spans.append((start, start + f._rendered().length))
+    return spans
+
+
+def _set_rendering(new, original, spans):
+    # Optimized functions keep the name of the function they replace
+    new._rename((original,), spans)
+
+
+def _constant(value, original):
+    constant = DeferredValue(value)
+    constant._name = str(original)
+    return constant
+
+
+def intern_meta_function(function: MetaFunction, table=None) -> MetaFunction:
+    """Return the MetaFunction in `table` that's equal to `function`. If there isn't one, `function`
+    is added to the table, after each function in it has been replaced by the equal one in the
+    table (or added in turn), so equal parts of everything in the table are the same object.
+
+    `table` maps MetaFunctions to themselves (e.g., a dict). By default, a table shared by all
+    calls, which doesn't keep its MetaFunctions alive, is used.
+    """
+    if table is None:
+        table = _INTERNED
+    # {id(function): interned function}
+    interned = {}
+    for original in function._bottom_up():
+        f = original
+        if any(interned.get(id(g), g) is not g for g in f._structure()[1]):
+            f = _rebuild(f, lambda g: interned.get(id(g), g))
+        existing = table.get(f)
+        if existing is None:
+            table[f] = existing = f
+        interned[id(original)] = existing
+    return interned[id(function)]
+
+
+class _WeakInternTable:
+    """A table of interned MetaFunctions, from which each is removed when it's no longer used."""
+
+    def __init__(self):
+        # {function: weak reference to function}
+        self._references = weakref.WeakKeyDictionary()
+
+    def get(self, function: MetaFunction) -> tp.Optional[MetaFunction]:
+        reference = self._references.get(function)
+        return None if reference is None else reference()
+
+    def __setitem__(self, function: MetaFunction, value: MetaFunction):
+        self._references[function] = weakref.ref(value)
+
+    def __len__(self):
+        return len(self._references)
+
+
+_INTERNED = _WeakInternTable()
+
+
+def _rebuild(function: MetaFunction, transform: tp.Callable) -> MetaFunction:
+    """Return a copy of `function` in which `transform` has been applied to each of its functions, or
+    `function` itself if it doesn't contain other functions. `transform` must not change the names
+    of the functions it's given.
+    """
+    if isinstance(function, SimpleFunction):
+        # Our function isn't a MetaFunction, so there's nothing to transform
+        return function
+    return function._rebuilt(tuple(map(transform, function.functions)))
@@ -6,3 +6,4 @@ from .base import FunctionMerge
 from .decorators import manage_call_state
 from .call_state import CallState
 from .concurrent import ConcurrentMerge
+from .concurrent import ThreadedMerge
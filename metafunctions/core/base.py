@@ -2,20 +2,40 @@ import typing as tp
 import abc
 import itertools
 import functools
-
+import operator
+from collections import namedtuple
 
 from metafunctions.core.decorators import binary_operation
 from metafunctions.core.decorators import manage_call_state
+from metafunctions.core.decorators import find_call
 from metafunctions.core.call_state import CallState
 from metafunctions import operators
 from metafunctions import exceptions
+from metafunctions import util
 
+# A MetaFunction's name, as a tuple of parts, each of which is a string or a MetaFunction whose name
+# appears there, along with the name's length, and the spans of our functions' names within it (see
+# `MetaFunction._render`). Only the name of the function being printed is ever built, so deeply
+# nested functions don't each hold a copy of the names of the functions they contain.
+_Rendering = namedtuple("_Rendering", "parts length spans")
 
-class MetaFunction(metaclass=abc.ABCMeta):
 
+class MetaFunction(metaclass=abc.ABCMeta):
     # Metafunctions will pass call state to any function with this attribute set to true
     _receives_call_state = True
+    # True if this metafunction, or any function it contains, uses call state. If False, calls that
+    # don't provide a call state aren't tracked.
+    _requires_call_state = True
+    # True if this metafunction accepts a batch of inputs and returns a batch of results of the same
+    # length, rather than a single input and result (see `node`)
+    _batched = False
+    # True if calling this metafunction has side effects, or may return different results for the
+    # same input, so that calls to it can't be shared (see `compile`)
+    _impure = False
     _function_join_str = ""
+    # The (parts, spans) of the name we were given in place of the one `_render` returns, if any
+    # (see `_rename`)
+    _renamed = None
 
     @abc.abstractmethod
     def __init__(self, *args, **kwargs):
@@ -23,16 +43,177 @@ class MetaFunction(metaclass=abc.ABCMeta):
         functions it contains.
         """
         self._functions = []
+        self._rendering = None
+        self._name_string = None
+        self._representation = None
+        self._call_positions = None
+        self._hash = None
 
     @abc.abstractmethod
     def __call__(self, *args, call_state=None, **kwargs):
         """Call the functions contained in this MetaFunction"""
 
     def __str__(self):
-        return "({})".format(
-            " {} ".format(self._function_join_str).join(str(f) for f in self.functions)
+        # Our name is built once, from the parts of each function's name in it, without recursion.
+        # Functions whose names have already been built are used as they are.
+        if self._name_string is None:
+            pieces = []
+            stack = [iter(self._rendered().parts)]
+            while stack:
+                for part in stack[-1]:
+                    # Parts are strings or MetaFunctions (and checking for a str is quicker)
+                    if isinstance(part, str):
+                        pieces.append(part)
+                    elif part._name_string is not None:
+                        pieces.append(part._name_string)
+                    else:
+                        stack.append(iter(part._rendered().parts))
+                        break
+                else:
+                    stack.pop()
+            self._name_string = "".join(pieces)
+        return self._name_string
+
+    def __repr__(self):
+        # Like our name, our repr can't change, and it includes the reprs of all our functions.
+        if self._representation is None:
+            self._representation = self._repr()
+        return self._representation
+
+    def _repr(self) -> str:
+        return super().__repr__()
+
+    def __eq__(self, other):
+        """MetaFunctions are equal if they have the same type and parameters, and equal functions
+        (see `_structure`). So pipelines that are built the same way, like two copies of `a | b`,
+        are equal, even though they're separate objects.
+        """
+        if self is other:
+            return True
+        if not isinstance(other, MetaFunction):
+            return NotImplemented
+        return hash(self) == hash(other) and _structurally_equal(self, other)
+
+    def __hash__(self):
+        # Like our name, our hash can't change. Our functions are hashed first.
+        if self._hash is None:
+            for f in self._bottom_up("_hash"):
+                parameters, functions = f._structure()
+                f._hash = hash((type(f), tuple(map(_Value, parameters + functions))))
+        return self._hash
+
+    def _structure(self) -> tp.Tuple[tuple, tuple]:
+        """Return (parameters, functions), where `parameters` is a tuple of the values, other than our
+        functions, that determine our behaviour and name, and `functions` are the functions we
+        call. Subclasses add their parameters to those of `super()._structure()`.
+        """
+        # A name we were given isn't necessarily made of our functions' names
+        parameters = () if self._renamed is None else (self._renamed,)
+        return parameters, self.functions
+
+    def _with_functions(self, functions: tuple) -> "MetaFunction":
+        """Return a copy of this MetaFunction that calls `functions` in place of our functions. Each
+        has the same name as the function it replaces. Functions that transform a tree (e.g.,
+        `compile_meta_function`) use this to rebuild the MetaFunctions whose functions they change,
+        so every subclass that contains functions must implement it.
+        """
+        raise exceptions.CompositionError(
+            "{} can't be rebuilt, because it doesn't implement _with_functions".format(
+                type(self).__name__
+            )
         )
 
+    def _rebuilt(self, functions: tuple) -> "MetaFunction":
+        """Return `_with_functions(functions)`, with the name we were given, if any."""
+        if "_with_functions" not in vars(type(self)):
+            # Otherwise a subclass would be rebuilt as its base class, losing whatever it adds
+            return MetaFunction._with_functions(self, functions)
+        rebuilt = self._with_functions(functions)
+        if self._renamed is not None:
+            rebuilt._rename(*self._renamed)
+        return rebuilt
+
+    def _rename(self, parts: tuple, spans: tp.Optional[tuple]):
+        """Give us the name made of `parts`, with our functions' names at `spans` (see `_render`), in
+        place of the one we'd render, e.g., the name of a function we replace. This must be done
+        before we're compared, hashed or rendered.
+        """
+        self._renamed = (tuple(parts), spans if spans is None else tuple(spans))
+        self._rendering = self._make_rendering(*self._renamed)
+
+    def _render(self) -> tp.Tuple[tuple, tp.Optional[tuple]]:
+        """Return the parts of our name (strings, and MetaFunctions whose names appear in ours), and a
+        tuple of the (start, end) span of each of our functions' names within it (or None if our
+        functions' names don't appear in ours in order).
+        """
+        join_str = " {} ".format(self._function_join_str)
+        parts = ["("]
+        spans = []
+        start = 1
+        for i, f in enumerate(self.functions):
+            if i:
+                parts.append(join_str)
+                start += len(join_str)
+            if not isinstance(f, MetaFunction):
+                f = str(f)
+            parts.append(f)
+            spans.append((start, start + _name_length(f)))
+            start = spans[-1][1]
+        parts.append(")")
+        return tuple(parts), tuple(spans)
+
+    def _rendered(self) -> _Rendering:
+        """Return our rendering (see `_render`). MetaFunctions can't change after they're created, so
+        this is only computed once.
+        """
+        if self._rendering is None:
+            # `_render` uses the renderings of our functions, so they're rendered first
+            for f in self._bottom_up("_rendering", operator.attrgetter("functions")):
+                f._rendering = self._make_rendering(*f._render())
+        return self._rendering
+
+    @staticmethod
+    def _render_wrapped(prefix: str, function) -> tp.Tuple[tuple, tuple]:
+        """`_render` for a MetaFunction named `prefix` + its function's name + ")"."""
+        if not isinstance(function, MetaFunction):
+            function = str(function)
+        end = len(prefix) + _name_length(function)
+        return (prefix, function, ")"), ((len(prefix), end),)
+
+    @staticmethod
+    def _make_rendering(parts: tuple, spans: tp.Optional[tuple]) -> _Rendering:
+        return _Rendering(parts, sum(map(_name_length, parts)), spans)
+
+    def _bottom_up(
+        self, attribute: str = None, get_functions: tp.Callable = None
+    ) -> list:
+        """Return this MetaFunction, and the MetaFunctions it contains whose `attribute` is None (or
+        all of them, if `attribute` isn't given), in an order in which each comes after the
+        functions it contains (as returned by `get_functions`, or by default, `_structure`).
+        Computing something in that order doesn't need recursion, so it works for functions nested
+        more deeply than the recursion limit.
+        """
+        if get_functions is None:
+            get_functions = _structural_functions
+        order = []
+        seen = {id(self)}
+        stack = [(self, iter(get_functions(self)))]
+        while stack:
+            function, functions = stack[-1]
+            for f in functions:
+                if (
+                    isinstance(f, MetaFunction)
+                    and (attribute is None or getattr(f, attribute) is None)
+                    and id(f) not in seen
+                ):
+                    seen.add(id(f))
+                    stack.append((f, iter(get_functions(f))))
+                    break
+            else:
+                stack.pop()
+                order.append(function)
+        return order
+
     @property
     def functions(self):
         return self._functions
@@ -51,7 +232,77 @@ class MetaFunction(metaclass=abc.ABCMeta):
 
     @staticmethod
     def new_call_state():
-        return CallState()
+        return CallState.acquire()
+
+    @staticmethod
+    def _any_requires_call_state(functions) -> bool:
+        return any(getattr(f, "_requires_call_state", True) for f in functions)
+
+    def _restore_call_state(self, call_state, traceback):
+        """Bring `call_state`, in which this MetaFunction is the active node, into the state it would
+        have been left in if the exception with the given traceback had been raised during a
+        tracked call. This allows us to locate errors raised by untracked calls.
+
+        `traceback` may begin at any frame above the one in which this MetaFunction was called.
+        """
+        call = find_call(traceback, self)
+        if call is None or call.tb_next is None:
+            return
+        body = call.tb_next
+        child_call = find_call(body.tb_next)
+        if child_call is None:
+            # The exception was raised by this function, rather than one of its children
+            return
+        child = child_call.tb_frame.f_locals["self"]
+        if not any(child is f for f in self.functions):
+            return
+
+        call_state.record_calls(self._count_called_before(body.tb_frame))
+        call_state.push(child)
+        child._restore_call_state(call_state, child_call)
+
+    def _count_called_before(self, frame) -> int:
+        """Given the frame of a call to this MetaFunction that is currently calling one of its
+        functions, return the number of functions it had already called (and pushed onto the call
+        state) during that call.
+        """
+        return 0
+
+    def _child_span(self, count, child) -> tp.Optional[tp.Tuple[int, int]]:
+        """Return the (start, end) span of `child`'s name within our name, given that `child` is the
+        `count`th function we've called (and pushed onto the call state). Return None if `child`
+        doesn't appear in our name.
+        """
+        spans = self._rendered().spans
+        if spans is not None:
+            position = self._call_position(count, child)
+            if position is not None:
+                return spans[position]
+        return util.find_nth(str(self), str(child), count)
+
+    def _call_position(self, count, child) -> tp.Optional[int]:
+        """Return the index in self.functions of `child`, which is the `count`th function we've
+        called (and pushed onto the call state), or None if we don't know it.
+        """
+        if self._call_positions is None:
+            self._call_positions = tuple(
+                i for i, f in enumerate(self.functions) if self._pushes_call_state(f)
+            )
+        if 0 < count <= len(self._call_positions):
+            position = self._call_positions[count - 1]
+            if self.functions[position] is child:
+                return position
+        for i, f in enumerate(self.functions):
+            if f is child:
+                return i
+        return None
+
+    @staticmethod
+    def _pushes_call_state(function) -> bool:
+        """Return True if calling `function` with a call state pushes it onto that call state."""
+        return isinstance(function, MetaFunction) and not isinstance(
+            function, DeferredValue
+        )
 
     ### Operator overloads ###
     @binary_operation
@@ -124,6 +375,11 @@ class FunctionChain(MetaFunction):
         """
         super().__init__()
         self._functions = functions
+        self._requires_call_state = self._any_requires_call_state(functions)
+        # Each function's batch of results is the next one's batch of inputs
+        self._batched = bool(functions) and all(
+            getattr(f, "_batched", False) for f in functions
+        )
 
     @manage_call_state
     def __call__(self, *args, **kwargs):
@@ -133,19 +389,30 @@ class FunctionChain(MetaFunction):
             result = f(result, **kwargs)
         return result
 
-    def __repr__(self):
+    def _repr(self):
         return "{self.__class__.__name__}{self.functions}".format(self=self)
 
+    def _with_functions(self, functions):
+        return FunctionChain(*functions)
+
+    def _count_called_before(self, frame):
+        # `f_iter` has already yielded the function currently being called
+        called = len(self._functions) - operator.length_hint(frame.f_locals["f_iter"])
+        return sum(map(self._pushes_call_state, self._functions[: called - 1]))
+
     @classmethod
     def combine(cls, *funcs):
         """Merge chains; i.e., combine all FunctionChains in `funcs` into a single FunctionChain."""
-        new_funcs = []
+        return cls(*cls._flatten(funcs))
+
+    @classmethod
+    def _flatten(cls, funcs: tp.Iterable):
+        """Yield the functions in `funcs`, replacing FunctionChains with their functions."""
         for f in funcs:
             if type(f) is cls:
-                new_funcs.extend(f.functions)
+                yield from f.functions
             else:
-                new_funcs.append(f)
-        return cls(*new_funcs)
+                yield f
 
 
 class FunctionMerge(MetaFunction):
@@ -157,6 +424,9 @@ class FunctionMerge(MetaFunction):
         "&": operators.concat,
     }
     _operator_to_character = {v: k for k, v in _character_to_operator.items()}
+    _operator_to_character.update(
+        {operators.fold(f): c for f, c in _operator_to_character.items() if c != "&"}
+    )
 
     def __init__(self, merge_func: tp.Callable, functions: tuple, function_join_str=""):
         """
@@ -184,6 +454,7 @@ class FunctionMerge(MetaFunction):
         self._function_join_str = function_join_str or self._operator_to_character.get(
             merge_func, str(merge_func)
         )
+        self._requires_call_state = self._any_requires_call_state(functions)
 
     @manage_call_state
     def __call__(self, *args, **kwargs):
@@ -198,14 +469,22 @@ class FunctionMerge(MetaFunction):
             results.append(self._call_function(f, (arg,), kwargs))
 
         # Any extra functions are called with no input
-        results.extend([self._call_function(f, (), kwargs) for f in func_iter])
+        for f in func_iter:
+            results.append(self._call_function(f, (), kwargs))
         return self._merge_func(*results)
 
-    def __repr__(self):
+    def _repr(self):
         return "{self.__class__.__name__}({self._merge_func}, {self.functions})".format(
             self=self
         )
 
+    def _structure(self):
+        parameters, functions = super()._structure()
+        return parameters + (self._merge_func, self._function_join_str), functions
+
+    def _with_functions(self, functions):
+        return FunctionMerge(self._merge_func, functions, self._function_join_str)
+
     @classmethod
     def combine(cls, merge_func: tp.Callable, *funcs, function_join_str=None):
         """Combine FunctionMerges. If consecutive FunctionMerges have the same merge_funcs, combine
@@ -215,13 +494,26 @@ class FunctionMerge(MetaFunction):
         arguments, or that combining is appropriate for the operator. (e.g., it is inappropriate to
         combine FunctionMerges where order of operations matter. 5 / 2 / 3 != 5 / (2 / 3))
         """
-        new_funcs = []
+        return cls(
+            merge_func,
+            tuple(cls._flatten(merge_func, funcs)),
+            function_join_str=function_join_str,
+        )
+
+    @classmethod
+    def _flatten(cls, merge_func: tp.Callable, funcs: tp.Iterable):
+        """Yield the functions in `funcs`, replacing FunctionMerges that use `merge_func` with their
+        functions.
+        """
         for f in funcs:
             if isinstance(f, cls) and f._merge_func is merge_func:
-                new_funcs.extend(f.functions)
+                yield from f.functions
             else:
-                new_funcs.append(f)
-        return cls(merge_func, tuple(new_funcs), function_join_str=function_join_str)
+                yield f
+
+    def _count_called_before(self, frame):
+        called = self.functions[: len(frame.f_locals["results"])]
+        return sum(map(self._pushes_call_state, called))
 
     def _get_call_iterators(self, args):
         """Do length checking and return (`args_iter`, `call_iter`), iterables of arguments and
@@ -263,25 +555,47 @@ class SimpleFunction(MetaFunction):
         super().__init__()
         self._function = function
         self._name = name or getattr(function, "__name__", False) or str(function)
+        self._requires_call_state = getattr(function, "_receives_call_state", False)
 
     @manage_call_state
-    def __call__(self, *args, call_state, **kwargs):
+    def __call__(self, *args, call_state=None, **kwargs):
         if getattr(self._function, "_receives_call_state", False):
             kwargs["call_state"] = call_state
+            # Unless our function promises not to, it may keep call_state after we return
+            if getattr(self._function, "_keeps_call_state", True):
+                call_state._share()
         return self._function(*args, **kwargs)
 
-    def __repr__(self):
+    def _repr(self):
         return "{self.__class__.__name__}({self.functions[0]!r})".format(self=self)
 
     def __str__(self):
         return self._name
 
+    def _render(self):
+        # Our function's name isn't necessarily part of ours
+        return (self._name,), None
+
+    def _structure(self):
+        return (self._name, self._batched, self._impure), self.functions
+
     @property
     def functions(self):
         return (self._function,)
 
+    def _restore_call_state(self, call_state, traceback):
+        # Anything our function calls is either passed our call_state, in which case it is tracked,
+        # or uses a call_state of its own.
+        pass
+
 
 class DeferredValue(SimpleFunction):
+    _requires_call_state = False
+    _rendering = None
+    _name_string = None
+    _representation = None
+    _hash = None
+
     def __init__(self, value):
         """A simple Deferred Value. Returns `value` when called. Equivalent to lambda x: x."""
         self._value = value
@@ -290,9 +604,79 @@ class DeferredValue(SimpleFunction):
     def __call__(self, *args, **kwargs):
         return self._value
 
-    def __repr__(self):
+    def _repr(self):
         return "{self.__class__.__name__}({self._value!r})".format(self=self)
 
     @property
     def functions(self):
         return (self,)
+
+    def _structure(self):
+        return (self._value, self._name), ()
+
+
+def _name_length(part) -> int:
+    """Return the length of a part of a name (see `_Rendering`)."""
+    if isinstance(part, str):
+        return len(part)
+    return part._rendered().length
+
+
+def _structural_functions(function: MetaFunction) -> tuple:
+    return function._structure()[1]
+
+
+def _structurally_equal(first: MetaFunction, second: MetaFunction) -> bool:
+    """Compare two MetaFunctions, and each pair of functions they contain, without recursion."""
+    pending = [(first, second)]
+    compared = set()
+    while pending:
+        f, g = pending.pop()
+        if f is g or (id(f), id(g)) in compared:
+            continue
+        compared.add((id(f), id(g)))
+        if type(f) is not type(g) or hash(f) != hash(g):
+            return False
+        f_parameters, f_functions = f._structure()
+        g_parameters, g_functions = g._structure()
+        if len(f_functions) != len(g_functions) or tuple(
+            map(_Value, f_parameters)
+        ) != tuple(map(_Value, g_parameters)):
+            return False
+        for f_function, g_function in zip(f_functions, g_functions):
+            if isinstance(f_function, MetaFunction) and isinstance(
+                g_function, MetaFunction
+            ):
+                pending.append((f_function, g_function))
+            elif _Value(f_function) != _Value(g_function):
+                return False
+    return True
+
+
+class _Value:
+    """A part of a MetaFunction's structure, which compares equal to parts of the same type that are
+    equal to it, and is hashable even if the part isn't (e.g., a list passed to `merge` as a
+    constant).
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        if self.value is other.value:
+            return True
+        if type(self.value) is not type(other.value):
+            return False
+        try:
+            return bool(self.value == other.value)
+        except Exception:
+            # e.g., numpy arrays, which can only be compared elementwise
+            return False
+
+    def __hash__(self):
+        try:
+            return hash((type(self.value), self.value))
+        except TypeError:
+            return hash(type(self.value))
@@ -1,65 +1,164 @@
-from collections import namedtuple, defaultdict, OrderedDict
+from array import array
+from collections import namedtuple
 from metafunctions import util
 
 
 class CallState:
     Node = namedtuple("Node", "function insert_index")
 
+    # The maximum number of unused call states kept for reuse by `acquire`
+    POOL_SIZE = 32
+    _pool = []
+
+    _INITIAL_CAPACITY = 16
+
     def __init__(self):
         """
         A call tree keeps track of function execution order in metafunctions. This is used to
         accurately determine the location of the currently active function, and to identify
         exception locations. It can be thought of as a metafunction aware call stack.
         """
-        # Meta entry is conceptually the root node of the call tree
-        self._meta_entry = None
-        self.active_node = None
+        self.data = {}
         self._nodes_visited = 0
+        # Set once code that may keep us has seen us (see `_share`)
+        self._shared = False
 
-        # A dictionary of {child: parent} functions
-        self._parents = OrderedDict()
+        # Only the active nodes are stored, in a stack of preallocated columns that are grown by
+        # doubling. For each active node we keep a count of the children it has called, which is
+        # all we need to locate the active function (see `highlight_active_function`), so memory
+        # use depends only on the depth of the tree, not on how many functions have been called.
+        # Nodes and the {child: parent} view of the tree are only built on request.
+        self._capacity = self._INITIAL_CAPACITY
+        self._functions = [None] * self._capacity
+        self._insert_indexes = array("l", [0]) * self._capacity
+        self._child_counts = array("l", [0]) * self._capacity
+        self._depth = 0
 
-        # A dictionary of {parent: [children]}, in call order
-        self._children = defaultdict(list)
-        self.data = {}
+    @classmethod
+    def acquire(cls):
+        """Return an unused call state from the pool, or a new one if the pool is empty."""
+        try:
+            return cls._pool.pop()
+        except IndexError:
+            return cls()
+
+    @classmethod
+    def release(cls, call_state):
+        """Reset `call_state` and return it to the pool, unless it has been shared.
+
+        Only the creator of `call_state` may release it, once its call has returned (as
+        `manage_call_state` does). Anything that might keep `call_state` beyond that must
+        `_share` it first.
+        """
+        if call_state._shared or call_state._depth or len(cls._pool) >= cls.POOL_SIZE:
+            return
+        call_state._reset()
+        cls._pool.append(call_state)
+
+    def _share(self):
+        """Mark this call state as seen by code that may keep it (e.g., a `bind_call_state`
+        function, or a generator that outlives its call). It will never be reused.
+        """
+        self._shared = True
+
+    def _reset(self):
+        if len(self.data):
+            self.data = {}
+        self._nodes_visited = 0
+        self._depth = 0
+        # Drop references to functions from previous calls. Slots are filled in order, so the used
+        # ones are contiguous.
+        functions = self._functions
+        i = 0
+        while i < self._capacity and functions[i] is not None:
+            functions[i] = None
+            i += 1
+
+    def _grow(self):
+        extra = self._capacity
+        self._capacity += extra
+        self._functions.extend([None] * extra)
+        zeros = array("l", [0]) * extra
+        self._insert_indexes.extend(zeros)
+        self._child_counts.extend(zeros)
+
+    def fork(self) -> "CallState":
+        """Return a copy of this call state, for a function that is called concurrently with
+        others. The copy has the same active functions, and a copy of our data.
+        """
+        forked = CallState()
+        forked._copy_stack(self)
+        forked.data = dict(self.data)
+        return forked
+
+    def _copy_stack(self, other):
+        """Make our active functions the same as `other`'s."""
+        self._capacity = other._capacity
+        self._functions = list(other._functions)
+        self._insert_indexes = array("l", other._insert_indexes)
+        self._child_counts = array("l", other._child_counts)
+        self._depth = other._depth
+        self._nodes_visited = other._nodes_visited
 
     def push(self, f):
         """
         Push a function onto the tree
         """
-        if self._meta_entry is None:
-            node = self.Node(f, self._nodes_visited)
-            self._meta_entry = node
-        else:
-            node = self.Node(f, self._nodes_visited)
-            self._parents[node] = self.active_node
-            self._children[self.active_node].append(node)
+        depth = self._depth
+        if depth == self._capacity:
+            self._grow()
+        if depth:
+            self._child_counts[depth - 1] += 1
+        self._functions[depth] = f
+        self._insert_indexes[depth] = self._nodes_visited
+        self._child_counts[depth] = 0
+        self._depth = depth + 1
         self._nodes_visited += 1
-        self.active_node = node
 
     def pop(self):
         """Remove last inserted f from the call tree."""
-        try:
-            node, parent = self._parents.popitem()
-        except KeyError:
-            m = self._meta_entry
-            self._meta_entry = None
-            self.active_node = None
-            return m
-        self._children.pop(node, None)
-        self.active_node = parent
-        return node[0]
+        if not self._depth:
+            return None
+        self._depth -= 1
+        return self._functions[self._depth]
+
+    def record_calls(self, count):
+        """Record that the active node has called `count` functions that weren't pushed."""
+        self._child_counts[self._depth - 1] += count
+
+    def _node(self, depth):
+        return self.Node(self._functions[depth], self._insert_indexes[depth])
+
+    @property
+    def active_node(self):
+        if not self._depth:
+            return None
+        return self._node(self._depth - 1)
+
+    @property
+    def _meta_entry(self):
+        if not self._depth:
+            return None
+        return self._node(0)
+
+    @property
+    def _parents(self):
+        """A dictionary of {child: parent} active nodes"""
+        return {self._node(d): self._node(d - 1) for d in range(1, self._depth)}
 
     def iter_parent_nodes(self, node):
         """
         Return an iterator over all parents of this node in the tree, ending with the meta_entry
         point.
         """
-        # if node isn't in _parents, it must be the meta entry
-        parent = self._parents.get(node, self._meta_entry)
-        yield parent
-        if parent is not self._meta_entry:
-            yield from self.iter_parent_nodes(parent)
+        depth = self._depth - 1
+        while depth > 0 and self._insert_indexes[depth] != node.insert_index:
+            depth -= 1
+
+        # if node isn't an active child, it must be the meta entry
+        yield self._meta_entry if depth <= 0 else self._node(depth - 1)
+        for d in range(depth - 2, -1, -1):
+            yield self._node(d)
 
     def highlight_active_function(self):
         """
@@ -68,27 +167,36 @@ class CallState:
 
         Consider this a 'you are here' when called from within a function pipeline.
         """
+        name, start, end = self._active_span()
+        return name[:start] + util.highlight(name[start:end]) + name[end:]
+
+    def _active_span(self):
+        """Return the name of the meta entry function, and the (start, end) span of the active
+        function's name within it.
+        """
         current_function = self.active_node.function
-        current_name = str(current_function)
-        new_name = util.highlight(current_name)
-
-        # rename active function in parent (if active function isn't in parent, active function
-        # becomes parent)
-        for parent in self.iter_parent_nodes(self.active_node):
-            parent_name = str(parent.function)
-
-            # Note we count occurences of current name in functions we've called so far. We do this
-            # because it's possible previous functions contain the name of this function.
-            name_count = sum(
-                str(n.function).count(current_name) for n in self._children[parent]
-            )
-
-            new_name = util.replace_nth(parent_name, current_name, name_count, new_name)
-            current_function = parent.function
-            current_name = parent_name
-
-            # if new parent name hasn't changed (meaning it didn't contain the name we're
-            # highlighting), highlight the parent name
-            if new_name == parent_name:
-                new_name = util.highlight(new_name)
-        return new_name
+        start, end = 0, _name_length(current_function)
+
+        # Find the span of the active function's name in each of its parents' names in turn. (if
+        # active function isn't in parent, active function becomes parent)
+        for depth in range(self._depth - 2, -1, -1):
+            parent = self._functions[depth]
+            count = self._child_counts[depth]
+            if hasattr(parent, "_child_span"):
+                span = parent._child_span(count, current_function)
+            else:
+                span = util.find_nth(str(parent), str(current_function), count)
+
+            if span is None:
+                start, end = 0, _name_length(parent)
+            else:
+                start, end = span[0] + start, span[0] + end
+            current_function = parent
+        return str(current_function), start, end
+
+
+def _name_length(function) -> int:
+    # MetaFunctions know the lengths of their names without building them
+    if hasattr(function, "_rendered"):
+        return function._rendered().length
+    return len(str(function))
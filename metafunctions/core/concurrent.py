@@ -1,25 +1,47 @@
 import os
-from operator import itemgetter
-from multiprocessing import Queue
+import glob
+import mmap
+import signal
+import tempfile
+import threading
+import weakref
+from multiprocessing import Pipe
+from multiprocessing.connection import wait
 from collections import namedtuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import functools
 import pickle
 
+from metafunctions.core import MetaFunction
 from metafunctions.core import FunctionMerge
 from metafunctions.core import manage_call_state
+from metafunctions.core import CallState
 from metafunctions import exceptions
 
 # Result tuple to be sent back from workers. Defined at module level for eas of pickling
 _ConcurrentResult = namedtuple(
-    "_ConcurrentResult", "index result call_state_data exception location"
+    "_ConcurrentResult", "index result call_state_data exception location buffers"
 )
 
+# The out-of-band buffers of a result (see `_dump_result`), written to a file in shared memory. The
+# parent maps the file and unpickles the result directly from it.
+_SharedBuffers = namedtuple("_SharedBuffers", "path sizes")
 
-class ConcurrentMerge(FunctionMerge):
-    def __init__(self, function_merge: FunctionMerge):
-        """A subclass of FunctionMerge that calls each of its component functions in parallel.
+# Where to put _SharedBuffers files. /dev/shm is memory backed, where it exists.
+_SHARED_MEMORY_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
 
-        ConcurrentMerge takes a FunctionMerge object and upgrades it.
+
+class _UpgradedMerge(FunctionMerge):
+    # Our name is our FunctionMerge's name, with this prefix
+    _name_prefix = None
+    # Whether we can upgrade MergeMaps of batched functions. We call a MergeMap's function once per
+    # item, so by default we can't.
+    _upgrades_batches = False
+
+    def __init__(self, function_merge: FunctionMerge):
+        """A base class for FunctionMerges that upgrade another FunctionMerge, calling its
+        functions in some other way.
         """
         if not isinstance(function_merge, FunctionMerge):
             # This check is necessary because functools.wraps will copy FunctionMerge attributes to
@@ -28,13 +50,20 @@ class ConcurrentMerge(FunctionMerge):
             raise exceptions.CompositionError(
                 "{} can only upgrade FunctionMerges".format(type(self))
             )
-        if not hasattr(os, "fork"):
+        if getattr(function_merge, "_batch_size", None) and not self._upgrades_batches:
             raise exceptions.CompositionError(
-                "{} requires os.fork, and thus is only available on unix".format(
-                    type(self).__name__
+                "{} can't upgrade a map of a batched function. Give the map workers "
+                "instead.".format(type(self).__name__)
+            )
+        reason = getattr(function_merge, "_upgrade_error", None)
+        if reason is not None:
+            # Our calls collect every result, then merge them with the merge function, so anything
+            # else the merge does with its results would be lost
+            raise exceptions.CompositionError(
+                "{} can't upgrade {}: {}".format(
+                    type(self).__name__, function_merge, reason
                 )
             )
-
         super().__init__(
             function_merge._merge_func,
             function_merge._functions,
@@ -42,50 +71,35 @@ class ConcurrentMerge(FunctionMerge):
         )
         self._function_merge = function_merge
 
-    def __str__(self):
-        merge_name = str(self._function_merge)
-        return (
-            "concurrent{}".format(merge_name)
-            if merge_name.startswith("(")
-            else "concurrent({})".format(merge_name)
-        )
+    def _render(self):
+        merge = self._function_merge
+        if _first_part(merge).startswith("("):
+            parts = (self._name_prefix, merge)
+        else:
+            parts = (self._name_prefix + "(", merge, ")")
+        offset = len(parts[0])
+        spans = merge._rendered().spans
+        return parts, tuple((start + offset, end + offset) for start, end in spans)
 
-    @manage_call_state
-    def __call__(self, *args, **kwargs):
-        """We fork here, and execute each function in a child process before joining the results
-        with _merge_func
+    def _call_position(self, count, child):
+        return self._function_merge._call_position(count, child)
+
+    def _structure(self):
+        # We behave like our FunctionMerge, which may be a subclass (e.g., a MergeMap)
+        merge_parameters, functions = self._function_merge._structure()
+        return (type(self._function_merge), merge_parameters), functions
+
+    def _calls(self, args) -> list:
+        """Return a list of (index, function, args) tuples, one for each function call we should
+        make when called with `args`.
         """
         arg_iter, func_iter = self._get_call_iterators(args)
         enumerated_funcs = enumerate(func_iter)
-        result_q = Queue()
-
-        # spawn a child for each function
-        children = []
-        for arg, (i, f) in zip(arg_iter, enumerated_funcs):
-            child_pid = self._process_in_fork(i, f, result_q, (arg,), kwargs)
-            children.append(child_pid)
-
-        # iterate over any remaining functions for which we have no args
-        for i, f in enumerated_funcs:
-            child_pid = self._process_in_fork(i, f, result_q, (), kwargs)
-            children.append(child_pid)
+        calls = [(i, f, (arg,)) for arg, (i, f) in zip(arg_iter, enumerated_funcs)]
 
-        # the parent waits for all children to complete
-        for pid in children:
-            os.waitpid(pid, 0)
-
-        # then retrieves the results
-        results = []
-        # iterate over the result q in sorted order
-        result_q.put(None)
-        for r in sorted(iter(result_q.get, None), key=itemgetter(0)):
-            if r.exception:
-                raise exceptions.ConcurrentException(
-                    "Caught exception in child process", location=r.location
-                ) from pickle.loads(r.exception)
-            kwargs["call_state"].data.update(pickle.loads(r.call_state_data))
-            results.append(pickle.loads(r.result))
-        return self._merge_func(*results)
+        # add any remaining functions for which we have no args
+        calls.extend((i, f, ()) for i, f in enumerated_funcs)
+        return calls
 
     def _get_call_iterators(self, args):
         return self._function_merge._get_call_iterators(args)
@@ -93,16 +107,230 @@ class ConcurrentMerge(FunctionMerge):
     def _call_function(self, f, args: tuple, kwargs: dict):
         return self._function_merge._call_function(f, args, kwargs)
 
-    def _process_in_fork(self, idx, func, result_q, args, kwargs):
+
+def _first_part(function: MetaFunction) -> str:
+    """Return the string that `function`'s name starts with."""
+    part = function
+    while isinstance(part, MetaFunction):
+        part = part._rendered().parts[0]
+    return part
+
+
+class ConcurrentMerge(_UpgradedMerge):
+    _name_prefix = "concurrent"
+
+    # Results with at least this many bytes of out-of-band data are returned through shared memory
+    # (see `_dump_result`)
+    SHARED_MEMORY_THRESHOLD = 1024 * 1024
+
+    def __init__(
+        self,
+        function_merge: FunctionMerge,
+        pool_size: int = None,
+        max_tasks_per_worker: int = None,
+    ):
+        """A subclass of FunctionMerge that calls each of its component functions in parallel.
+
+        ConcurrentMerge takes a FunctionMerge object and upgrades it.
+
+        By default, every call forks a new child process per component function. If `pool_size` is
+        given, component functions are instead run by a pool of up to `pool_size` long lived worker
+        processes, which are forked the first time they're needed and reused by later calls. This
+        avoids the cost of forking on every call, but arguments (and call_state.data) must be
+        picklable, because they're sent to workers rather than inherited by them. Functions in a
+        pooled ConcurrentMerge receive a call_state whose meta entry is the ConcurrentMerge.
+
+        Args:
+            pool_size: The maximum number of worker processes to use.
+            max_tasks_per_worker: If given, each worker exits after calling this many functions,
+            and is replaced by a new one when needed.
+        """
+        if not hasattr(os, "fork"):
+            raise exceptions.CompositionError(
+                "{} requires os.fork, and thus is only available on unix".format(
+                    type(self).__name__
+                )
+            )
+        super().__init__(function_merge)
+
+        if pool_size is not None and pool_size < 1:
+            raise exceptions.CompositionError("pool_size must be at least 1")
+        if max_tasks_per_worker is not None and pool_size is None:
+            raise exceptions.CompositionError(
+                "max_tasks_per_worker requires a pool_size"
+            )
+
+        # Child processes send call_state.data back to the parent
+        self._requires_call_state = True
+
+        self._pool_size = pool_size
+        self._max_tasks_per_worker = max_tasks_per_worker
+        self._pool = None
+        if pool_size is not None:
+            self._pool = _WorkerPool(pool_size, max_tasks_per_worker)
+
+    def _structure(self):
+        parameters, functions = super()._structure()
+        return parameters + (self._pool_size, self._max_tasks_per_worker), functions
+
+    def _with_functions(self, functions):
+        return ConcurrentMerge(
+            self._function_merge._rebuilt(functions),
+            self._pool_size,
+            self._max_tasks_per_worker,
+        )
+
+    @manage_call_state
+    def __call__(self, *args, **kwargs):
+        """We fork here, and execute each function in a child process (or send each function to a
+        worker process, if we have a pool) before joining the results with _merge_func
+        """
+        calls = self._calls(args)
+        if self._pool is None:
+            results = self._call_in_forks(calls, kwargs)
+        else:
+            results = self._call_in_pool(calls, kwargs)
+        return self._merge_func(*self._collect(results, kwargs["call_state"]))
+
+    def _collect(self, results, call_state) -> list:
+        """Given the _ConcurrentResults of a call, in order, raise the exception of the first that
+        failed, or merge their call_state data into `call_state`, and return their results.
+        """
+        merged = []
+        try:
+            # If a function raised, its siblings were stopped, and have no results
+            failed = [r for r in results if r is not None and r.exception]
+            if failed:
+                raise exceptions.ConcurrentException(
+                    "Caught exception in child process", location=failed[0].location
+                ) from pickle.loads(failed[0].exception)
+            for r in results:
+                call_state.data.update(pickle.loads(r.call_state_data))
+                merged.append(_load_result(r))
+        finally:
+            # Don't leave shared memory behind for results we didn't load
+            for r in results:
+                if r is not None:
+                    _discard_buffers(r.buffers)
+        return merged
+
+    def close(self):
+        """Shut down our worker pool, if we have one. The pool is restarted if we're called again."""
+        if self._pool is not None:
+            self._pool.close()
+
+    def _call_in_forks(self, calls, kwargs):
+        """Call each function in `calls` in a child process of its own, and return the results in
+        order. Each child sends its result through a pipe of its own, and we read results as they
+        arrive. If a function raises, we kill its siblings, and their results are None.
+        """
+        children = {}
+        results = [None] * len(calls)
+        try:
+            # spawn a child for each function
+            for position, (i, f, args) in enumerate(calls):
+                receiver, sender = Pipe(duplex=False)
+                child_pid = self._process_in_fork(i, f, sender, args, kwargs)
+                # Only the child writes to the pipe. Closing our copy means we'll see EOF if the
+                # child exits without sending a result.
+                sender.close()
+                children[receiver] = child_pid, position
+
+            while children:
+                for receiver in wait(list(children)):
+                    child_pid, position = children.pop(receiver)
+                    try:
+                        result = receiver.recv()
+                    except EOFError:
+                        result = None
+                    receiver.close()
+                    os.waitpid(child_pid, 0)
+
+                    if result is None:
+                        raise exceptions.ConcurrentException(
+                            "Child process {} exited without returning a result".format(
+                                child_pid
+                            )
+                        )
+                    results[position] = result
+                    if result.exception:
+                        return results
+            return results
+        finally:
+            # Stop any children that are still running
+            for receiver, (child_pid, _) in children.items():
+                os.kill(child_pid, signal.SIGKILL)
+                receiver.close()
+                os.waitpid(child_pid, 0)
+                _discard_process_buffers(child_pid)
+
+    def _call_in_pool(self, calls, kwargs):
+        """Send each function in `calls` to a worker process, and return the results in order."""
+        call_state = kwargs["call_state"]
+        worker_kwargs = {k: v for k, v in kwargs.items() if k != "call_state"}
+        tasks = [
+            (i, self._function_index(i, f), args, worker_kwargs, call_state.data)
+            for i, f, args in calls
+        ]
+        results = self._pool.run(
+            self._call_in_worker, tasks, stop=lambda r: r.exception
+        )
+
+        # Workers locate errors within our name. Place those locations within the meta entry's name.
+        name, start, end = call_state._active_span()
+        return [
+            r._replace(location=name[:start] + r.location + name[end:])
+            if r is not None and r.exception
+            else r
+            for r in results
+        ]
+
+    def _function_index(self, i, f):
+        """Return the index in self._functions of f, the `i`th function we call."""
+        if i < len(self._functions) and self._functions[i] is f:
+            return i
+        for index, function in enumerate(self._functions):
+            if function is f:
+                return index
+
+    def _call_in_worker(self, task):
+        """Call the function described by `task` (see `_call_in_pool`) in a worker process."""
+        idx, function_index, args, kwargs, data = task
+        call_state = CallState()
+        call_state.data = data
+        call_state.push(self)
+        kwargs["call_state"] = call_state
+        return self._call_in_child(idx, self._functions[function_index], args, kwargs)
+
+    def _process_in_fork(self, idx, func, sender, args, kwargs):
         """Call self._call_function in a child process. This function returns the ID of the child
-        in the parent process, while the child process calls _call_function, puts the results in
-        the provided queues, then exits.
+        in the parent process, while the child process calls _call_function, sends the result
+        through `sender`, then exits.
         """
         pid = os.fork()
         if pid:
             return pid
 
         # here we are the child
+        result = None
+        try:
+            result = self._call_in_child(idx, func, args, kwargs)
+        finally:
+            # The parent reads results as they arrive, so this can't block for long, no matter how
+            # large the result is.
+            sender.send(result)
+            sender.close()
+
+            # This is the one place that the python docs say it's normal to use os._exit. Because
+            # this is executed in a child process, calling sys.exit can have unintended
+            # consequences. e.g., anything above this that catches the resulting SystemExit can
+            # cause the child process to stay alive. the unittest framework does this.
+            os._exit(0)
+
+    def _call_in_child(self, idx, func, args, kwargs) -> _ConcurrentResult:
+        """Call self._call_function, and return a _ConcurrentResult containing its pickled result,
+        or the exception it raised.
+        """
         make_result = functools.partial(
             _ConcurrentResult,
             result=None,
@@ -110,16 +338,16 @@ class ConcurrentMerge(FunctionMerge):
             index=idx,
             call_state_data=None,
             location="",
+            buffers=None,
         )
 
-        result = None
         try:
             r = self._call_function(func, args, kwargs)
 
-            # pickle here, so that we can't crash with pickle errors in the finally clause
-            pickled_r = pickle.dumps(r)
+            # pickle here, so that we can't crash with pickle errors when sending the result
+            pickled_r, buffers = self._dump_result(r)
             data = pickle.dumps(kwargs["call_state"].data)
-            result = make_result(result=pickled_r, call_state_data=data)
+            return make_result(result=pickled_r, call_state_data=data, buffers=buffers)
         except Exception as e:
             try:
                 # In case func does something stupid like raising an unpicklable exception
@@ -128,19 +356,350 @@ class ConcurrentMerge(FunctionMerge):
                 pickled_exception = pickle.dumps(
                     AttributeError("Unplicklable exception raised in {}".format(func))
                 )
-            result = make_result(
+            return make_result(
                 exception=pickled_exception,
                 location=kwargs["call_state"].highlight_active_function(),
             )
-        finally:
-            result_q.put(result)
-            # it's necessary to explicitly close the result_q and join its background thread here,
-            # because the below os._exit won't allow time for any cleanup.
-            result_q.close()
-            result_q.join_thread()
 
-            # This is the one place that the python docs say it's normal to use os._exit. Because
-            # this is executed in a child process, calling sys.exit can have unintended
-            # consequences. e.g., anything above this that catches the resulting SystemExit can
-            # cause the child process to stay alive. the unittest framework does this.
+    def _dump_result(self, result):
+        """Pickle `result`, and return the pickled bytes along with its out-of-band buffers, if any.
+
+        Objects that support pickle protocol 5 (e.g., numpy arrays), and results that are bytes or
+        bytearrays, are pickled out-of-band, as buffers that refer to their data rather than copies
+        of it. If those buffers add up to at least SHARED_MEMORY_THRESHOLD bytes, we write them to
+        shared memory once, and the parent unpickles the result from there, without copying them
+        through a pipe. Otherwise, they're returned as bytes.
+        """
+        if pickle.HIGHEST_PROTOCOL < 5:
+            return pickle.dumps(result), None
+
+        if type(result) in (bytes, bytearray):
+            result = _OutOfBandBytes(result)
+        buffers = []
+        pickled = pickle.dumps(result, protocol=5, buffer_callback=buffers.append)
+        if not buffers:
+            return pickled, None
+        try:
+            raw = [b.raw() for b in buffers]
+        except BufferError:
+            # Non-contiguous buffers can't be sent as is
+            return pickle.dumps(result), None
+
+        total = sum(m.nbytes for m in raw)
+        if not total or total < self.SHARED_MEMORY_THRESHOLD:
+            return pickled, [m.tobytes() for m in raw]
+
+        fd, path = tempfile.mkstemp(
+            prefix=_shared_memory_prefix(os.getpid()), dir=_SHARED_MEMORY_DIR
+        )
+        try:
+            with open(fd, "wb") as f:
+                for m in raw:
+                    f.write(m)
+        except BaseException:
+            os.unlink(path)
+            raise
+        return pickled, _SharedBuffers(path, tuple(m.nbytes for m in raw))
+
+
+class _OutOfBandBytes:
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        """Pickles as `data`, a bytes or bytearray object, but out-of-band, which bytes and bytearray
+        don't do on their own. They're unpickled as a copy of their buffer.
+        """
+        self.data = data
+
+    def __reduce_ex__(self, protocol):
+        return type(self.data), (pickle.PickleBuffer(self.data),)
+
+
+def _load_result(r: _ConcurrentResult):
+    """Unpickle the result in `r`."""
+    if r.buffers is None:
+        return pickle.loads(r.result)
+    if not isinstance(r.buffers, _SharedBuffers):
+        return pickle.loads(r.result, buffers=r.buffers)
+
+    # Map the shared buffers, rather than reading them. Objects that support out-of-band pickling
+    # may then refer to the mapping directly, which stays open as long as they need it.
+    with open(r.buffers.path, "rb") as f:
+        os.unlink(r.buffers.path)
+        view = memoryview(
+            mmap.mmap(f.fileno(), sum(r.buffers.sizes), access=mmap.ACCESS_COPY)
+        )
+    buffers = []
+    start = 0
+    for size in r.buffers.sizes:
+        buffers.append(view[start : start + size])
+        start += size
+    return pickle.loads(r.result, buffers=buffers)
+
+
+def _shared_memory_prefix(pid):
+    return "metafunctions-{}-".format(pid)
+
+
+def _discard_process_buffers(pid):
+    """Remove any shared memory files created by process `pid`, which has been killed."""
+    directory = _SHARED_MEMORY_DIR or tempfile.gettempdir()
+    for path in glob.glob(
+        os.path.join(directory, glob.escape(_shared_memory_prefix(pid)) + "*")
+    ):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def _discard_buffers(buffers):
+    """Remove the shared memory file of `buffers`, if it still exists."""
+    if isinstance(buffers, _SharedBuffers):
+        try:
+            os.unlink(buffers.path)
+        except FileNotFoundError:
+            pass
+
+
+class ThreadedMerge(_UpgradedMerge):
+    _name_prefix = "threaded"
+
+    # The maximum number of threads in the pool shared by all ThreadedMerges. Set this before the
+    # first ThreadedMerge is called.
+    POOL_SIZE = min(32, (os.cpu_count() or 1) + 4)
+    _executor = None
+    _executor_pid = None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, function_merge: FunctionMerge):
+        """A subclass of FunctionMerge that calls each of its component functions in a thread.
+
+        ThreadedMerge takes a FunctionMerge object and upgrades it. Unlike ConcurrentMerge, nothing
+        needs to be forked or pickled, so it suits functions that spend their time waiting on I/O,
+        or in code that releases the GIL. It also works where os.fork is unavailable.
+
+        Each function receives its own copy of the call_state (see `CallState.fork`), whose data is
+        merged back into ours after all functions have returned, in order.
+        """
+        super().__init__(function_merge)
+        self._requires_call_state = True
+
+    def _with_functions(self, functions):
+        return ThreadedMerge(self._function_merge._rebuilt(functions))
+
+    @manage_call_state
+    def __call__(self, *args, **kwargs):
+        """Submit each function to the shared thread pool, then join the results with _merge_func"""
+        call_state = kwargs["call_state"]
+        branches = []
+        for i, f, f_args in self._calls(args):
+            branch_kwargs = dict(kwargs, call_state=call_state.fork())
+            branches.append((f, f_args, branch_kwargs))
+
+        executor = self._get_executor()
+        futures = [executor.submit(self._call_function, *b) for b in branches]
+
+        results = []
+        error = None
+        for future, (f, f_args, branch_kwargs) in zip(futures, branches):
+            if future.cancel():
+                # No thread has started this function yet, so call it ourselves rather than wait.
+                # This way, ThreadedMerges nested in each other can't deadlock the pool.
+                if error is not None:
+                    continue
+                try:
+                    results.append(self._call_function(f, f_args, branch_kwargs))
+                except Exception as e:
+                    error = e, branch_kwargs["call_state"]
+            elif future.exception() is not None:
+                error = error or (future.exception(), branch_kwargs["call_state"])
+            elif error is None:
+                results.append(future.result())
+
+        if error is not None:
+            e, branch_state = error
+            # Take on the failed function's call_state, so the exception can be located
+            call_state._copy_stack(branch_state)
+            raise e
+
+        for _, _, branch_kwargs in branches:
+            call_state.data.update(branch_kwargs["call_state"].data)
+        return self._merge_func(*results)
+
+    @classmethod
+    def _get_executor(cls) -> ThreadPoolExecutor:
+        """Return the thread pool, creating it if necessary (or if we've been forked)."""
+        with cls._executor_lock:
+            if cls._executor is None or cls._executor_pid != os.getpid():
+                cls._executor = ThreadPoolExecutor(
+                    cls.POOL_SIZE, thread_name_prefix="metafunctions"
+                )
+                cls._executor_pid = os.getpid()
+            return cls._executor
+
+
+class _Worker:
+    __slots__ = ("pid", "connection", "owner", "tasks")
+
+    def __init__(self, pid, connection):
+        self.pid = pid
+        self.connection = connection
+        # The process that forked this worker
+        self.owner = os.getpid()
+        self.tasks = 0
+
+
+class _WorkerPool:
+    def __init__(self, size: int, max_tasks_per_worker: int = None):
+        """A pool of long lived worker processes, each of which receives tasks and returns results
+        over a pipe of its own. Workers are forked as they're needed, so they inherit the functions
+        they call, and only tasks and results need to be pickled.
+
+        Workers are shut down by `close`, or when the pool is garbage collected or the interpreter
+        exits.
+        """
+        self.size = size
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self._workers = []
+        self._lock = threading.Lock()
+        self._finalizer = weakref.finalize(self, _shutdown_workers, self._workers)
+
+    def run(self, handler, tasks: list, stop=None) -> list:
+        """Call `handler(task)` in a worker process for each task in `tasks`, and return the
+        results in order.
+
+        If `stop(result)` is true for any result, we return immediately. Workers that are still
+        busy are killed, and tasks that didn't finish have a result of None.
+        """
+        with self._lock:
+            if self._workers and self._workers[0].owner != os.getpid():
+                # We've been inherited by a forked process. Our workers belong to our parent.
+                _shutdown_workers(self._workers)
+
+            pending = deque(enumerate(tasks))
+            idle = list(self._workers)
+            busy = {}
+            results = [None] * len(tasks)
+            send_error = None
+            lost = 0
+
+            try:
+                while pending or busy:
+                    while pending and (idle or len(self._workers) < self.size):
+                        worker = idle.pop() if idle else self._spawn(handler)
+                        position, task = pending.popleft()
+                        try:
+                            worker.connection.send(task)
+                        except OSError:
+                            # The worker has exited. Retry with another.
+                            self._retire(worker)
+                            pending.appendleft((position, task))
+                            continue
+                        except Exception as e:
+                            # The task couldn't be pickled, so nothing was sent.
+                            send_error = send_error or e
+                            idle.append(worker)
+                            continue
+                        busy[worker.connection] = worker, position
+
+                    if not busy:
+                        break
+                    for connection in wait(list(busy)):
+                        worker, position = busy.pop(connection)
+                        try:
+                            results[position] = connection.recv()
+                        except EOFError:
+                            lost += 1
+                            self._retire(worker)
+                            continue
+                        worker.tasks += 1
+                        if worker.tasks == self.max_tasks_per_worker:
+                            # The worker exits after returning its last result
+                            self._retire(worker)
+                        else:
+                            idle.append(worker)
+                        if stop is not None and stop(results[position]):
+                            return results
+            finally:
+                # If we're interrupted, workers that are still busy would send their results to
+                # the next caller. Stop them instead.
+                for worker, _ in busy.values():
+                    os.kill(worker.pid, signal.SIGKILL)
+                    self._retire(worker)
+                    _discard_process_buffers(worker.pid)
+
+            if send_error is not None:
+                raise exceptions.ConcurrentException(
+                    "Couldn't send a task to a worker process. Arguments to functions in a "
+                    "pool must be picklable."
+                ) from send_error
+            if lost:
+                raise exceptions.ConcurrentException(
+                    "{} worker process(es) exited unexpectedly".format(lost)
+                )
+            return results
+
+    def close(self):
+        with self._lock:
+            _shutdown_workers(self._workers)
+
+    def _spawn(self, handler) -> _Worker:
+        parent_connection, child_connection = Pipe()
+        pid = os.fork()
+        if pid:
+            child_connection.close()
+            worker = _Worker(pid, parent_connection)
+            self._workers.append(worker)
+            return worker
+
+        # here we are the worker
+        try:
+            parent_connection.close()
+            for worker in self._workers:
+                worker.connection.close()
+            _serve(handler, child_connection, self.max_tasks_per_worker)
+        finally:
+            # See ConcurrentMerge._process_in_fork
             os._exit(0)
+
+    def _retire(self, worker):
+        self._workers.remove(worker)
+        worker.connection.close()
+        os.waitpid(worker.pid, 0)
+
+
+def _serve(handler, connection, max_tasks=None):
+    """The main loop of a worker process. Call handler with each task received over connection,
+    and send back the result, until we receive None or have handled `max_tasks` tasks.
+    """
+    handled = 0
+    while handled != max_tasks:
+        try:
+            task = connection.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        connection.send(handler(task))
+        handled += 1
+
+
+def _shutdown_workers(workers: list):
+    """Tell each worker we own to exit, and wait for them to do so. Workers inherited from another
+    process are only forgotten.
+    """
+    owned = [w for w in workers if w.owner == os.getpid()]
+    for worker in owned:
+        try:
+            worker.connection.send(None)
+        except OSError:
+            pass
+    for worker in workers:
+        worker.connection.close()
+    for worker in owned:
+        try:
+            os.waitpid(worker.pid, 0)
+        except ChildProcessError:
+            pass
+    workers.clear()
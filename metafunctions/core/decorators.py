@@ -4,6 +4,8 @@ Internal decorators that are applied to MetaFunction methods, not functions.
 from functools import wraps
 from collections.abc import Callable
 
+from metafunctions.core.call_state import CallState
+
 
 def binary_operation(method):
     """Internal decorator to apply common type checking for binary operations"""
@@ -22,18 +24,50 @@ def binary_operation(method):
 def manage_call_state(call_method):
     """Decorates the call method to insure call_state is present in kwargs, or create a new one.
     If the call state isn't active, we assume we are the meta entry point.
+
+    If no call state is provided and the MetaFunction doesn't require one (see
+    `MetaFunction._requires_call_state`), the call is not tracked at all. Nobody can observe the
+    call state in that case, and if a location is needed after an exception, it can be recovered
+    from the traceback (see `MetaFunction._restore_call_state`).
     """
 
     @wraps(call_method)
     def with_call_state(self, *args, **kwargs):
-        try:
-            call_state = kwargs["call_state"]
-        except KeyError:
-            call_state = self.new_call_state()
-            kwargs["call_state"] = call_state
+        call_state = kwargs.get("call_state")
+        if call_state is not None:
+            call_state.push(self)
+            r = call_method(self, *args, **kwargs)
+            call_state.pop()
+            return r
+
+        if not self._requires_call_state:
+            return call_method(self, *args, **kwargs)
+
+        # We are the meta entry point. Our call state can be reused once we're done with it, unless
+        # someone else has kept it.
+        call_state = self.new_call_state()
+        kwargs["call_state"] = call_state
         call_state.push(self)
         r = call_method(self, *args, **kwargs)
         call_state.pop()
+        CallState.release(call_state)
         return r
 
     return with_call_state
+
+
+_WITH_CALL_STATE_CODE = manage_call_state(lambda self: None).__code__
+
+
+def find_call(traceback, function=None):
+    """Return the first entry in `traceback` at which a MetaFunction (or specifically, `function`)
+    was called through `manage_call_state`, or None if there isn't one.
+    """
+    while traceback is not None:
+        frame = traceback.tb_frame
+        if frame.f_code is _WITH_CALL_STATE_CODE and (
+            function is None or frame.f_locals["self"] is function
+        ):
+            return traceback
+        traceback = traceback.tb_next
+    return None
@@ -0,0 +1,168 @@
+"""
+Call MetaFunction pipelines without recursion.
+"""
+import operator
+
+from metafunctions.core import MetaFunction
+from metafunctions.core import DeferredValue
+from metafunctions.core import FunctionChain
+from metafunctions.core import FunctionMerge
+from metafunctions.core import manage_call_state
+from metafunctions.core.decorators import find_call
+from metafunctions.compiler import FoldedMerge
+
+# Stack frame types
+_CHAIN = 0
+_MERGE = 1
+# Merge frame phases: calling functions with one argument each, then functions with no arguments
+_WITH_ARGS = 0
+_WITHOUT_ARGS = 1
+
+# Marks the absence of a result, or of another function to call
+_NOTHING = object()
+
+
+class IterativeFunction(MetaFunction):
+    def __init__(self, meta_function: MetaFunction):
+        """An IterativeFunction calls the FunctionChains and FunctionMerges in its meta_function
+        with a loop and an explicit stack, rather than by recursion. Any other function in the tree
+        (e.g., a SimpleFunction or an mmap) is called as usual.
+
+        This means that pipelines can be nested much more deeply than python's recursion limit
+        allows, and that each level of nesting costs a few list operations instead of several
+        python function calls. Otherwise, calling an IterativeFunction is the same as calling its
+        meta_function, including the way it uses call_state, and the error locations that
+        `locate_error` reports.
+        """
+        super().__init__()
+        self._meta_function = meta_function
+        self._functions = (meta_function,)
+        self._requires_call_state = meta_function._requires_call_state
+        self._batched = meta_function._batched
+
+    @manage_call_state
+    def __call__(self, *args, call_state=None, **kwargs):
+        return _run(self._meta_function, args, kwargs, call_state)
+
+    def _render(self):
+        return (self._meta_function,), self._meta_function._rendered().spans
+
+    def _repr(self):
+        return "{self.__class__.__name__}({self._meta_function!r})".format(self=self)
+
+    def _with_functions(self, functions):
+        return IterativeFunction(functions[0])
+
+    def _child_span(self, count, child):
+        if child is self._meta_function:
+            return 0, self._rendered().length
+        return self._meta_function._child_span(count, child)
+
+    def _restore_call_state(self, call_state, traceback):
+        """Push the functions that were active when the exception with the given traceback was
+        raised by an untracked call onto call_state. They're the functions in our stack, which is
+        kept in the frame of `_run`.
+        """
+        run = traceback
+        while run is not None and run.tb_frame.f_code is not _run.__code__:
+            run = run.tb_next
+        if run is None:
+            return super()._restore_call_state(call_state, traceback)
+
+        stack = run.tb_frame.f_locals["stack"]
+        for frame in stack:
+            call_state.push(frame[1])
+            call_state.record_calls(_count_called_before(frame))
+
+        # Was the exception raised by a function the last frame was calling?
+        child_call = find_call(run.tb_next)
+        if child_call is None:
+            return
+        child = child_call.tb_frame.f_locals["self"]
+        if child is not run.tb_frame.f_locals["function"]:
+            return
+        call_state.push(child)
+        child._restore_call_state(call_state, child_call)
+
+
+def _run(function, args, kwargs, call_state):
+    """Call `function` with `args` and `kwargs`, as `function(*args, **kwargs)` would. Instead of
+    calling the functions in chains and merges recursively, keep a stack of the chains and merges
+    that are in progress.
+    """
+    stack = []
+    while True:
+        # Start calling `function`. Chains and merges are added to the stack, and we move on to
+        # their first function. Anything else is called directly.
+        kind = type(function)
+        if kind is FunctionChain:
+            if call_state is not None:
+                call_state.push(function)
+            functions = iter(function._functions)
+            stack.append([_CHAIN, function, functions])
+            function = next(functions)
+            continue
+
+        if kind is FunctionMerge or kind is FoldedMerge:
+            if call_state is not None:
+                call_state.push(function)
+            frame = [_MERGE, function, None, None, [], _WITH_ARGS]
+            stack.append(frame)
+            frame[2], frame[3] = function._get_call_iterators(args)
+            result = _NOTHING
+        elif kind is DeferredValue:
+            result = function._value
+        elif call_state is None:
+            result = function(*args, **kwargs)
+        else:
+            result = function(*args, call_state=call_state, **kwargs)
+
+        # Pass the result to the chain or merge that called `function`, and find the next function
+        # to call. Chains and merges that have called all their functions are finished, and their
+        # results are passed to their callers in turn.
+        while True:
+            if not stack:
+                return result
+            frame = stack[-1]
+            if frame[0] is _CHAIN:
+                function = next(frame[2], _NOTHING)
+                if function is not _NOTHING:
+                    args = (result,)
+                    break
+            else:
+                results = frame[4]
+                if result is not _NOTHING:
+                    results.append(result)
+                function, args = _next_merge_call(frame)
+                if function is not _NOTHING:
+                    break
+                result = frame[1]._merge_func(*results)
+            stack.pop()
+            if call_state is not None:
+                call_state.pop()
+
+
+def _next_merge_call(frame):
+    """Return the next function a merge frame should call, and its args, as FunctionMerge.__call__
+    would, or (_NOTHING, None) if there aren't any.
+    """
+    if frame[5] is _WITH_ARGS:
+        arg = next(frame[2], _NOTHING)
+        if arg is not _NOTHING:
+            return next(frame[3], _NOTHING), (arg,)
+        frame[5] = _WITHOUT_ARGS
+    return next(frame[3], _NOTHING), ()
+
+
+def _count_called_before(frame) -> int:
+    """Return the number of functions the chain or merge in `frame` has called (and pushed onto
+    the call state) before the one it's currently calling.
+    """
+    function = frame[1]
+    functions = function.functions
+    if frame[0] is _CHAIN:
+        called = len(functions) - operator.length_hint(frame[2])
+        before = functions[: called - 1]
+    else:
+        before = functions[: len(frame[4])]
+    return sum(map(function._pushes_call_state, before))
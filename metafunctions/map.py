@@ -1,38 +1,609 @@
 import typing as tp
 import itertools
+import functools
+import array
+from collections.abc import Mapping
 
+from metafunctions.core import manage_call_state
+from metafunctions.core import MetaFunction
 from metafunctions.core.concurrent import FunctionMerge
+from metafunctions.core.concurrent import ConcurrentMerge
 from metafunctions.operators import concat
+from metafunctions import exceptions
+
+# Marks a fold without an initial value, which can't be None, because None is a valid initial value
+NO_INITIAL = object()
 
 
 class MergeMap(FunctionMerge):
-    def __init__(self, function: tp.Callable, merge_function: tp.Callable = concat):
+    # The default number of items per batch, for batched functions
+    BATCH_SIZE = 1024
+    # Why ConcurrentMerge and ThreadedMerge can't upgrade this kind of map, if they can't. They
+    # call the map's function on every item, and pass the results to its merge function.
+    _upgrade_error = None
+
+    def __init__(
+        self,
+        function: tp.Callable,
+        merge_function: tp.Callable = concat,
+        batch_size: int = None,
+    ):
         """
         MergeMap is a FunctionMerge with only one function. When called, it behaves like the
         builtin `map` function and calls its function once per item in the iterable(s) it receives.
+
+        If the function is batched (see `node`), it's instead called once per batch of up to
+        `batch_size` items, and the results of each batch are merged as if they'd been returned by
+        separate calls. Each argument of a batched function is a slice of the corresponding
+        iterable we received, if that iterable is a sequence (e.g., a list or numpy array), or a
+        list otherwise.
         """
         super().__init__(merge_function, (function,))
+        self._batch_size = None
+        if getattr(function, "_batched", False):
+            if batch_size is not None and batch_size < 1:
+                raise exceptions.CompositionError("batch_size must be at least 1")
+            self._batch_size = batch_size or self.BATCH_SIZE
+        elif batch_size is not None:
+            raise exceptions.CompositionError(
+                "batch_size requires a batched function (see `node`)"
+            )
+        elif _calls_batched(function):
+            raise exceptions.CompositionError(
+                "{} would be called one item at a time, but calls batched functions. Map them "
+                "separately, or make every function in its chain batched.".format(
+                    function
+                )
+            )
+
+    @manage_call_state
+    def __call__(self, *args, **kwargs):
+        return self._merge_func(*self._map(self.functions[0], args, kwargs))
+
+    def _map(self, f, args: tuple, kwargs: dict) -> tp.Iterator:
+        """Return an iterator over the results of calling f with each item in `args`, a tuple of
+        iterables, as the builtin map would.
+        """
+        if self._batch_size is None:
+            return (f(*item, **kwargs) for item in zip(*args))
+        return self._map_batches(f, args, kwargs)
+
+    def _map_batches(self, f, args, kwargs):
+        for batch in _batches(args, self._batch_size):
+            results = f(*batch, **kwargs)
+            if len(results) != len(batch[0]):
+                raise exceptions.CallError(
+                    "{} returned {} results for a batch of {} items".format(
+                        f, len(results), len(batch[0])
+                    )
+                )
+            yield from results
 
     def _get_call_iterators(self, args):
         """
         Each element in args is an iterable.
         """
-        args_iter = zip(*args)
-
         # Note that EVERY element in the func iter will be called, so we need to make sure the
-        # length of our iterator is the same as the shortest iterable we received.
-        shortest_arg = min(args, key=len)
-        func_iter = itertools.repeat(self.functions[0], len(shortest_arg))
-        return args_iter, func_iter
+        # length of our iterator is the same as the shortest iterable we received. Args may be
+        # iterators, so we find that by consuming them.
+        items = list(zip(*args))
+        func_iter = itertools.repeat(self.functions[0], len(items))
+        return iter(items), func_iter
 
     def _call_function(self, f, args: tuple, kwargs: dict):
         """In MergeMap, args will be a single element tuple containing the args for this function."""
         return f(*args[0], **kwargs)
 
-    def __str__(self):
-        return "mmap({self.functions[0]!s})".format(self=self)
+    def _count_called_before(self, frame):
+        # We call our only function repeatedly, so the number of calls doesn't affect its location
+        return 0
+
+    def _call_position(self, count, child):
+        # We call our only function repeatedly
+        return 0
+
+    def _render(self):
+        return self._render_wrapped("mmap(", self.functions[0])
+
+    def _repr(self):
+        return "{self.__class__.__name__}({self.functions[0]}, merge_function={self._merge_func}{batch_size})".format(
+            self=self, batch_size=self._batch_size_repr()
+        )
+
+    def _batch_size_repr(self):
+        if self._batch_size is None:
+            return ""
+        return ", batch_size={}".format(self._batch_size)
+
+    def _structure(self):
+        parameters, functions = super()._structure()
+        return parameters + (self._batch_size,), functions
+
+    def _with_functions(self, functions):
+        return MergeMap(functions[0], self._merge_func, self._batch_size)
+
+
+class ReducingMergeMap(MergeMap):
+    _upgrade_error = "it folds its results with reduce. Give the map workers instead."
+
+    def __init__(
+        self,
+        function: tp.Callable,
+        reduce: tp.Callable,
+        initial=NO_INITIAL,
+        batch_size: int = None,
+    ):
+        """
+        A MergeMap that folds its function's results into a single value with `reduce`, as
+        `functools.reduce(reduce, map(function, ...), initial)` would. Each result is folded in as
+        soon as it's produced, so results are never all held in memory at once.
+        """
+        super().__init__(function, batch_size=batch_size)
+        self._reduce = reduce
+        self._initial = initial
+
+    @manage_call_state
+    def __call__(self, *args, **kwargs):
+        results = self._map(self.functions[0], args, kwargs)
+        return _fold(self._reduce, results, self._initial)
+
+    def _repr(self):
+        return "{self.__class__.__name__}({self.functions[0]}, reduce={self._reduce}{initial}{batch_size})".format(
+            self=self,
+            initial=_initial_repr(self._initial),
+            batch_size=self._batch_size_repr(),
+        )
+
+    def _structure(self):
+        parameters, functions = super()._structure()
+        return parameters + (self._reduce, self._initial), functions
+
+    def _with_functions(self, functions):
+        return ReducingMergeMap(
+            functions[0], self._reduce, self._initial, self._batch_size
+        )
+
+
+class ColumnarMergeMap(MergeMap):
+    _upgrade_error = "it collects its results into columns before merging them."
+
+    def __init__(
+        self,
+        function: tp.Callable,
+        merge_function: tp.Callable = concat,
+        typecodes: str = None,
+        batch_size: int = None,
+    ):
+        """
+        A MergeMap whose function returns records (e.g., tuples of fields). Instead of merging
+        the records, it collects each field into a column of its own, and passes the columns to
+        `merge_function`. Records are discarded as soon as their fields have been collected.
+
+        Columns are lists, unless `typecodes` is given, in which case field `i` is collected into
+        an `array.array` of `typecodes[i]`, and records must have `len(typecodes)` fields.
+        Otherwise, the number of fields is that of the first record, and there are no columns if
+        there are no records.
+        """
+        if typecodes is not None:
+            for typecode in typecodes:
+                if typecode not in array.typecodes:
+                    raise exceptions.CompositionError(
+                        "{!r} is not an array typecode".format(typecode)
+                    )
+        super().__init__(function, merge_function, batch_size)
+        self._typecodes = typecodes
+
+    @manage_call_state
+    def __call__(self, *args, **kwargs):
+        records = self._map(self.functions[0], args, kwargs)
+        if self._typecodes is not None:
+            columns = [array.array(typecode) for typecode in self._typecodes]
+        else:
+            try:
+                first = next(records)
+            except StopIteration:
+                return self._merge_func()
+            columns = [[] for _ in first]
+            records = itertools.chain((first,), records)
+
+        appends = [column.append for column in columns]
+        for record in records:
+            if len(record) != len(columns):
+                raise exceptions.CallError(
+                    "{} returned a record with {} fields, but there are {} columns".format(
+                        self.functions[0], len(record), len(columns)
+                    )
+                )
+            for append, value in zip(appends, record):
+                append(value)
+        return self._merge_func(*columns)
+
+    def _repr(self):
+        return "{self.__class__.__name__}({self.functions[0]}, merge_function={self._merge_func}, typecodes={self._typecodes!r}{batch_size})".format(
+            self=self, batch_size=self._batch_size_repr()
+        )
+
+    def _structure(self):
+        parameters, functions = super()._structure()
+        return parameters + (self._typecodes,), functions
+
+    def _with_functions(self, functions):
+        return ColumnarMergeMap(
+            functions[0], self._merge_func, self._typecodes, self._batch_size
+        )
+
+
+class LazyMergeMap(MergeMap):
+    _upgrade_error = (
+        "its results are produced lazily, not all at once. Use mmap instead."
+    )
+
+    def __init__(self, function: tp.Callable, batch_size: int = None):
+        """
+        A MergeMap that returns an iterator over its function's results, rather than merging them.
+        Like the builtin `map`, it accepts any iterables, including unbounded ones, and its
+        function is only called on an item (or batch) when the next result is requested.
+        """
+        super().__init__(function, batch_size=batch_size)
+        # Our function is called after we return. It needs a call state of its own, so that errors
+        # can still be located within us.
+        self._requires_call_state = True
+
+    @manage_call_state
+    def __call__(self, *args, call_state, **kwargs):
+        # Our function receives a copy of call_state as it is now, which shares its data. Both are
+        # used after we return, so call_state can't be reused.
+        call_state._share()
+        branch = call_state.fork()
+        branch.data = call_state.data
+        kwargs["call_state"] = branch
+        results = self._map(self.functions[0], args, kwargs)
+        return self._iterate(results, call_state, branch)
+
+    def _iterate(self, results, call_state, branch):
+        try:
+            yield from results
+        except Exception:
+            # We're probably being consumed by another function. Place the error within us rather
+            # than it.
+            call_state._copy_stack(branch)
+            raise
+
+    def _render(self):
+        return self._render_wrapped("imap(", self.functions[0])
+
+    def _repr(self):
+        return "{self.__class__.__name__}({self.functions[0]})".format(self=self)
+
+    def _with_functions(self, functions):
+        return LazyMergeMap(functions[0], self._batch_size)
+
+
+class ArrayMergeMap(MergeMap):
+    def __init__(
+        self,
+        function: tp.Callable,
+        dtype=None,
+        vectorized: bool = False,
+        batch_size: int = None,
+    ):
+        """
+        A MergeMap that returns a numpy array of its function's results, rather than merging them
+        with a merge function. If `dtype` is given, results are written into a preallocated array of
+        that dtype as they're produced, instead of being collected as python objects first.
+        Otherwise, they're collected first, and the array's dtype is the one numpy chooses for all
+        of them (e.g., float if some results are ints and others floats).
+
+        If `vectorized` is true, arrays we receive (objects that support the buffer protocol, or
+        define `__array__`) are passed to our function whole, as if it were batched (see `node`),
+        or in batches of `batch_size` items if given. The function must then behave like a ufunc,
+        and return an array with one result per item. Other iterables are mapped an item at a time.
+
+        numpy is an optional dependency of metafunctions, which ArrayMergeMap requires.
+        """
+        _import_numpy()
+        if vectorized and not getattr(function, "_batched", False):
+            # We batch arrays ourselves
+            if batch_size is not None and batch_size < 1:
+                raise exceptions.CompositionError("batch_size must be at least 1")
+            super().__init__(function, functools.partial(_merge_array, dtype))
+        else:
+            super().__init__(
+                function, functools.partial(_merge_array, dtype), batch_size
+            )
+        self._dtype = dtype
+        self._vectorized = vectorized
+        self._array_batch_size = batch_size
+
+    @manage_call_state
+    def __call__(self, *args, **kwargs):
+        numpy = _import_numpy()
+        f = self.functions[0]
+        if self._vectorized and args and all(map(_is_array, args)):
+            return self._map_arrays(f, [_as_array(numpy, a) for a in args], kwargs)
+
+        count = -1
+        if all(hasattr(a, "__len__") for a in args):
+            count = min(map(len, args), default=0)
+        return _fill_array(numpy, self._map(f, args, kwargs), count, self._dtype)
+
+    def _map_arrays(self, f, arrays: list, kwargs: dict):
+        """Call f with batches of `arrays`, and return an array of the results."""
+        numpy = _import_numpy()
+        length = min(map(len, arrays))
+        size = self._array_batch_size or max(length, 1)
+        out = None
+        for start in range(0, length, size):
+            stop = min(start + size, length)
+            results = numpy.asarray(f(*(a[start:stop] for a in arrays), **kwargs))
+            if results.shape[:1] != (stop - start,):
+                raise exceptions.CallError(
+                    "{} returned an array of shape {} for a batch of {} items".format(
+                        f, results.shape, stop - start
+                    )
+                )
+            if size >= length:
+                # There's only one batch, so its results are our results
+                return results.astype(self._dtype or results.dtype, copy=False)
+            if out is None:
+                shape = (length,) + results.shape[1:]
+                out = numpy.empty(shape, self._dtype or results.dtype)
+            elif self._dtype is None and not numpy.can_cast(results.dtype, out.dtype):
+                # Widen the array for this batch's results, as numpy would for all of them
+                out = out.astype(numpy.result_type(out, results))
+            out[start:stop] = results
+        if out is None:
+            return numpy.empty(0, self._dtype)
+        return out
+
+    def _repr(self):
+        return "{self.__class__.__name__}({self.functions[0]}, dtype={self._dtype!r}, vectorized={self._vectorized}{batch_size})".format(
+            self=self,
+            batch_size=""
+            if self._array_batch_size is None
+            else ", batch_size={}".format(self._array_batch_size),
+        )
+
+    def _structure(self):
+        # Our merge function is a new partial for each ArrayMergeMap
+        parameters = (self._dtype, self._vectorized, self._array_batch_size)
+        return parameters, self.functions
+
+    def _with_functions(self, functions):
+        return ArrayMergeMap(
+            functions[0], self._dtype, self._vectorized, self._array_batch_size
+        )
+
+
+class ParallelMergeMap(ConcurrentMerge):
+    # Our MergeMap's _map method calls batched functions correctly
+    _upgrades_batches = True
+    # See MergeMap._upgrade_error
+    _upgrade_error = (
+        "it already calls its function in worker processes, on chunks of its input."
+    )
+    # Without a chunksize, the input is split into about this many chunks per worker
+    CHUNKS_PER_WORKER = 4
+
+    def __init__(
+        self,
+        function: tp.Callable,
+        merge_function: tp.Callable = concat,
+        workers: int = 1,
+        chunksize: int = None,
+        reduce: tp.Callable = None,
+        initial=NO_INITIAL,
+        batch_size: int = None,
+    ):
+        """
+        A MergeMap that calls its function in a pool of `workers` worker processes. The input is
+        split into chunks of `chunksize` items, and each chunk is sent to a worker as a single task.
+        Results are merged in input order, so a ParallelMergeMap returns the same result as the
+        equivalent MergeMap.
+
+        If `reduce` is given, results are folded as by a ReducingMergeMap instead of merged. Each
+        worker folds the results of its chunk, and we fold those partial results, starting with
+        `initial`. For that to give the same result as folding every result in order, `reduce`
+        must be associative, and accept its own results as either argument.
+
+        As with a pooled ConcurrentMerge, inputs, results and call_state.data must be picklable, and
+        the function receives a call_state whose meta entry is the ParallelMergeMap. Call `close()`
+        to shut the pool down.
+        """
+        if chunksize is not None and chunksize < 1:
+            raise exceptions.CompositionError("chunksize must be at least 1")
+        super().__init__(
+            MergeMap(function, merge_function, batch_size), pool_size=workers
+        )
+        self._chunksize = chunksize
+        self._reduce = reduce
+        self._initial = initial
+
+    @manage_call_state
+    def __call__(self, *args, **kwargs):
+        # Each chunk is a slice of each of args, so a batched function receives slices of the
+        # sequences we received, as it would from a MergeMap.
+        if not all(map(_sliceable, args)):
+            args = tuple(map(list, zip(*zip(*args))))
+        length = min(map(len, args), default=0)
+        chunksize = self._chunksize or self._default_chunksize(length)
+        function = self.functions[0]
+        calls = [
+            (i, function, tuple(a[start : start + chunksize] for a in args))
+            for i, start in enumerate(range(0, length, chunksize))
+        ]
+        chunks = self._collect(self._call_in_pool(calls, kwargs), kwargs["call_state"])
+        if self._reduce is not None:
+            return _fold(self._reduce, chunks, self._initial)
+        return self._merge_func(*itertools.chain.from_iterable(chunks))
+
+    def _default_chunksize(self, item_count) -> int:
+        chunks = self._pool_size * self.CHUNKS_PER_WORKER
+        return max(1, -(-item_count // chunks))
+
+    def _call_function(self, f, args: tuple, kwargs: dict):
+        """In a ParallelMergeMap, args is a chunk: a tuple of equal length, non-empty slices of the
+        iterables we received.
+        """
+        results = self._function_merge._map(f, args, kwargs)
+        if self._reduce is not None:
+            return functools.reduce(self._reduce, results)
+        return list(results)
+
+    def _render(self):
+        # We return the same results as a MergeMap, so we have the same name
+        merge = self._function_merge
+        return (merge,), merge._rendered().spans
+
+    def _repr(self):
+        return "{self.__class__.__name__}({self.functions[0]}, merge_function={self._merge_func}, workers={self._pool_size}, chunksize={self._chunksize}{reduce}{batch_size})".format(
+            self=self,
+            reduce=self._reduce_repr(),
+            batch_size=self._function_merge._batch_size_repr(),
+        )
+
+    def _structure(self):
+        parameters, functions = super()._structure()
+        return parameters + (self._chunksize, self._reduce, self._initial), functions
 
-    def __repr__(self):
-        return "{self.__class__.__name__}({self.functions[0]}, merge_function={self._merge_func})".format(
-            self=self
+    def _with_functions(self, functions):
+        return ParallelMergeMap(
+            functions[0],
+            self._merge_func,
+            self._pool_size,
+            self._chunksize,
+            self._reduce,
+            self._initial,
+            self._function_merge._batch_size,
         )
+
+    def _reduce_repr(self):
+        if self._reduce is None:
+            return ""
+        return ", reduce={}{}".format(self._reduce, _initial_repr(self._initial))
+
+
+def _calls_batched(function) -> bool:
+    """Return True if `function` isn't batched, but contains a batched function, which would
+    receive what `function` receives. Maps call their own functions, so they're not searched.
+    """
+    pending = [function]
+    seen = {id(function)}
+    while pending:
+        f = pending.pop()
+        if f is not function and getattr(f, "_batched", False):
+            return True
+        if isinstance(f, MetaFunction) and not isinstance(
+            f, (MergeMap, ParallelMergeMap)
+        ):
+            pending.extend(g for g in f.functions if id(g) not in seen)
+            seen.update(map(id, f.functions))
+    return False
+
+
+def _fold(function: tp.Callable, iterable: tp.Iterable, initial=NO_INITIAL):
+    """functools.reduce, with NO_INITIAL standing for a missing initial value."""
+    if initial is NO_INITIAL:
+        return functools.reduce(function, iterable)
+    return functools.reduce(function, iterable, initial)
+
+
+def _initial_repr(initial) -> str:
+    if initial is NO_INITIAL:
+        return ""
+    return ", initial={!r}".format(initial)
+
+
+def _sliceable(iterable) -> bool:
+    return (
+        hasattr(iterable, "__len__")
+        and hasattr(iterable, "__getitem__")
+        and not isinstance(iterable, Mapping)
+    )
+
+
+def _batches(args: tuple, size: int) -> tp.Iterator[tuple]:
+    """Yield tuples containing a batch of up to `size` items from each of `args`, stopping at the
+    end of the shortest. Sequences are sliced (so numpy arrays yield arrays), and items from other
+    iterables are collected into lists.
+    """
+    if not args:
+        return
+    if all(map(_sliceable, args)):
+        length = min(map(len, args))
+        for start in range(0, length, size):
+            stop = min(start + size, length)
+            yield tuple(a[start:stop] for a in args)
+        return
+
+    items = zip(*args)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield tuple(map(list, zip(*batch)))
+
+
+def _import_numpy():
+    """Return the numpy module, which is an optional dependency."""
+    try:
+        import numpy
+    except ImportError:
+        raise exceptions.CompositionError(
+            "numpy is required for array output"
+        ) from None
+    return numpy
+
+
+def _is_array(obj) -> bool:
+    """Return True if obj is array-like: if it defines `__array__` or supports the buffer protocol."""
+    if hasattr(obj, "__array__"):
+        return True
+    try:
+        memoryview(obj)
+    except TypeError:
+        return False
+    return True
+
+
+def _as_array(numpy, obj):
+    if isinstance(obj, numpy.ndarray):
+        return obj
+    if hasattr(obj, "__array__"):
+        return numpy.asarray(obj)
+    # Buffers (e.g., bytes or array.array) are viewed as arrays of their items, not copied
+    return numpy.asarray(memoryview(obj))
+
+
+def _merge_array(dtype, *results):
+    # ArrayMergeMaps only merge results when their functions are called by something else, e.g., a
+    # ConcurrentMerge
+    return _fill_array(_import_numpy(), results, len(results), dtype)
+
+
+def _fill_array(numpy, results: tp.Iterable, count: int, dtype=None):
+    """Return an array of `results`, which contains `count` results, or an unknown number if
+    `count` is -1. If dtype is None, it's the dtype numpy chooses for all the results.
+    """
+    if dtype is None:
+        # Later results may need a wider dtype than the first (e.g., a float after ints, or a
+        # longer string), so they can't be written into an array made for the first
+        results = list(results)
+        return numpy.array(results) if results else numpy.empty(0)
+
+    results = iter(results)
+    try:
+        first = numpy.asarray(next(results))
+    except StopIteration:
+        return numpy.empty(0, dtype)
+
+    if first.ndim == 0:
+        # fromiter fills a preallocated array, if it knows the count
+        return numpy.fromiter(itertools.chain((first[()],), results), dtype, count)
+    if count == -1:
+        return numpy.array([first, *results], dtype)
+    out = numpy.empty((count,) + first.shape, dtype)
+    out[0] = first
+    for i, result in enumerate(results, 1):
+        out[i] = result
+    return out
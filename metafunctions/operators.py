@@ -1,9 +1,74 @@
 """
 Extra operators used by MetaFunctions
 """
+import sys
+import functools
 from operator import add, sub, truediv, mul
 
 
 def concat(*args):
     "concat(1, 2, 3) -> (1, 2, 3)"
     return args
+
+
+class fold:
+    "fold(sub)(1, 2, 3) -> (1 - 2) - 3"
+
+    # The numpy ufuncs that apply our operators, which can write their results into an existing array
+    _UFUNCS = {add: "add", sub: "subtract", mul: "multiply", truediv: "true_divide"}
+
+    def __init__(self, operator):
+        self.operator = operator
+        self._ufunc_name = self._UFUNCS.get(operator)
+
+    def __call__(self, *args):
+        if len(args) < 3:
+            return functools.reduce(self.operator, args)
+
+        # The result of the first operation is a new object, which no one else can see, so if it's
+        # an array we can accumulate the rest of the results into it, rather than creating a new
+        # array for each one.
+        total = self.operator(args[0], args[1])
+        numpy = sys.modules.get("numpy")
+        if (
+            numpy is None
+            or self._ufunc_name is None
+            or type(total) is not numpy.ndarray
+        ):
+            return functools.reduce(self.operator, args[2:], total)
+
+        ufunc = getattr(numpy, self._ufunc_name)
+        for arg in args[2:]:
+            if _fits(numpy, total, arg):
+                ufunc(total, arg, out=total)
+            else:
+                # The result has a different type or shape, so it's a new array anyway
+                total = self.operator(total, arg)
+        return total
+
+    def __eq__(self, other):
+        return type(other) is fold and other.operator is self.operator
+
+    def __hash__(self):
+        return hash((fold, self.operator))
+
+    def __repr__(self):
+        return "fold({})".format(getattr(self.operator, "__name__", self.operator))
+
+
+# N-ary sum and product. merge_sum(a, b, c) == (a + b) + c, but numpy arrays are summed into a
+# single result array, without creating a temporary array for each addition.
+merge_sum = fold(add)
+merge_prod = fold(mul)
+
+
+def _fits(numpy, array, other) -> bool:
+    """Return True if the result of an operation on `array` and `other` can be written to `array`."""
+    try:
+        return (
+            numpy.result_type(array, other) == array.dtype
+            and numpy.broadcast(array, other).shape == array.shape
+        )
+    except Exception:
+        # E.g., `other` isn't something numpy understands. Let the operator decide what to do.
+        return False
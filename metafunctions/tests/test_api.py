@@ -3,8 +3,10 @@ import functools
 
 from metafunctions.tests.util import BaseTestCase
 from metafunctions.tests.simple_nodes import *
-from metafunctions.api import store, recall, node, bind_call_state
-from metafunctions.core import SimpleFunction, CallState
+from metafunctions.api import store, recall, node, bind_call_state, chain, merge
+from metafunctions.core import SimpleFunction, CallState, FunctionChain, FunctionMerge
+from metafunctions import operators
+from metafunctions import exceptions
 
 
 class TestUnit(BaseTestCase):
@@ -84,3 +86,57 @@ class TestUnit(BaseTestCase):
 
     def test_str_recall(self):
         self.assertEqual(str(recall("key")), "recall('key')")
+
+    def test_chain(self):
+        cmp = chain(a, b | c, "d", lambda x: x + "e")
+        self.assertIsInstance(cmp, FunctionChain)
+        self.assertEqual(str(cmp), "(a | b | c | 'd' | <lambda>)")
+        self.assertEqual(cmp("_"), "de")
+        self.assertEqual(repr(chain(a, b, c)), repr(a | b | c))
+
+        steps = (node(lambda x, i=i: x + str(i), name=str(i)) for i in range(1000))
+        cmp = chain(steps)
+        self.assertEqual(len(cmp.functions), 1000)
+        self.assertEqual(cmp(""), "".join(str(i) for i in range(1000)))
+
+        self.assertEqual(str(chain(iter([a]))), "(a)")
+        for functions in ([a, b], (a, b)):
+            with self.subTest(functions=functions):
+                self.assertEqual(chain(functions), a | b)
+                self.assertEqual(str(chain(functions)), "(a | b)")
+        # A single string is a value, not an iterable of values
+        self.assertEqual(str(chain("d")), "('d')")
+        with self.assertRaises(exceptions.CompositionError):
+            chain()
+        with self.assertRaises(exceptions.CompositionError):
+            chain(iter(()))
+        with self.assertRaises(exceptions.CompositionError):
+            chain([])
+
+    def test_merge(self):
+        cmp = merge(operators.concat, a, b & c, "d")
+        self.assertIsInstance(cmp, FunctionMerge)
+        self.assertEqual(str(cmp), "(a & b & c & 'd')")
+        self.assertEqual(cmp("_"), ("_a", "_b", "_c", "d"))
+        self.assertEqual(repr(merge(operators.concat, a, b)), repr(a & b))
+
+        # Merges with other operators aren't flattened
+        cmp = merge(operators.concat, (f for f in (a, b + c)))
+        self.assertEqual(str(cmp), "(a & (b + c))")
+        self.assertEqual(cmp("_"), ("_a", "_b_c"))
+
+        def join(*args):
+            return "".join(args)
+
+        cmp = merge(join, merge(join, a, b), c, function_join_str="~")
+        self.assertEqual(str(cmp), "(a ~ b ~ c)")
+        self.assertEqual(cmp("_"), "_a_b_c")
+
+        for functions in ([a, b], (a, b)):
+            with self.subTest(functions=functions):
+                cmp = merge(join, functions, function_join_str="~")
+                self.assertEqual(str(cmp), "(a ~ b)")
+                self.assertEqual(merge(join, functions)("_"), "_a_b")
+
+        with self.assertRaises(exceptions.CompositionError):
+            merge(join)
@@ -0,0 +1,387 @@
+import os
+import sys
+import unittest
+import functools
+import subprocess
+import threading
+from unittest import mock
+
+from metafunctions.tests.util import BaseTestCase
+from metafunctions.tests.simple_nodes import *
+from metafunctions.api import node
+from metafunctions.api import cached
+from metafunctions.api import disk_cached
+from metafunctions.api import concurrent
+from metafunctions.api import store
+from metafunctions.api import recall
+from metafunctions.api import mmap
+from metafunctions.api import threaded
+from metafunctions.api import locate_error
+from metafunctions.api import compile
+from metafunctions.cache import CachedFunction
+from metafunctions.cache import DiskCachedFunction
+from metafunctions.cache import CacheInfo
+from metafunctions.core import CallState
+from metafunctions.compiler import CompiledFunction
+from metafunctions import exceptions
+
+
+# Inputs received by the functions below. They refer to it as a global, so that it isn't part of
+# their identity when they're disk cached.
+CALLS = []
+
+
+@node
+def record(x, suffix="r"):
+    CALLS.append(x)
+    return x + suffix
+
+
+def scale(x, factor):
+    CALLS.append(x)
+    return x * factor
+
+
+def make_scale(factor):
+    @node
+    def scale_by(x):
+        CALLS.append(x)
+        return x * factor
+
+    return scale_by
+
+
+def vowels(x):
+    return "".join(c for c in x if c in {"a", "e", "i", "o", "u"})
+
+
+class RecordCalls:
+    """Gives tests `self.record`, a node that appends each input it receives to `self.calls`."""
+
+    def setUp(self):
+        super().setUp()
+        CALLS.clear()
+        self.calls = CALLS
+        self.record = record
+
+
+class TestUnit(RecordCalls, BaseTestCase):
+    def test_basic(self):
+        cmp = cached(self.record)
+        self.assertIsInstance(cmp, CachedFunction)
+        self.assertEqual(str(cmp), "cached(record)")
+        self.assertEqual(
+            repr(cmp),
+            "CachedFunction({!r}, maxsize=128, ttl=None, key=None)".format(self.record),
+        )
+
+        self.assertEqual(cmp("_"), "_r")
+        self.assertEqual(cmp("_"), "_r")
+        self.assertEqual(cmp("-"), "-r")
+        self.assertEqual(self.calls, ["_", "-"])
+        self.assertEqual(cmp.cache_info(), CacheInfo(1, 2, 0, 128, 2))
+
+        cmp.cache_clear()
+        self.assertEqual(cmp.cache_info(), CacheInfo(0, 0, 0, 128, 0))
+        self.assertEqual(cmp("_"), "_r")
+        self.assertEqual(self.calls, ["_", "-", "_"])
+
+    def test_kwargs(self):
+        cmp = cached(self.record)
+        self.assertEqual(cmp("_", suffix="s"), "_s")
+        self.assertEqual(cmp("_", suffix="s"), "_s")
+        self.assertEqual(cmp("_"), "_r")
+        self.assertEqual(cmp("_", "r"), "_r")
+        self.assertEqual(self.calls, ["_", "_", "_"])
+
+    def test_lru(self):
+        cmp = cached(self.record, maxsize=2)
+        for x in "abacab":
+            cmp(x)
+        # 'c' evicts 'b', the least recently used, and 'b' then evicts 'a'
+        self.assertEqual(self.calls, ["a", "b", "c", "b"])
+        self.assertEqual(cmp.cache_info(), CacheInfo(2, 4, 2, 2, 2))
+
+        unbounded = cached(self.record, maxsize=None)
+        for x in range(1000):
+            unbounded(str(x))
+        self.assertEqual(unbounded.cache_info().currsize, 1000)
+
+    def test_ttl(self):
+        cmp = cached(self.record, ttl=10)
+        with mock.patch("time.monotonic", return_value=100):
+            cmp("_")
+            cmp("_")
+        with mock.patch("time.monotonic", return_value=109.9):
+            cmp("_")
+        with mock.patch("time.monotonic", return_value=110):
+            cmp("_")
+        self.assertEqual(self.calls, ["_", "_"])
+        self.assertEqual(cmp.cache_info(), CacheInfo(2, 2, 1, 128, 1))
+
+    def test_key(self):
+        @node
+        def total(values):
+            self.calls.append(values)
+            return sum(values)
+
+        cmp = cached(total, key=tuple)
+        self.assertEqual(cmp([1, 2]), 3)
+        self.assertEqual(cmp([1, 2]), 3)
+        self.assertEqual(len(self.calls), 1)
+
+        with self.assertRaises(TypeError):
+            cached(total)([1, 2])
+
+    def test_none_result(self):
+        @node
+        def nothing(x):
+            self.calls.append(x)
+
+        cmp = cached(nothing)
+        self.assertIsNone(cmp(1))
+        self.assertIsNone(cmp(1))
+        self.assertEqual(self.calls, [1])
+
+    def test_composition(self):
+        cmp = a | cached(self.record) + cached(b) | c
+        self.assertEqual(str(cmp), "(a | (cached(record) + cached(b)) | c)")
+        self.assertEqual(cmp("_"), "_ar_abc")
+        self.assertEqual(cmp("_"), "_ar_abc")
+        self.assertEqual(self.calls, ["_a"])
+
+        cmp = (a & b & a) | mmap(cached(self.record))
+        self.assertEqual(cmp("_"), ("_ar", "_br", "_ar"))
+        self.assertEqual(self.calls, ["_a", "_a", "_b"])
+
+        cmp = threaded(cached(self.record) + cached(self.record))
+        self.assertEqual(cmp("x"), "xrxr")
+
+        # Plain functions are upgraded, and the cache isn't affected by call_state.
+        cmp = cached(lambda x: x * 2) | store("k") | recall("k")
+        self.assertEqual(cmp(2), 4)
+        state = CallState()
+        self.assertEqual(cmp(2, call_state=state), 4)
+        self.assertEqual(state.data, {"k": 4})
+        self.assertEqual(cmp.functions[0].cache_info().hits, 1)
+
+    def test_call_state_functions(self):
+        for f in (store("x"), recall("x"), a | recall("x")):
+            with self.subTest(f=str(f)):
+                with self.assertRaises(exceptions.CompositionError):
+                    cached(f)
+
+    def test_composition_errors(self):
+        with self.assertRaises(exceptions.CompositionError):
+            cached(a, maxsize=0)
+        with self.assertRaises(exceptions.CompositionError):
+            cached(a, ttl=0)
+
+    def test_locate_error(self):
+        @node
+        def fail(x):
+            if x.startswith("_"):
+                1 / 0
+            return x
+
+        cmp = locate_error(a | cached(b | fail) | c, use_color=False)
+        self.assertEqual(cmp("-"), "-abc")
+        with self.assertRaises(ZeroDivisionError) as e:
+            cmp("_")
+        self.assertIn("(a | cached((b | ->fail<-)) | c)", str(e.exception))
+        with self.assertRaises(ZeroDivisionError) as e:
+            locate_error(cached(fail) + a, use_color=False)("_")
+        self.assertIn("(cached(->fail<-) + a)", str(e.exception))
+
+    def test_compile(self):
+        cmp = compile(cached(a | b) | c)
+        self.assertIsInstance(cmp.functions[0], CachedFunction)
+        self.assertEqual(cmp("_"), "_abc")
+        self.assertEqual(cmp("_"), "_abc")
+        self.assertEqual(cmp.functions[0].cache_info().hits, 1)
+
+
+class TestDisk(RecordCalls, BaseTestCase):
+    def cache_files(self):
+        return sorted(
+            f
+            for f in os.listdir(self.self_destructing_directory)
+            if not f.startswith(".")
+        )
+
+    def test_basic(self):
+        directory = self.self_destructing_directory
+        cmp = disk_cached(self.record, directory)
+        self.assertIsInstance(cmp, DiskCachedFunction)
+        self.assertEqual(str(cmp), "disk_cached(record)")
+
+        self.assertEqual(cmp("_"), "_r")
+        self.assertEqual(cmp("_"), "_r")
+        self.assertEqual(cmp("_", suffix="s"), "_s")
+        self.assertEqual(self.calls, ["_", "_"])
+        self.assertEqual(len(self.cache_files()), 2)
+        info = cmp.cache_info()
+        self.assertEqual(info[:4], (1, 2, 0, None))
+        self.assertGreater(info.currsize, 0)
+
+        # Results outlive the function that stored them
+        again = disk_cached(self.record, directory)
+        self.assertEqual(again("_"), "_r")
+        self.assertEqual(self.calls, ["_", "_"])
+        self.assertEqual(again.cache_info().hits, 1)
+
+        cmp.cache_clear()
+        self.assertEqual(self.cache_files(), [])
+        self.assertEqual(cmp.cache_info(), CacheInfo(0, 0, 0, None, 0))
+
+    def test_identity(self):
+        directory = self.self_destructing_directory
+
+        @node
+        def f(x):
+            CALLS.append(x)
+            return x * 3
+
+        # Same code, same results, even for a rebuilt pipeline
+        disk_cached(a | b, directory)("_")
+        disk_cached(a | b, directory)("_")
+        self.assertEqual(len(self.cache_files()), 1)
+
+        # Different structure or code, different results
+        for cmp in (a | c, a + b, b | a, f):
+            disk_cached(cmp, directory)("_")
+        self.assertEqual(len(self.cache_files()), 5)
+        self.assertEqual(disk_cached(f, directory)(2), 6)
+        self.assertEqual(disk_cached(make_scale(2), directory)(2), 4)
+        self.assertEqual(self.calls, ["_", 2, 2])
+
+        # A name takes the place of the function's identity
+        self.assertEqual(disk_cached(make_scale(2), directory, name="n")(3), 6)
+        self.assertEqual(disk_cached(make_scale(5), directory, name="n")(3), 6)
+
+    def test_identity_values(self):
+        # Functions created with different values have different results
+        directory = self.self_destructing_directory
+        for first, second, args, results in (
+            (
+                functools.partial(scale, factor=2),
+                functools.partial(scale, factor=3),
+                (5,),
+                (10, 15),
+            ),
+            (functools.partial(scale, 2), functools.partial(scale, 3), (5,), (10, 15)),
+            (make_scale(1), make_scale(100), (5,), (5, 500)),
+            (lambda x, n=2: x * n, lambda x, n=3: x * n, (5,), (10, 15)),
+            ("-".join, ",".join, (["a", "b"],), ("a-b", "a,b")),
+        ):
+            with self.subTest(first=first):
+                self.assertEqual(disk_cached(first, directory)(*args), results[0])
+                self.assertEqual(disk_cached(second, directory)(*args), results[1])
+                # Equal values share results
+                count = len(self.cache_files())
+                self.assertEqual(disk_cached(first, directory)(*args), results[0])
+                self.assertEqual(len(self.cache_files()), count)
+
+    def test_identity_hash_seed(self):
+        # Sets are described in a fixed order, so identities don't depend on the hash seed
+        code = (
+            "from metafunctions.cache import _identity\n"
+            "from metafunctions.tests import test_cache\n"
+            "print(_identity(test_cache.vowels))\n"
+            "print(_identity(test_cache.make_scale({'x', 'y', 'z'})))\n"
+        )
+        identities = set()
+        for seed in ("1", "2", "3"):
+            process = subprocess.run(
+                [sys.executable, "-c", code],
+                env=dict(os.environ, PYTHONHASHSEED=seed),
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+                check=True,
+            )
+            identities.add(process.stdout)
+        self.assertEqual(len(identities), 1)
+
+    def test_unidentifiable(self):
+        class Unpicklable:
+            def __init__(self):
+                self.lock = threading.Lock()
+
+            def __call__(self, x):
+                return x
+
+        directory = self.self_destructing_directory
+        with self.assertRaises(exceptions.CompositionError):
+            disk_cached(Unpicklable(), directory)
+        with self.assertRaises(exceptions.CompositionError):
+            disk_cached(a | Unpicklable(), directory)
+        self.assertEqual(disk_cached(Unpicklable(), directory, name="u")(1), 1)
+
+    def test_eviction(self):
+        directory = self.self_destructing_directory
+        cmp = disk_cached(self.record, directory, max_bytes=10**6)
+        for x in "abc":
+            cmp(x)
+        size = cmp.cache_info().currsize
+        files = {}
+        for i, x in enumerate("abc"):
+            path = cmp._path((x,), {})
+            os.utime(path, (i, i))
+            files[x] = path
+
+        # Using 'a' makes 'b' the least recently used
+        cmp("a")
+        cmp._max_bytes = size
+        cmp("d")
+        self.assertFalse(os.path.exists(files["b"]))
+        self.assertTrue(os.path.exists(files["a"]))
+        self.assertTrue(os.path.exists(files["c"]))
+        self.assertEqual(cmp.cache_info().evictions, 1)
+        self.assertLessEqual(cmp.cache_info().currsize, size)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "Concurent isn't available on windows")
+    def test_processes(self):
+        # Results stored by concurrent children are available to everyone
+        directory = self.self_destructing_directory
+        cached_a = disk_cached(a, directory)
+        cmp = concurrent(cached_a & disk_cached(b, directory) & cached_a)
+        self.assertEqual(cmp("_"), ("_a", "_b", "_a"))
+        self.assertEqual(len(self.cache_files()), 2)
+
+        cmp = concurrent(disk_cached(a, directory) + disk_cached(b, directory), 2)
+        self.addCleanup(cmp.close)
+        self.assertEqual(cmp("_"), "_a_b")
+        self.assertEqual(len(self.cache_files()), 2)
+
+    def test_composition(self):
+        directory = self.self_destructing_directory
+        cmp = a | disk_cached(b + c, directory) | d
+        self.assertEqual(str(cmp), "(a | disk_cached((b + c)) | d)")
+        self.assertEqual(cmp("_"), "_ab_acd")
+        self.assertEqual(cmp("_"), "_ab_acd")
+
+        with self.assertRaises(exceptions.CompositionError):
+            disk_cached(store("x"), directory)
+        with self.assertRaises(exceptions.CompositionError):
+            disk_cached(a, directory, max_bytes=0)
+
+    def test_locate_error(self):
+        @node
+        def fail(x):
+            1 / 0
+
+        directory = self.self_destructing_directory
+        cmp = locate_error(a | disk_cached(b | fail, directory), use_color=False)
+        with self.assertRaises(ZeroDivisionError) as e:
+            cmp("_")
+        self.assertIn("(a | disk_cached((b | ->fail<-)))", str(e.exception))
+        self.assertEqual(self.cache_files(), [])
+
+    def test_compile(self):
+        directory = self.self_destructing_directory
+        cmp = disk_cached(a | b, directory)
+        cmp("_")
+        compiled = compile(cmp)
+        self.assertIsInstance(compiled.functions[0], CompiledFunction)
+        self.assertEqual(compiled("_"), "_ab")
+        self.assertEqual(compiled.cache_info().hits, 1)
@@ -1,10 +1,17 @@
+from unittest import mock
+
 from metafunctions.tests.util import BaseTestCase
 from metafunctions.tests.simple_nodes import *
 from metafunctions.api import bind_call_state
 from metafunctions.api import node
 from metafunctions.api import mmap
+from metafunctions.api import imap
 from metafunctions.api import locate_error
+from metafunctions.api import store
+from metafunctions.api import recall
+from metafunctions.api import star
 from metafunctions.core import CallState
+from metafunctions.core import FunctionChain
 
 
 class TestUnit(BaseTestCase):
@@ -59,6 +66,9 @@ class TestUnit(BaseTestCase):
         a, b, c, d = "a b c d".split()
         Node = CallState.Node
 
+        def child_counts(tree):
+            return list(tree._child_counts[: tree._depth])
+
         tree = CallState()
         tree.push(a)
         tree.push(a)
@@ -70,23 +80,11 @@ class TestUnit(BaseTestCase):
         self.assertDictEqual(
             tree._parents, {Node(b, 2): Node(a, 0), Node(a, 3): Node(b, 2)}
         )
-        self.assertDictEqual(
-            tree._children,
-            {
-                Node(a, 0): [Node(a, 1), Node(b, 2)],
-                Node(b, 2): [Node(a, 3)],
-            },
-        )
+        self.assertEqual(tree.active_node, Node(a, 3))
+        self.assertEqual(child_counts(tree), [2, 1, 0])
 
         tree.push(b)
-        self.assertDictEqual(
-            tree._children,
-            {
-                Node(a, 0): [Node(a, 1), Node(b, 2)],
-                Node(b, 2): [Node(a, 3)],
-                Node(a, 3): [Node(b, 4)],
-            },
-        )
+        self.assertEqual(child_counts(tree), [2, 1, 1, 0])
         self.assertDictEqual(
             tree._parents,
             {
@@ -101,25 +99,27 @@ class TestUnit(BaseTestCase):
         for f in a, b, c, d:
             tree.push(f)
             tree.pop()
-        self.assertDictEqual(
-            tree._children,
-            {
-                Node(a, 0): [Node(a, 1), Node(b, 2)],
-                Node(b, 2): [
-                    Node(a, 3),
-                    Node(a, 5),
-                    Node(b, 6),
-                    Node(c, 7),
-                    Node(d, 8),
-                ],
-            },
-        )
+        self.assertEqual(child_counts(tree), [2, 5])
         self.assertDictEqual(
             tree._parents,
             {
                 Node(b, 2): Node(a, 0),
             },
         )
+        tree.record_calls(3)
+        self.assertEqual(child_counts(tree), [2, 8])
+
+    def test_bounded_memory(self):
+        # Call states don't grow with the number of functions called
+        @node
+        @bind_call_state
+        def size(call_state, x):
+            return call_state._capacity, call_state._depth
+
+        state = CallState()
+        sizes = mmap(a | size)(["_"] * 10000, call_state=state)
+        self.assertEqual(set(sizes), {(CallState._INITIAL_CAPACITY, 3)})
+        self.assertEqual(state._nodes_visited, 30001)
 
     def test_iter_parent_nodes(self):
         @node
@@ -249,3 +249,177 @@ class TestUnit(BaseTestCase):
         self.assertEqual(str(tim), "tim")
         self.assertEqual(str(atim), "(a | tim)")
         self.assertEqual(atim("_"), "(a | ->tim<-)")
+
+    @mock.patch("metafunctions.core.base.CallState")
+    def test_untracked_calls(self, mock_call_state):
+        # Pipelines that don't use call state don't create one
+        @node
+        def f(x):
+            return x + "f"
+
+        cmp = a | b & f | mmap(c)
+        self.assertFalse(cmp._requires_call_state)
+        self.assertEqual(cmp("_"), ("_abc", "_afc"))
+        mock_call_state.assert_not_called()
+
+        # But they do if something needs it
+        cmp = a | store("a") | b
+        self.assertTrue(cmp._requires_call_state)
+        cmp("_")
+        mock_call_state.acquire.assert_called_once_with()
+
+    def test_requires_call_state(self):
+        @node
+        @bind_call_state
+        def f(call_state, x):
+            return x
+
+        self.assertFalse(a._requires_call_state)
+        self.assertFalse((a | b)._requires_call_state)
+        self.assertFalse((a + 1)._requires_call_state)
+        self.assertFalse(mmap(a & b)._requires_call_state)
+        self.assertTrue(f._requires_call_state)
+        self.assertTrue((a | (b & f))._requires_call_state)
+        self.assertTrue(mmap(f)._requires_call_state)
+        self.assertTrue(recall("x")._requires_call_state)
+        self.assertTrue(locate_error(a)._requires_call_state)
+
+    def test_untracked_locations(self):
+        # Locations of errors raised in untracked calls are the same as in tracked ones
+        @node
+        def fail_on_b(x):
+            if x.endswith("b"):
+                raise ValueError("b!")
+            return x + "f"
+
+        @node
+        @bind_call_state
+        def tracked(call_state, x):
+            return x
+
+        cases = (
+            (
+                a | fail_on_b | b | fail_on_b | c,
+                "(a | fail_on_b | b | ->fail_on_b<- | c)",
+            ),
+            (b | (a & a & fail_on_b), "(b | (a & a & ->fail_on_b<-))"),
+            (b | a + 1, "(b | ->(a + 1)<-)"),
+            (
+                (a | fail_on_b) + (b | fail_on_b),
+                "((a | fail_on_b) + (b | ->fail_on_b<-))",
+            ),
+            ((b & b) | star(fail_on_b & c), "((b & b) | ->star(fail_on_b & c)<-)"),
+        )
+        for cmp, expected in cases:
+            with self.subTest(cmp=str(cmp)):
+                for pipeline in (cmp, FunctionChain(cmp, tracked)):
+                    self.assertEqual(pipeline._requires_call_state, pipeline is not cmp)
+                    with self.assertRaises(Exception) as e:
+                        locate_error(pipeline, use_color=False)("_")
+                    location = str(e.exception).split(": ", 1)[1]
+                    if pipeline is cmp:
+                        self.assertEqual(location, expected)
+                    else:
+                        self.assertEqual(location, "({} | tracked)".format(expected))
+
+    def test_pooling(self):
+        # Call states created for a call are reused, unless they were shared with something that
+        # might keep them.
+        kept = []
+
+        @node
+        @bind_call_state
+        def keep(call_state, x):
+            kept.append(call_state)
+            return x
+
+        CallState._pool.clear()
+        cmp = a | store("x") | b | recall("x") | locate_error(c)
+        self.assertEqual(cmp("_"), "_ac")
+        self.assertEqual(len(CallState._pool), 1)
+        state = CallState._pool[0]
+        self.assertEqual(cmp("_"), "_ac")
+        self.assertEqual(CallState._pool, [state])
+
+        # A reused call state is reset
+        self.assertEqual(state.data, {})
+        self.assertIsNone(state.active_node)
+        self.assertEqual(state._nodes_visited, 0)
+
+        cmp = a | keep | store("x")
+        self.assertEqual(cmp("_"), "_a")
+        self.assertEqual(CallState._pool, [])
+        self.assertIs(kept[0], state)
+        self.assertEqual(kept[0].data, {"x": "_a"})
+
+        # imap's call state is used after it returns
+        results = imap(a)("xy")
+        self.assertEqual(CallState._pool, [])
+        self.assertEqual(list(results), ["xa", "ya"])
+
+        # call states that are provided are never pooled
+        provided = CallState()
+        (a | store("x"))("_", call_state=provided)
+        self.assertEqual(CallState._pool, [])
+
+    def test_deep_tree(self):
+        # Call states grow as required
+        @node
+        @bind_call_state
+        def location(call_state, x):
+            return call_state.highlight_active_function()
+
+        cmp = location
+        for _ in range(100):
+            cmp = FunctionChain(a, cmp)
+        state = CallState()
+        self.assertEqual(
+            cmp("_", call_state=state), "(a | " * 100 + "->location<-" + ")" * 100
+        )
+        self.assertEqual(state._nodes_visited, 201)
+        self.assertIsNone(state.active_node)
+
+    def test_highlight_spans(self):
+        # Locations are found from the structure of the pipeline, rather than by searching names
+        @node
+        def m(x):
+            if x == "fail":
+                raise ValueError()
+            return x
+
+        @node(name="m | m")
+        def tricky(x):
+            return x
+
+        cases = (
+            (mmap(m), ["ok", "fail"], "mmap(->m<-)"),
+            (mmap(m) | mmap(m), ["ok", "fail"], "(mmap(->m<-) | mmap(m))"),
+            (tricky | m, "fail", "(m | m | ->m<-)"),
+            (mmap(m) + m, "fail", "(mmap(m) + ->m<-)"),
+            ("ok" | m & (m | "fail" | m), None, "('ok' | (m & (m | 'fail' | ->m<-)))"),
+        )
+        for cmp, arg, expected in cases:
+            with self.subTest(cmp=str(cmp)):
+                tracked = FunctionChain(cmp, store("_"))
+                with self.assertRaises(ValueError) as e:
+                    locate_error(cmp, use_color=False)(arg)
+                self.assertEqual(str(e.exception).split(": ", 1)[1], expected)
+
+                with self.assertRaises(ValueError) as e:
+                    locate_error(tracked, use_color=False)(arg)
+                self.assertEqual(
+                    str(e.exception).split(": ", 1)[1],
+                    "({} | store('_'))".format(expected),
+                )
+
+    def test_rendering_cached(self):
+        cmp = a | b + c | mmap(d)
+        self.assertIsNone(cmp._rendering)
+        self.assertEqual(str(cmp), "(a | (b + c) | mmap(d))")
+        self.assertEqual(cmp._rendering.spans, ((1, 2), (5, 12), (15, 22)))
+        self.assertEqual(cmp._rendering.length, len(str(cmp)))
+        # The name is only built once
+        self.assertIs(str(cmp), str(cmp))
+        with mock.patch.object(type(cmp), "_render") as render:
+            self.assertEqual(str(cmp), "(a | (b + c) | mmap(d))")
+        render.assert_not_called()
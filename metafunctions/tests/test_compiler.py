@@ -0,0 +1,548 @@
+import operator
+import unittest
+import os
+
+from metafunctions.tests.util import BaseTestCase
+from metafunctions.tests.simple_nodes import *
+from metafunctions.api import node
+from metafunctions.api import store
+from metafunctions.api import recall
+from metafunctions.api import mmap
+from metafunctions.api import imap
+from metafunctions.api import concurrent
+from metafunctions.api import locate_error
+from metafunctions.api import compile
+from metafunctions.api import optimize
+from metafunctions.api import merge
+from metafunctions.api import chain
+from metafunctions.api import cached
+from metafunctions.api import iterative
+from metafunctions.api import intern
+from metafunctions.compiler import CompiledFunction
+from metafunctions.map import MergeMap
+from metafunctions.map import ReducingMergeMap
+from metafunctions.core import FunctionChain
+from metafunctions.core import FunctionMerge
+from metafunctions.core import CallState
+from metafunctions.core import DeferredValue
+from metafunctions.core import SimpleFunction
+from metafunctions.engine import IterativeFunction
+from metafunctions import operators
+from metafunctions import exceptions
+
+
+class TestUnit(BaseTestCase):
+    def test_basic(self):
+        cmp = compile(a | b + c | d)
+        self.assertIsInstance(cmp, CompiledFunction)
+        self.assertEqual(cmp("_"), "_ab_acd")
+        self.assertEqual(str(cmp), "(a | (b + c) | d)")
+        self.assertEqual(repr(cmp), "CompiledFunction({!r})".format(a | b + c | d))
+
+    def test_same_results(self):
+        @node
+        def f(x, y=1):
+            return x * y
+
+        pipelines = (
+            a | b | c,
+            a + b,
+            a & b & "c",
+            (a & b) | "".join,
+            a | (b & (c | d) & "x") | (lambda t: "".join(t)),
+            "const" | a,
+        )
+        for p in pipelines:
+            with self.subTest(p=str(p)):
+                self.assertEqual(compile(p)("_"), p("_"))
+
+        numeric = f + 2 | f * f - 1 | f / 3
+        self.assertEqual(compile(numeric)(3), numeric(3))
+        self.assertEqual(compile(numeric)(3, y=2), numeric(3, y=2))
+
+    def test_multiple_args(self):
+        cmp = a + b
+        compiled = compile(cmp)
+        self.assertEqual(compiled("-", "_"), "-a_b")
+        with self.assertRaises(exceptions.CallError):
+            compiled("_", "_", "_")
+
+        @node
+        def nothing():
+            return "n"
+
+        compiled = compile(nothing & nothing | "".join)
+        self.assertEqual(compiled(), "nn")
+
+    def test_single_calls(self):
+        call_count = 0
+
+        @node
+        def y(x):
+            nonlocal call_count
+            call_count += 1
+            return x + "y"
+
+        cmp = compile(y | y * 2 | y + y | y)
+        self.assertEqual(cmp("_"), "_yy_yyy_yy_yyyy")
+        self.assertEqual(call_count, 5)
+
+    def test_share_subexpressions(self):
+        calls = []
+
+        @node
+        def load(x):
+            calls.append("load")
+            return x + "l"
+
+        @node
+        def parse(x):
+            calls.append("parse")
+            return x + "p"
+
+        @node(impure=True)
+        def now(x):
+            calls.append("now")
+            return x + "n"
+
+        cmp = (load | parse | a) + (load | parse | b) + (load | c)
+        expected = cmp("_")
+        self.assertEqual(calls, ["load", "parse", "load", "parse", "load"])
+
+        calls.clear()
+        self.assertEqual(compile(cmp)("_"), expected)
+        self.assertEqual(calls, ["load", "parse", "load", "parse", "load"])
+
+        calls.clear()
+        shared = compile(cmp, share_subexpressions=True)
+        self.assertEqual(str(shared), str(cmp))
+        self.assertEqual(
+            repr(shared),
+            "CompiledFunction({!r}, share_subexpressions=True)".format(cmp),
+        )
+        self.assertEqual(shared("_"), expected)
+        self.assertEqual(calls, ["load", "parse"])
+
+        # Only calls with the same input are shared
+        calls.clear()
+        cmp = (load | parse) & (parse | load) & (load | load) & load
+        self.assertEqual(compile(cmp, share_subexpressions=True)("_"), cmp("_"))
+        self.assertEqual(calls.count("load"), 8)
+        self.assertEqual(calls.count("parse"), 4)
+
+        # Merges of shared results are shared too
+        calls.clear()
+        cmp = (load + parse | a) & (load + parse | b)
+        self.assertEqual(compile(cmp, share_subexpressions=True)("_"), cmp("_"))
+        self.assertEqual(calls, ["load", "parse", "load", "parse", "load", "parse"])
+
+        calls.clear()
+        cmp = (now | a) + (now | a)
+        self.assertEqual(compile(cmp, share_subexpressions=True)("_"), "_na_na")
+        self.assertEqual(calls, ["now", "now"])
+
+        # Compiled parts of larger pipelines share their subexpressions too
+        calls.clear()
+        cmp = compile(mmap(load + load) | store("x"), share_subexpressions=True)
+        self.assertEqual(cmp(["_", "-"]), ("_l_l", "-l-l"))
+        self.assertEqual(calls, ["load", "load"])
+
+    def test_share_subexpressions_locate_error(self):
+        @node
+        def fail(x):
+            1 / 0
+
+        pipelines = (
+            (a | b | c) + (a | b | fail),
+            (a | b) + (a | fail) + (a | b | fail),
+            a + a + (a | b | c) & (a | b | fail),
+        )
+        for p in pipelines:
+            with self.subTest(p=str(p)):
+                with self.assertRaises(ZeroDivisionError) as expected:
+                    locate_error(p, use_color=False)("_")
+                shared = compile(p, share_subexpressions=True)
+                with self.assertRaises(ZeroDivisionError) as e:
+                    locate_error(shared, use_color=False)("_")
+                self.assertEqual(str(e.exception), str(expected.exception))
+
+    def test_call_state_functions(self):
+        # Parts of the pipeline that use call_state are not compiled, but everything else is.
+        cmp = compile(a | b + c | store("k") | (c | d) + recall("k"))
+        self.assertIsInstance(cmp, FunctionChain)
+        self.assertIsInstance(cmp.functions[1], CompiledFunction)
+        self.assertIsInstance(cmp.functions[3], FunctionMerge)
+        self.assertIsInstance(cmp.functions[3].functions[0], CompiledFunction)
+        self.assertEqual(
+            str(cmp), "(a | (b + c) | store('k') | ((c | d) + recall('k')))"
+        )
+        self.assertEqual(cmp("_"), "_ab_accd_ab_ac")
+
+        state = CallState()
+        cmp("_", call_state=state)
+        self.assertEqual(state.data, {"k": "_ab_ac"})
+
+    def test_map(self):
+        cmp = compile((b & c & "stoke") | mmap(a | d))
+        self.assertEqual(cmp("_"), ("_bad", "_cad", "stokead"))
+
+    @unittest.skipUnless(hasattr(os, "fork"), "Concurent isn't available on windows")
+    def test_concurrent(self):
+        cmp = compile(concurrent((a | b) + (c | d)))
+        self.assertEqual(str(cmp), "concurrent((a | b) + (c | d))")
+        self.assertIsInstance(cmp.functions[0], CompiledFunction)
+        self.assertEqual(cmp("_"), "_ab_cd")
+
+    @unittest.skipUnless(
+        hasattr(os, "fork"), "Parallel mmap isn't available on windows"
+    )
+    def test_parallel_map(self):
+        cmp = compile(mmap(a | d, workers=2))
+        self.addCleanup(cmp.close)
+        self.assertEqual(str(cmp), "mmap((a | d))")
+        self.assertIsInstance(cmp.functions[0], CompiledFunction)
+        self.assertEqual(cmp(["_", "-"]), ("_ad", "-ad"))
+
+    def test_not_compilable(self):
+        self.assertIs(compile(a), a)
+        with self.assertRaises(exceptions.CompositionError):
+            CompiledFunction(a | store("x"))
+
+    def test_wrapped(self):
+        # MetaFunctions that wrap others are rebuilt around their compiled functions
+        cmp = compile(iterative(cached(a | b) & store("x")))
+        self.assertIsInstance(cmp, IterativeFunction)
+        self.assertIsInstance(
+            cmp.functions[0].functions[0].functions[0], CompiledFunction
+        )
+        self.assertEqual(str(cmp), "(cached((a | b)) & store('x'))")
+        self.assertEqual(cmp("_"), ("_ab", "_"))
+
+        compiled = compile(a | b)
+        self.assertIs(compile(compiled), compiled)
+        self.assertIs(compile(compiled & store("x")).functions[0], compiled)
+
+    def test_unknown_subclass(self):
+        # Transformations can't tell what else a subclass does, so they don't guess
+        class Repeat(FunctionChain):
+            def __call__(self, *args, **kwargs):
+                return super().__call__(super().__call__(*args, **kwargs))
+
+        class Wrapped(SimpleFunction):
+            pass
+
+        cmp = Repeat(a + b, store("x"))
+        with self.assertRaises(exceptions.CompositionError):
+            compile(cmp)
+        with self.assertRaises(exceptions.CompositionError):
+            optimize(Repeat(a + b + c))
+        table = {}
+        intern(a + b, table)
+        with self.assertRaises(exceptions.CompositionError):
+            intern(cmp, table)
+        self.assertIs(
+            compile(Wrapped(str.upper) | store("x")).functions[0].__class__, Wrapped
+        )
+
+    def test_locate_error(self):
+        @node
+        def fail(x):
+            1 / 0
+
+        pipelines = (
+            a + b | (c & fail & fail),
+            a | b | fail | c,
+            (a & fail) | c,
+            a | fail + a,
+            a | b + 1,
+            FunctionMerge(operator.add, (a, b, c)) | b,
+            a | (b | c) + (a | b | store("x")) | fail,
+        )
+        for p in pipelines:
+            with self.subTest(p=str(p)):
+                with self.assertRaises(Exception) as expected:
+                    locate_error(p, use_color=False)("_")
+                with self.assertRaises(type(expected.exception)) as e:
+                    locate_error(compile(p), use_color=False)("_")
+                self.assertEqual(str(e.exception), str(expected.exception))
+
+    def test_provided_call_state(self):
+        # Compiled functions register in the call_state they receive, like the original would.
+        cmp = compile(a | b)
+        state = CallState()
+        cmp("_", call_state=state)
+        self.assertIsNone(state.active_node)
+
+        cmp = a | compile(b + c) | store("x")
+        self.assertEqual(cmp("_", call_state=state), "_ab_ac")
+        self.assertEqual(state.data, {"x": "_ab_ac"})
+
+
+class TestOptimize(BaseTestCase):
+    def test_flatten(self):
+        cmp = a + b + c + d
+        optimized = optimize(cmp)
+        self.assertIsInstance(optimized, FunctionMerge)
+        self.assertEqual(optimized.functions, (a, b, c, d))
+        self.assertEqual(optimized._merge_func, operators.fold(operators.add))
+        self.assertEqual(str(optimized), "(((a + b) + c) + d)")
+        self.assertEqual(optimized("_"), cmp("_"))
+
+        @node
+        def f(x):
+            return x * 2
+
+        # Each run of the same operator is flattened
+        pipelines = (
+            (f - 1 - f - 3, 4),
+            (f / 2 / f * 4 * f, 3),
+            (f * 2 + 1 + f - f - 1, 3),
+        )
+        for cmp, length in pipelines:
+            with self.subTest(cmp=str(cmp)):
+                optimized = optimize(cmp)
+                self.assertEqual(str(optimized), str(cmp))
+                self.assertEqual(len(optimized.functions), length)
+                self.assertEqual(optimized(5), cmp(5))
+
+        # Only left nested merges of the same operator are equivalent to a left fold
+        for cmp in (
+            a + (b + c),
+            (a + b) & c,
+            (f - 1) + 2,
+            merge(operators.add, a, b, c),
+        ):
+            with self.subTest(cmp=str(cmp)):
+                self.assertIs(optimize(cmp), cmp)
+
+    def test_multiple_args(self):
+        # Merges that receive several arguments distribute them among their functions
+        for cmp in (a + b + c, a + b + c + d, a + b + c | b + c + d):
+            with self.subTest(cmp=str(cmp)):
+                optimized = optimize(cmp)
+                self.assertEqual(optimized("_", "-"), cmp("_", "-"))
+                self.assertEqual(optimized("_"), cmp("_"))
+                self.assertEqual(compile(optimized)("_", "-"), cmp("_", "-"))
+                with self.assertRaises(exceptions.CallError) as expected:
+                    cmp("_", "-", "+")
+                with self.assertRaises(exceptions.CallError) as e:
+                    optimized("_", "-", "+")
+                self.assertEqual(str(e.exception), str(expected.exception))
+
+        @node
+        def nothing():
+            return "n"
+
+        cmp = nothing + nothing + nothing
+        self.assertEqual(optimize(cmp)(), "nnn")
+
+    def test_constants(self):
+        cmp = a & merge(operators.add, "x", "y") & (1 | chain(2, 3))
+        optimized = optimize(cmp)
+        self.assertEqual(str(optimized), str(cmp))
+        self.assertEqual(str(cmp), "(a & ('x' + 'y') & (1 | 2 | 3))")
+        self.assertIsInstance(optimized.functions[1], DeferredValue)
+        self.assertIsInstance(optimized.functions[2], DeferredValue)
+        self.assertEqual(optimized("_"), ("_a", "xy", 3))
+
+        # Constants that can't be evaluated are left to raise errors when called
+        cmp = a & merge(operators.truediv, 1, 0)
+        optimized = optimize(cmp)
+        self.assertIsInstance(optimized.functions[1], FunctionMerge)
+        with self.assertRaises(ZeroDivisionError) as e:
+            locate_error(optimized, use_color=False)("_")
+        self.assertIn("(a & ->(1 / 0)<-)", str(e.exception))
+
+    def test_single_chains(self):
+        cmp = a + chain(b) | chain(c) & d
+        optimized = optimize(cmp)
+        self.assertEqual(str(optimized), "((a + (b)) | ((c) & d))")
+        self.assertIs(optimized.functions[0].functions[1], b)
+        self.assertIs(optimized.functions[1].functions[0], c)
+        self.assertEqual(optimized("_"), cmp("_"))
+
+        # The pipeline itself keeps its name
+        self.assertEqual(str(optimize(chain(a))), "(a)")
+
+    def test_unchanged(self):
+        for cmp in (a, a | b, a & b & c, a + (b | c)):
+            with self.subTest(cmp=str(cmp)):
+                self.assertIs(optimize(cmp), cmp)
+
+    def test_locate_error(self):
+        @node
+        def fail(x):
+            1 / 0
+
+        pipelines = (
+            a + b + fail,
+            a + fail + b + c,
+            (a | b + c + fail) & d,
+            a | chain(b) + chain(chain(fail)) + c,
+            a + b + c | fail,
+            mmap(a + b + fail) | c,
+            a | (b + c + d) + (a + fail),
+        )
+        for p in pipelines:
+            with self.subTest(p=str(p)):
+                with self.assertRaises(ZeroDivisionError) as expected:
+                    locate_error(p, use_color=False)("_")
+                for optimized in (optimize(p), compile(optimize(p))):
+                    self.assertEqual(str(optimized), str(p))
+                    with self.assertRaises(ZeroDivisionError) as e:
+                        locate_error(optimized, use_color=False)("_")
+                    self.assertEqual(str(e.exception), str(expected.exception))
+
+    def test_nested(self):
+        cmp = a | mmap(b + c + d) | "".join
+        optimized = optimize(cmp)
+        self.assertEqual(len(optimized.functions[1].functions[0].functions), 3)
+        self.assertEqual(optimized("_"), cmp("_"))
+        self.assertEqual(compile(optimized)("_"), cmp("_"))
+
+    def test_wrapped(self):
+        cmp = cached(iterative(mmap(a + b + c) | mmap(d)))
+        optimized = optimize(cmp)
+        self.assertEqual(str(optimized), str(cmp))
+        fused = optimized.functions[0].functions[0].functions[0]
+        self.assertIsInstance(fused, MergeMap)
+        # The fused maps' functions are compiled together, and the merge is folded
+        fused_chain = fused.functions[0].functions[0]
+        self.assertEqual(len(fused_chain.functions[0].functions), 3)
+        self.assertEqual(optimized(("1", "2")), cmp(("1", "2")))
+
+        compiled = optimize(compile(a + b + c))
+        self.assertIsInstance(compiled, CompiledFunction)
+        self.assertEqual(len(compiled.functions[0].functions), 3)
+        self.assertEqual(str(compiled), "((a + b) + c)")
+
+    def test_fuse_maps(self):
+        calls = []
+
+        def recorder(name):
+            @node(name=name)
+            def f(x):
+                calls.append(name)
+                return x + name
+
+            return f
+
+        f, g, h = recorder("f"), recorder("g"), recorder("h")
+        cmp = mmap(f) | mmap(g) | mmap(h)
+        optimized = optimize(cmp)
+        self.assertEqual(str(optimized), "(mmap(f) | mmap(g) | mmap(h))")
+        fused = optimized.functions[0]
+        self.assertEqual(len(optimized.functions), 1)
+        self.assertIsInstance(fused, MergeMap)
+        self.assertIsInstance(fused.functions[0], CompiledFunction)
+        self.assertEqual(fused.functions[0]._meta_function.functions, (f, g, h))
+        # The fused map is named after the maps it replaces, as is the chain it calls
+        self.assertEqual(str(fused), "mmap(f) | mmap(g) | mmap(h)")
+        self.assertEqual(
+            repr(fused),
+            "MergeMap(mmap(f) | mmap(g) | mmap(h), merge_function={})".format(
+                operators.concat
+            ),
+        )
+
+        self.assertEqual(optimized("12"), cmp("12"))
+        calls.clear()
+        self.assertEqual(optimized("12"), ("1fgh", "2fgh"))
+        # One item at a time
+        self.assertEqual(calls, ["f", "g", "h", "f", "g", "h"])
+
+        # Part of a larger chain, with several iterables, and reducing or merging at the end
+        pipelines = (
+            a | mmap(f) | mmap(g) | "".join,
+            mmap(f) | mmap(g, operator.add),
+            a | mmap(f) | mmap(g, reduce=operator.add),
+            (a & b) | mmap(f) | mmap(g & h, columns=True),
+            mmap(f) | "".join | mmap(g) | mmap(h),
+            mmap(f) | mmap(mmap(g) | "".join),
+        )
+        for p in pipelines:
+            with self.subTest(p=str(p)):
+                optimized = optimize(p)
+                self.assertEqual(str(optimized), str(p))
+                self.assertEqual(optimized("12"), p("12"))
+                self.assertEqual(compile(optimized)("12"), p("12"))
+                self.assertLess(len(optimized.functions), len(p.functions))
+
+        cmp = mmap(lambda x, y: x + y) | mmap(f)
+        self.assertEqual(optimize(cmp)("ab", "cd"), ("acf", "bdf"))
+
+        cmp = optimize(mmap(f) | mmap(g, reduce=operator.add))
+        self.assertIsInstance(cmp.functions[0], ReducingMergeMap)
+
+    def test_unfused_maps(self):
+        @node(batched=True)
+        def batched(xs):
+            return [x + "b" for x in xs]
+
+        pipelines = (
+            mmap(a, operator.add) | mmap(b),
+            mmap(a, reduce=operator.add) | mmap(b),
+            mmap(batched) | mmap(b),
+            mmap(a) | mmap(batched),
+            mmap(a | store("x")) | mmap(b),
+            mmap(a) | mmap(b + recall("x")),
+            mmap(a) | imap(b),
+        )
+        for p in pipelines:
+            with self.subTest(p=str(p)):
+                self.assertIs(optimize(p), p)
+
+    def test_impure_maps(self):
+        # Impure functions are called in the order they would be if the maps weren't fused
+        calls = []
+
+        @node(impure=True)
+        def log(x):
+            calls.append(x)
+            return x
+
+        @node
+        def mark(x):
+            calls.append(x + "!")
+            return x
+
+        pipelines = (
+            mmap(log) | mmap(mark),
+            mmap(mark) | mmap(log),
+            mmap(a) | mmap(b | log) | mmap(mark),
+            mmap(a) | mmap(b & log, columns=True),
+        )
+        for p in pipelines:
+            with self.subTest(p=str(p)):
+                calls.clear()
+                expected = p("12")
+                expected_calls = list(calls)
+                optimized = optimize(p)
+                calls.clear()
+                self.assertEqual(optimized("12"), expected)
+                self.assertEqual(calls, expected_calls)
+                self.assertEqual(len(optimized.functions), len(p.functions))
+
+    def test_fused_maps_locate_error(self):
+        @node
+        def fail(x):
+            if x.startswith("2"):
+                1 / 0
+            return x
+
+        pipelines = (
+            mmap(a) | mmap(fail),
+            mmap(fail) | mmap(b) | mmap(c),
+            a | mmap(b | fail) | mmap(c) | d,
+            mmap(a) | mmap(b + fail),
+            (mmap(a) | mmap(b) | mmap(fail)) & c,
+            mmap(a) | mmap(fail, reduce=operator.add),
+        )
+        for p in pipelines:
+            with self.subTest(p=str(p)):
+                with self.assertRaises(ZeroDivisionError) as expected:
+                    locate_error(p, use_color=False)("12")
+                for optimized in (optimize(p), compile(optimize(p))):
+                    with self.assertRaises(ZeroDivisionError) as e:
+                        locate_error(optimized, use_color=False)("12")
+                    self.assertEqual(str(e.exception), str(expected.exception))
@@ -1,4 +1,11 @@
+import os
+import time
+import glob
+import mmap as mmap_module
+import pickle
+import tempfile
 import platform
+import threading
 import operator
 import unittest
 from unittest import mock
@@ -11,11 +18,16 @@ from metafunctions.tests.simple_nodes import *
 from metafunctions.api import node
 from metafunctions.api import bind_call_state
 from metafunctions.api import concurrent
+from metafunctions.api import threaded
 from metafunctions.api import mmap
 from metafunctions.api import store
+from metafunctions.api import recall
+from metafunctions.api import compile
 from metafunctions.api import star
 from metafunctions.api import locate_error
 from metafunctions.core.concurrent import ConcurrentMerge
+from metafunctions.core.concurrent import ThreadedMerge
+from metafunctions.core import concurrent as concurrent_module
 from metafunctions import operators
 from metafunctions.core import CallState
 from metafunctions.exceptions import ConcurrentException, CompositionError, CallError
@@ -201,10 +213,9 @@ class TestIntegration(BaseTestCase):
 
     @mock.patch("metafunctions.core.concurrent.os.fork", return_value=0)
     @mock.patch("metafunctions.core.concurrent.os._exit")
-    @mock.patch("multiprocessing.queues.Queue.close")
-    @mock.patch("multiprocessing.queues.Queue.join_thread")
+    @mock.patch("metafunctions.core.concurrent.os.kill")
     @mock.patch("metafunctions.core.concurrent.os.waitpid")
-    def test_no_fork(self, mock_wait, mock_join, mock_close, mock_exit, mock_fork):
+    def test_no_fork(self, mock_wait, mock_kill, mock_exit, mock_fork):
         # This test re-runs concurrent tests with forking disabled. Partially this is to
         # address my inability to get coverage.py to recognize the code covered by forked
         # processes, but it's also useful to have single process coverage of _process_in_fork to
@@ -228,3 +239,336 @@ class TestIntegration(BaseTestCase):
             str(e.exception),
             "ConcurrentMerge requires os.fork, and thus is only available on unix",
         )
+
+
+@unittest.skipIf(
+    platform.system() == "Windows", "Concurrent isn't supported on windows"
+)
+class TestCollection(BaseTestCase):
+    # These tests rely on real child processes, so they aren't re-run by test_no_fork
+    def test_large_results(self):
+        # Results larger than a pipe's buffer are read while children are still sending them
+        @node
+        def large(x):
+            return x * 1000000
+
+        cmp = concurrent(large & large & large)
+        self.assertEqual(cmp("x"), ("x" * 1000000,) * 3)
+
+    def test_kill_siblings(self):
+        # When one function fails, the others are stopped
+        @node
+        def slow(x):
+            time.sleep(30)
+
+        @node
+        def fail(x):
+            1 / 0
+
+        start = time.monotonic()
+        with self.assertRaises(ConcurrentException) as e:
+            concurrent(slow & fail & slow)("_")
+        self.assertIsInstance(e.exception.__cause__, ZeroDivisionError)
+        self.assertLess(time.monotonic() - start, 10)
+
+        pooled = concurrent(slow & fail & slow, pool_size=3)
+        self.addCleanup(pooled.close)
+        start = time.monotonic()
+        with self.assertRaises(ConcurrentException):
+            pooled("_")
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(len(pooled._pool._workers), 1)
+
+    def test_child_exits(self):
+        @node
+        def exit(x):
+            os._exit(1)
+
+        with self.assertRaises(ConcurrentException):
+            concurrent(a & exit)("_")
+
+
+@unittest.skipIf(
+    platform.system() == "Windows", "Concurrent isn't supported on windows"
+)
+class TestPool(BaseTestCase):
+    def test_basic(self):
+        cmp = concurrent(a + b, pool_size=2)
+        self.addCleanup(cmp.close)
+        self.assertEqual(cmp("_"), "_a_b")
+        self.assertEqual(cmp("-", "_"), "-a_b")
+        self.assertEqual(str(cmp), "concurrent(a + b)")
+
+        cmp = "bnn" | concurrent(mmap(a), pool_size=2) | "".join
+        self.assertEqual(cmp(), "banana")
+
+    def test_workers_reused(self):
+        @node
+        def pid(x):
+            return os.getpid()
+
+        cmp = concurrent(mmap(pid), pool_size=2)
+        self.addCleanup(cmp.close)
+        pids = set(cmp(range(10)))
+        self.assertLessEqual(len(pids), 2)
+        self.assertNotIn(os.getpid(), pids)
+        self.assertEqual(set(cmp(range(10))), pids)
+
+        cmp.close()
+        self.assertEqual(cmp._pool._workers, [])
+        for worker_pid in pids:
+            with self.assertRaises(ProcessLookupError):
+                os.kill(worker_pid, 0)
+
+        # The pool restarts after closing
+        self.assertTrue(pids.isdisjoint(cmp(range(10))))
+
+    def test_max_tasks_per_worker(self):
+        @node
+        def pid(x):
+            return os.getpid()
+
+        cmp = concurrent(mmap(pid), pool_size=1, max_tasks_per_worker=2)
+        self.addCleanup(cmp.close)
+        pids = cmp(range(6))
+        self.assertEqual(len(set(pids)), 3)
+        self.assertEqual(pids[0], pids[1])
+        self.assertEqual(pids[2], pids[3])
+
+        with self.assertRaises(CompositionError):
+            concurrent(a + b, max_tasks_per_worker=2)
+        with self.assertRaises(CompositionError):
+            concurrent(a + b, pool_size=0)
+
+    def test_call_state(self):
+        chain_a = a | b | store("ab")
+        chain_b = recall("start") | a | store("ba")
+        cmp = concurrent(chain_a & chain_b, pool_size=2)
+        self.addCleanup(cmp.close)
+        state = CallState()
+        state.data["start"] = "-"
+
+        self.assertEqual(cmp("_", call_state=state), ("_ab", "-a"))
+        self.assertDictEqual(state.data, {"start": "-", "ab": "_ab", "ba": "-a"})
+
+    def test_exceptions(self):
+        @node
+        def fail(x):
+            if not x:
+                1 / 0
+            return x - 1
+
+        pooled = concurrent(fail - (fail | fail), pool_size=2)
+        self.addCleanup(pooled.close)
+        cmp = locate_error(1 | pooled, use_color=False)
+        with self.assertRaises(ConcurrentException) as e:
+            cmp()
+        self.assertIsInstance(e.exception.__cause__, ZeroDivisionError)
+        self.assertEqual(
+            str(e.exception),
+            "Caught exception in child process \n\nOccured in the following function: "
+            "(1 | concurrent(fail - (fail | ->fail<-)))",
+        )
+
+        # The pool is still usable
+        self.assertEqual(pooled(3), 1)
+
+    def test_unpicklable(self):
+        @node
+        def f(x):
+            return lambda: None
+
+        cmp = concurrent(a & f, pool_size=2)
+        self.addCleanup(cmp.close)
+        with self.assertRaises(ConcurrentException):
+            cmp("_")
+        with self.assertRaises(ConcurrentException):
+            concurrent(mmap(b), pool_size=2)([lambda: None])
+        self.assertEqual(cmp._pool._workers[0].tasks, 1)
+
+    def test_worker_exits(self):
+        @node
+        def exit(x):
+            if x:
+                os._exit(1)
+            return x
+
+        cmp = concurrent(mmap(exit), pool_size=2)
+        self.addCleanup(cmp.close)
+        with self.assertRaises(ConcurrentException):
+            cmp([0, 1, 0])
+        self.assertEqual(cmp([0, 0]), (0, 0))
+
+    def test_compile(self):
+        cmp = compile(concurrent((a | b) + (c | d), pool_size=3))
+        self.addCleanup(cmp.close)
+        self.assertEqual(cmp._pool.size, 3)
+        self.assertEqual(cmp("_"), "_ab_cd")
+
+
+class TestThreaded(BaseTestCase):
+    def test_basic(self):
+        cmp = threaded(a + b)
+        self.assertIsInstance(cmp, ThreadedMerge)
+        self.assertEqual(cmp("_"), "_a_b")
+        self.assertEqual(cmp("-", "_"), "-a_b")
+        with self.assertRaises(CallError):
+            cmp("_", "_", "_")
+        self.assertEqual(str(cmp), "threaded(a + b)")
+        self.assertEqual(str(threaded(mmap(a))), "threaded(mmap(a))")
+
+        cmp = "bnn" | threaded(mmap(a)) | "".join
+        self.assertEqual(cmp(), "banana")
+
+        with self.assertRaises(CompositionError):
+            threaded(a | b)
+
+    def test_parallel(self):
+        # All branches run at once
+        barrier = threading.Barrier(3, timeout=5)
+
+        @node
+        def wait(x):
+            return barrier.wait() >= 0
+
+        cmp = threaded(wait & wait & wait)
+        self.assertEqual(cmp(None), (True, True, True))
+
+    def test_nested(self):
+        # Nested ThreadedMerges can't exhaust the pool
+        with mock.patch.object(ThreadedMerge, "POOL_SIZE", 1), mock.patch.object(
+            ThreadedMerge, "_executor", None
+        ):
+            inner = threaded(mmap(a))
+            cmp = threaded(mmap(mmap(b) | inner))
+            self.assertEqual(cmp([["x", "y"], ["z"]]), (("xba", "yba"), ("zba",)))
+
+    def test_call_state(self):
+        @node
+        @bind_call_state
+        def check_isolated(call_state, x):
+            self.assertNotIn("ab", call_state.data)
+            return x
+
+        chain_a = a | b | store("ab")
+        chain_b = recall("start") | check_isolated | a | store("ba")
+        cmp = threaded(chain_a & chain_b)
+        state = CallState()
+        state.data["start"] = "-"
+
+        self.assertEqual(cmp("_", call_state=state), ("_ab", "-a"))
+        self.assertDictEqual(state.data, {"start": "-", "ab": "_ab", "ba": "-a"})
+
+        # Unlike concurrent, nothing needs to be picklable
+        cmp = threaded((lambda x: lambda: x) & a)
+        self.assertEqual(cmp("_")[0](), "_")
+
+    def test_exceptions(self):
+        @node
+        def fail(x):
+            if not x:
+                1 / 0
+            return x - 1
+
+        cmp = locate_error(1 | threaded(fail & (fail | fail) & fail), use_color=False)
+        with self.assertRaises(ZeroDivisionError) as e:
+            cmp()
+        self.assertEqual(
+            str(e.exception),
+            "division by zero \n\nOccured in the following function: "
+            "(1 | threaded(fail & (fail | ->fail<-) & fail))",
+        )
+
+    def test_compile(self):
+        cmp = compile(threaded((a | b) + (c | d)))
+        self.assertIsInstance(cmp, ThreadedMerge)
+        self.assertEqual(cmp("_"), "_ab_cd")
+
+
+class Blob:
+    """An object that refers to the buffer it's unpickled from, instead of copying it."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def __reduce_ex__(self, protocol):
+        if protocol >= 5:
+            return type(self), (pickle.PickleBuffer(self.data),)
+        return type(self), (bytes(self.data),)
+
+
+@unittest.skipIf(
+    platform.system() == "Windows", "Concurrent isn't supported on windows"
+)
+@unittest.skipIf(pickle.HIGHEST_PROTOCOL < 5, "Requires pickle protocol 5")
+class TestSharedMemory(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(ConcurrentMerge, "SHARED_MEMORY_THRESHOLD", 1000)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def shared_files(self):
+        return set(
+            glob.glob(
+                os.path.join(
+                    concurrent_module._SHARED_MEMORY_DIR or tempfile.gettempdir(),
+                    "metafunctions-*",
+                )
+            )
+        )
+
+    def test_large_results(self):
+        @node
+        def large(x):
+            return bytearray(x.encode() * 2000)
+
+        @node
+        def blob(x):
+            return Blob(bytearray(x.encode() * 2000))
+
+        before = self.shared_files()
+        for kwargs in ({}, {"pool_size": 2}):
+            with self.subTest(**kwargs):
+                cmp = concurrent(large & blob & a, **kwargs)
+                self.addCleanup(cmp.close)
+                with mock.patch(
+                    "metafunctions.core.concurrent.mmap.mmap", wraps=mmap_module.mmap
+                ) as mapped:
+                    big, b, small = cmp("_")
+                # Both large results were sent through shared memory
+                self.assertEqual(mapped.call_count, 2)
+                self.assertEqual(big, bytearray(b"_" * 2000))
+                self.assertEqual(small, "_a")
+
+                # Blob was unpickled straight from shared memory
+                self.assertIsInstance(b.data, memoryview)
+                self.assertIsInstance(b.data.obj, mmap_module.mmap)
+                self.assertEqual(bytes(b.data), b"_" * 2000)
+        self.assertEqual(self.shared_files(), before)
+
+    def test_small_results(self):
+        @node
+        def blob(x):
+            return Blob(bytearray(x))
+
+        cmp = concurrent(blob & blob)
+        with mock.patch("metafunctions.core.concurrent.tempfile.mkstemp") as mkstemp:
+            results = cmp(b"small")
+        mkstemp.assert_not_called()
+        self.assertEqual([bytes(r.data) for r in results], [b"small", b"small"])
+
+    def test_cleanup(self):
+        # Shared memory is released, even if we don't load the result
+        @node
+        def large(x):
+            return bytearray(5000)
+
+        @node
+        def fail(x):
+            1 / 0
+
+        before = self.shared_files()
+        with self.assertRaises(ConcurrentException):
+            concurrent(fail & large & large)("_")
+        self.assertEqual(self.shared_files(), before)
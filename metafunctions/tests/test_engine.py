@@ -0,0 +1,132 @@
+from metafunctions.tests.util import BaseTestCase
+from metafunctions.tests.simple_nodes import *
+from metafunctions.api import node
+from metafunctions.api import iterative
+from metafunctions.api import locate_error
+from metafunctions.api import store
+from metafunctions.api import recall
+from metafunctions.api import mmap
+from metafunctions.api import compile
+from metafunctions.api import optimize
+from metafunctions.api import merge
+from metafunctions.core import CallState
+from metafunctions.engine import IterativeFunction
+from metafunctions import exceptions
+
+DEPTH = 20000
+
+
+@node
+def fail(x):
+    if x.startswith("_"):
+        1 / 0
+    return x
+
+
+@node
+def kw(*args, suffix="s"):
+    return "".join(args) + suffix
+
+
+class TestUnit(BaseTestCase):
+    def test_basic(self):
+        cmp = a | b + c
+        it = iterative(cmp)
+        self.assertIsInstance(it, IterativeFunction)
+        self.assertEqual(str(it), str(cmp))
+        self.assertEqual(repr(it), "IterativeFunction({!r})".format(cmp))
+        self.assertEqual(it("_"), "_ab_ac")
+
+    def test_same_results(self):
+        for cmp in (
+            a,
+            a | b | c,
+            a + b + "1",
+            a & b & c,
+            (a | (b + c)) + (d | e + "x"),
+            a + "1" | mmap(b) | "".join,
+            compile(a | b + c),
+            optimize(a + b + c + d),
+            merge(lambda *x: "".join(x), a, b, c),
+        ):
+            with self.subTest(cmp=str(cmp)):
+                self.assertEqual(iterative(cmp)("_"), cmp("_"))
+
+    def test_args(self):
+        # Merges distribute their arguments as usual, including when they have too many
+        cmp = kw & kw + kw
+        self.assertEqual(iterative(a & b & c)("1", "2", "3"), ("1a", "2b", "3c"))
+        self.assertEqual(iterative(cmp)("_", suffix="!"), cmp("_", suffix="!"))
+        self.assertEqual(iterative(a + b)("1", "2"), "1a2b")
+        with self.assertRaises(exceptions.CallError):
+            iterative(a + b)("1", "2", "3")
+
+    def test_call_state(self):
+        cmp = iterative(a | store("x") | b + recall("x"))
+        self.assertEqual(cmp("_"), "_ab_a")
+
+        state = CallState()
+        self.assertEqual(cmp("_", call_state=state), "_ab_a")
+        self.assertEqual(state.data, {"x": "_a"})
+        self.assertEqual(state._depth, 0)
+
+    def test_deep(self):
+        cmp = a
+        for i in range(DEPTH):
+            cmp = cmp + b if i % 2 else cmp | c
+        with self.assertRaises(RecursionError):
+            cmp("_")
+
+        expected = "_a" + "c_b" * (DEPTH // 2)
+        self.assertEqual(iterative(cmp)("_"), expected)
+
+        tracked = iterative(cmp | store("x") | recall("x"))
+        self.assertEqual(tracked("_"), expected)
+        # Calls don't need our name
+        self.assertIsNone(cmp._rendering)
+
+    def test_deep_name(self):
+        cmp = a
+        for i in range(DEPTH):
+            cmp = cmp + b if i % 2 else cmp | c
+        # Rendering doesn't recurse either, and each function's rendering refers to the names of
+        # its functions rather than copying them
+        name = str(cmp)
+        self.assertTrue(name.startswith("(" * (DEPTH // 2)))
+        self.assertEqual(len(name), cmp._rendering.length)
+        copied = sum(
+            len(part)
+            for f in cmp._bottom_up()
+            for part in f._rendering.parts
+            if isinstance(part, str)
+        )
+        self.assertLess(copied, 10 * DEPTH)
+
+    def test_locate_error(self):
+        for cmp in (
+            a | (b + (c | fail)) + a,
+            a | store("k") | (b & (c | fail)),
+            (a | b) + fail,
+            a & (b | fail) & c,
+            compile(a | fail),
+        ):
+            with self.subTest(cmp=str(cmp)):
+                with self.assertRaises(ZeroDivisionError) as expected:
+                    locate_error(cmp, use_color=False)("_")
+                with self.assertRaises(ZeroDivisionError) as e:
+                    locate_error(iterative(cmp), use_color=False)("_")
+                self.assertEqual(str(e.exception), str(expected.exception))
+
+        # Errors raised by merge functions are located too
+        cmp = (a & b) + 1
+        with self.assertRaises(TypeError) as e:
+            locate_error(iterative(cmp), use_color=False)("_")
+        self.assertIn("->((a & b) + 1)<-", str(e.exception))
+
+    def test_locate_error_deep(self):
+        cmp = a | fail
+        for _ in range(DEPTH):
+            cmp = b + cmp
+        with self.assertRaises(ZeroDivisionError) as e:
+            locate_error(iterative(cmp), use_color=False)("_")
+        self.assertIn("(b + (a | ->fail<-))" + ")" * (DEPTH - 1), str(e.exception))
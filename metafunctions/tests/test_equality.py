@@ -0,0 +1,220 @@
+import os
+import gc
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from metafunctions.tests.util import BaseTestCase
+from metafunctions.tests.simple_nodes import *
+from metafunctions.api import node
+from metafunctions.api import intern
+from metafunctions.api import mmap
+from metafunctions.api import imap
+from metafunctions.api import cached
+from metafunctions.api import concurrent
+from metafunctions.api import threaded
+from metafunctions.api import compile
+from metafunctions.api import optimize
+from metafunctions.api import iterative
+from metafunctions.api import merge
+from metafunctions.api import locate_error
+from metafunctions.api import chain
+from metafunctions.api import store
+from metafunctions.api import recall
+from metafunctions.api import star
+from metafunctions.core import SimpleFunction
+from metafunctions.core import DeferredValue
+from metafunctions.core import CallState
+from metafunctions import compiler
+from metafunctions import operators
+
+
+def f(x):
+    return x + "f"
+
+
+class TestUnit(BaseTestCase):
+    def test_equal(self):
+        builders = [
+            lambda: a | b,
+            lambda: a + b | c & d,
+            lambda: a - 1 | "x",
+            lambda: (a & b) / [1, 2],
+            lambda: node(f) | f,
+            lambda: merge(operators.merge_sum, a, b, c),
+            lambda: mmap(a) | mmap(b, reduce=operators.add, initial=[]),
+            lambda: mmap(a, columns="ii") | imap(b),
+            lambda: threaded(a & b),
+            lambda: cached(a | b, maxsize=3),
+            lambda: compile(a | b + c),
+            lambda: optimize(a + b + c),
+            lambda: iterative(a | b),
+            lambda: a | store("k") | b + recall("k"),
+            lambda: star(a & b) | c,
+            lambda: locate_error(a | b, use_color=False),
+        ]
+        if hasattr(os, "fork"):
+            builders.append(lambda: concurrent(a + b) | mmap(a, workers=2))
+        for build in builders:
+            first = build()
+            second = build()
+            with self.subTest(cmp=str(first)):
+                self.assertIsNot(first, second)
+                self.assertEqual(first, second)
+                self.assertEqual(hash(first), hash(second))
+                self.assertEqual(len({first, second}), 1)
+                for other in builders:
+                    if other is not build:
+                        self.assertNotEqual(first, other())
+
+    def test_not_equal(self):
+        # Anything that changes behaviour or name makes a difference
+        pairs = [
+            (a | b, b | a),
+            (a | b, a | b | c),
+            (a + b, a - b),
+            (a + b, merge(operators.add, a, b, function_join_str="plus")),
+            (a + 1, a + 1.0),
+            (a + 1, a + True),
+            (a & [1], a & [2]),
+            (node(f), node(f, name="g")),
+            (node(f), node(batched=True)(f)),
+            (node(f), node(impure=True)(f)),
+            (mmap(a), mmap(a, reduce=operators.add)),
+            (mmap(a, reduce=operators.add), mmap(a, reduce=operators.add, initial="")),
+            (mmap(a), imap(a)),
+            (threaded(a + b), a + b),
+            (cached(a), cached(a, maxsize=1)),
+            (compile(a | b), compile(a | b, share_subexpressions=True)),
+            (compile(a | b), a | b),
+            (iterative(a | b), a | b),
+            (store("k"), store("j")),
+            (store("k"), recall("k")),
+            (recall("k"), recall("k", from_call_state=CallState())),
+            (star(a), star(b)),
+            (locate_error(a, use_color=False), locate_error(a, use_color=True)),
+            (locate_error(a, use_color=False), locate_error(b, use_color=False)),
+        ]
+        for first, second in pairs:
+            with self.subTest(first=str(first), second=str(second)):
+                self.assertNotEqual(first, second)
+                self.assertNotEqual(second, first)
+
+        self.assertNotEqual(a, f)
+        self.assertNotEqual(a | b, "(a | b)")
+        self.assertEqual(DeferredValue(1), DeferredValue(1))
+        self.assertNotEqual(SimpleFunction(f), DeferredValue(f))
+
+    @unittest.skipIf(numpy is None, "numpy isn't installed")
+    def test_unhashable_values(self):
+        array = numpy.arange(3)
+        self.assertEqual(a & array, a & array)
+        self.assertNotEqual(a & array, a & numpy.arange(3))
+        self.assertEqual(hash(a & array), hash(a & numpy.arange(3)))
+
+    def test_deep(self):
+        first = second = a
+        for _ in range(5000):
+            first = first + b | c
+            second = second + b | c
+        self.assertEqual(first, second)
+        self.assertEqual(hash(first), hash(second))
+        self.assertNotEqual(first, second | d)
+
+        # Shared parts are compared once
+        for _ in range(100):
+            first = first + first
+            second = second + second
+        self.assertEqual(first, second)
+
+    def test_intern(self):
+        table = {}
+        first = intern(a | b + c, table)
+        second = intern(d + (a | b + c), table)
+        self.assertIs(second.functions[1], first)
+        self.assertIs(intern(a | b + c, table), first)
+        self.assertIs(intern(first, table), first)
+        self.assertEqual(len(table), 7)
+
+        # Separately built parts are replaced by interned ones
+        cmp = intern(node(f) + node(f), table)
+        self.assertIs(cmp.functions[0], cmp.functions[1])
+        self.assertEqual(cmp("_"), "_f_f")
+
+        # Interning doesn't change names or behaviour
+        for build in (
+            lambda: (a & b) | mmap(c + "x") | "".join,
+            lambda: optimize(a + b + c + d),
+            lambda: compile(a | b) + (a | b),
+            lambda: threaded(a & b & (a | b)),
+            lambda: optimize(mmap(node(f)) | mmap(node(f)) | "".join),
+            lambda: threaded(optimize(a & b & chain(c))),
+        ):
+            original = build()
+            interned = intern(build(), table)
+            with self.subTest(cmp=str(original)):
+                self.assertEqual(interned, original)
+                self.assertEqual(str(interned), str(original))
+                self.assertEqual(interned("_"), original("_"))
+                self.assertIs(intern(build(), table), interned)
+
+    def test_intern_renamed(self):
+        # Optimized functions keep the names of the functions they replace, so they aren't equal to
+        # functions that are otherwise the same, but have other names
+        table = {}
+        plain = intern(a + b, table)
+        optimized = optimize(a + chain(b))
+        self.assertEqual(str(optimized), "(a + (b))")
+        self.assertNotEqual(optimized, plain)
+        self.assertEqual(optimized, optimize(a + chain(b)))
+        self.assertEqual(str(intern(optimized, table)), "(a + (b))")
+
+        compiled = intern(mmap(compile(a | b)), table)
+        fused = intern(optimize(mmap(a) | mmap(b)), table)
+        self.assertIsNot(fused.functions[0], compiled)
+        self.assertEqual(str(fused), "(mmap(a) | mmap(b))")
+        with self.assertRaises(TypeError) as e:
+            locate_error(fused, use_color=False)([1])
+        self.assertIn("(mmap(->a<-) | mmap(b))", str(e.exception))
+
+    def test_intern_call_state_functions(self):
+        # Functions built by store, recall, star and locate_error are shared too
+        table = {}
+
+        def build():
+            cmp = star(a & b) | store("k") | recall("k")
+            return locate_error(cmp, use_color=False)
+
+        first = intern(build(), table)
+        self.assertIs(intern(build(), table), first)
+        cmp = intern(a | store("k") | c + recall("k"), table)
+        self.assertIs(intern(b | store("k"), table).functions[1], cmp.functions[1])
+        self.assertEqual(cmp("_"), "_ac_a")
+        self.assertEqual(first(("1", "2")), ("1a", "2b"))
+
+    def test_intern_default_table(self):
+        first = intern(a + b | c)
+        self.assertIs(intern(a + b | c), first)
+        self.assertIs(intern(a + b).functions[0], a)
+
+        # The default table doesn't keep its functions alive
+        count = len(compiler._INTERNED)
+        intern(e | e | e)
+        gc.collect()
+        self.assertLessEqual(len(compiler._INTERNED), count + 1)
+
+    def test_intern_locate_error(self):
+        @node
+        def fail(x):
+            1 / 0
+
+        table = {}
+        shared = intern(a | fail, table)
+        cmp = intern((a | fail) + (b + (a | fail)), table)
+        self.assertIs(cmp.functions[1].functions[1], shared)
+        with self.assertRaises(ZeroDivisionError) as e:
+            locate_error(cmp, use_color=False)("_")
+        self.assertIn("((a | ->fail<-) + (b + (a | fail)))", str(e.exception))
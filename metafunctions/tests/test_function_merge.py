@@ -5,8 +5,11 @@ from metafunctions.core import FunctionMerge
 from metafunctions.core import SimpleFunction
 from metafunctions.tests.util import BaseTestCase
 from metafunctions.operators import concat
+from metafunctions.operators import merge_sum
+from metafunctions.operators import merge_prod
+from metafunctions.operators import fold
 from metafunctions import exceptions
-from metafunctions.api import node, star
+from metafunctions.api import node, star, merge
 
 
 class TestUnit(BaseTestCase):
@@ -66,6 +69,22 @@ class TestUnit(BaseTestCase):
         abc = (a & (b & c)) | "".join
         self.assertEqual(abc("_"), "_a_b_c")
 
+    def test_fold(self):
+        cmp = FunctionMerge(merge_sum, (a, b, c))
+        self.assertEqual(str(cmp), "(a + b + c)")
+        self.assertEqual(cmp("_"), "_a_b_c")
+        self.assertEqual(cmp("-", "_", "+"), "-a_b+c")
+
+        @node
+        def n(x):
+            return x + 1
+
+        self.assertEqual(str(FunctionMerge(merge_prod, (n, n, n))), "(n * n * n)")
+        self.assertEqual(FunctionMerge(merge_prod, (n, n, n))(1), 8)
+        cmp = merge(fold(operator.sub), n, 1, n)
+        self.assertEqual(str(cmp), "(n - 1 - n)")
+        self.assertEqual(cmp(1), -1)
+
     def test_combine(self):
         # Only combine FunctionMerges that have the same MergeFunc
         add = a + b
@@ -11,8 +11,18 @@ class TestUnit(unittest.TestCase):
             "store",
             "recall",
             "concurrent",
+            "threaded",
             "mmap",
+            "imap",
+            "cached",
+            "disk_cached",
             "locate_error",
+            "compile",
+            "optimize",
+            "iterative",
+            "intern",
+            "chain",
+            "merge",
         ]
         random.shuffle(expected_names)
         for name in expected_names:
@@ -1,10 +1,36 @@
+import os
+import sys
+import array
+import unittest
+import itertools
+import operator
+from unittest import mock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from metafunctions.tests.util import BaseTestCase
 from metafunctions.tests.simple_nodes import *
 from metafunctions.api import node
 from metafunctions.api import star
 from metafunctions.api import mmap
+from metafunctions.api import imap
+from metafunctions.api import store
+from metafunctions.api import recall
+from metafunctions.api import locate_error
+from metafunctions.api import concurrent
+from metafunctions.api import threaded
+from metafunctions.api import compile
 from metafunctions.map import MergeMap
+from metafunctions.map import ParallelMergeMap
+from metafunctions.map import LazyMergeMap
+from metafunctions.map import ReducingMergeMap
+from metafunctions.map import ArrayMergeMap
+from metafunctions.map import ColumnarMergeMap
 from metafunctions import operators
+from metafunctions import exceptions
 
 
 class TestIntegration(BaseTestCase):
@@ -56,3 +82,474 @@ class TestIntegration(BaseTestCase):
     def test_loop_with_non_meta(self):
         cmp = (b & c & "stoke") | mmap(len)
         self.assertEqual(cmp("_"), (2, 2, 5))
+
+    def test_iterators(self):
+        m = mmap(a)
+        self.assertEqual(m(iter("xyz")), ("xa", "ya", "za"))
+        self.assertEqual(mmap(operators.add)(iter([1, 2]), itertools.count()), (1, 3))
+
+    def test_reduce(self):
+        m = mmap(a, reduce=operator.add)
+        self.assertIsInstance(m, ReducingMergeMap)
+        self.assertEqual(m("bnn"), "banana")
+        self.assertEqual(str(m), "mmap(a)")
+        self.assertEqual(repr(m), "ReducingMergeMap(a, reduce={})".format(operator.add))
+
+        m = mmap(float, reduce=operator.add, initial=1)
+        self.assertEqual(m(range(5)), 11.0)
+        self.assertEqual(m([]), 1)
+        self.assertEqual(
+            repr(m),
+            "ReducingMergeMap(float, reduce={}, initial=1)".format(operator.add),
+        )
+        with self.assertRaises(TypeError):
+            mmap(a, reduce=operator.add)([])
+
+        # Results are folded as they're produced
+        results = []
+
+        @node
+        def f(x):
+            self.assertEqual(len(results), x)
+            return [x]
+
+        @node
+        def fold(acc, x):
+            results.extend(x)
+            return None
+
+        mmap(f, reduce=fold, initial=None)(range(5))
+        self.assertEqual(results, [0, 1, 2, 3, 4])
+
+    def test_reduce_locate_error(self):
+        @node
+        def fail(x):
+            if x == 3:
+                1 / 0
+            return x
+
+        for tracked in (fail, fail | store("x")):
+            with self.subTest(tracked=str(tracked)):
+                cmp = locate_error(mmap(tracked, reduce=operator.add), use_color=False)
+                with self.assertRaises(ZeroDivisionError) as e:
+                    cmp(range(5))
+                self.assertIn("->fail<-", str(e.exception))
+
+    def test_composition_errors(self):
+        with self.assertRaises(exceptions.CompositionError):
+            mmap(a, operators.add, reduce=operator.add)
+        with self.assertRaises(exceptions.CompositionError):
+            mmap(a, initial=0)
+
+        # Upgrading would merge the results, rather than fold them
+        total = mmap(lambda x: x * x, reduce=operator.add, initial=0)
+        with self.assertRaises(exceptions.CompositionError):
+            threaded(total)
+        if hasattr(os, "fork"):
+            with self.assertRaises(exceptions.CompositionError):
+                concurrent(total)
+
+
+class TestLazy(BaseTestCase):
+    def test_basic(self):
+        m = imap(a)
+        self.assertIsInstance(m, LazyMergeMap)
+        self.assertEqual(list(m("bnn")), ["ba", "na", "na"])
+        self.assertEqual(str(m), "imap(a)")
+        self.assertEqual(repr(m), "LazyMergeMap(a)")
+
+        # Multiple iterables are zipped, as with mmap
+        m = imap(operators.add)
+        self.assertEqual(list(m([1, 2, 3], itertools.count(10))), [11, 13, 15])
+
+    def test_lazy(self):
+        calls = []
+
+        @node
+        def double(x):
+            calls.append(x)
+            return x * 2
+
+        cmp = imap(double) | imap(double) | (lambda results: next(iter(results)))
+        self.assertEqual(cmp(itertools.count(1)), 4)
+        self.assertEqual(calls, [1, 2])
+
+    def test_call_state(self):
+        cmp = imap(store("x")) | list | recall("x")
+        self.assertEqual(cmp([1, 2, 3]), 3)
+
+    def test_upgrade(self):
+        # Upgrading would compute every result up front
+        with self.assertRaises(exceptions.CompositionError):
+            threaded(imap(a))
+        if hasattr(os, "fork"):
+            with self.assertRaises(exceptions.CompositionError):
+                concurrent(imap(a))
+
+    def test_locate_error(self):
+        @node
+        def fail(x):
+            if x == 3:
+                1 / 0
+            return x
+
+        # The error happens while `list` consumes our results, but it's located within us
+        cmp = locate_error(imap(fail) | list, use_color=False)
+        with self.assertRaises(ZeroDivisionError) as e:
+            cmp(range(5))
+        self.assertEqual(
+            str(e.exception),
+            "division by zero \n\nOccured in the following function: (imap(->fail<-) | list)",
+        )
+
+
+class TestBatched(BaseTestCase):
+    def setUp(self):
+        self.batches = []
+
+        @node(batched=True)
+        def square(xs):
+            self.batches.append(xs)
+            return [x * x for x in xs]
+
+        self.square = square
+
+    def test_basic(self):
+        m = mmap(self.square, batch_size=4)
+        self.assertEqual(m(range(10)), tuple(x * x for x in range(10)))
+        # Sequences are sliced
+        self.assertEqual(self.batches, [range(0, 4), range(4, 8), range(8, 10)])
+        self.assertEqual(
+            repr(m),
+            "MergeMap(square, merge_function={}, batch_size=4)".format(
+                operators.concat
+            ),
+        )
+
+        self.batches.clear()
+        self.assertEqual(m(iter([1, 2, 3, 4, 5])), (1, 4, 9, 16, 25))
+        self.assertEqual(self.batches, [[1, 2, 3, 4], [5]])
+
+        self.batches.clear()
+        self.assertEqual(
+            mmap(self.square)(range(2000)), tuple(x * x for x in range(2000))
+        )
+        self.assertEqual(len(self.batches), 2)
+
+    def test_multi_arg(self):
+        @node(batched=True)
+        def add(xs, ys):
+            return [x + y for x, y in zip(xs, ys)]
+
+        m = mmap(add, batch_size=2)
+        self.assertEqual(m([1, 2, 3], [10, 20, 30, 40]), (11, 22, 33))
+        self.assertEqual(m(iter([1, 2, 3]), itertools.count(10)), (11, 13, 15))
+
+    def test_reduce_and_lazy(self):
+        m = mmap(self.square, reduce=operator.add, initial=0, batch_size=3)
+        self.assertEqual(m(range(5)), 30)
+        self.assertEqual(self.batches, [range(0, 3), range(3, 5)])
+
+        self.batches.clear()
+        results = imap(self.square, batch_size=3)(itertools.count())
+        self.assertEqual(list(itertools.islice(results, 4)), [0, 1, 4, 9])
+        self.assertEqual(self.batches, [[0, 1, 2], [3, 4, 5]])
+
+    def test_chains(self):
+        # A chain of batched functions is batched
+        m = mmap(self.square | self.square, batch_size=2)
+        self.assertEqual(m([1, 2, 3]), (1, 16, 81))
+        self.assertEqual(self.batches, [[1, 2], [1, 4], [3], [9]])
+        self.assertEqual(compile(m)([1, 2, 3]), (1, 16, 81))
+        self.assertEqual(mmap(mmap(self.square) | sum)([[1, 2], [3]]), (5, 9))
+
+        # Batched functions that would receive one item at a time can't be mapped
+        for function in (
+            a | self.square,
+            self.square | a,
+            self.square + 1,
+            (self.square & self.square) | a,
+            compile(self.square + self.square),
+        ):
+            with self.subTest(function=str(function)):
+                with self.assertRaises(exceptions.CompositionError):
+                    mmap(function)
+                with self.assertRaises(exceptions.CompositionError):
+                    imap(function)
+
+    def test_wrong_length(self):
+        @node(batched=True)
+        def bad(xs):
+            return xs[:1]
+
+        with self.assertRaises(exceptions.CallError):
+            mmap(bad)([1, 2])
+
+    def test_composition_errors(self):
+        with self.assertRaises(exceptions.CompositionError):
+            mmap(a, batch_size=10)
+        with self.assertRaises(exceptions.CompositionError):
+            mmap(self.square, batch_size=0)
+        with self.assertRaises(exceptions.CompositionError):
+            threaded(mmap(self.square))
+
+    @unittest.skipUnless(hasattr(os, "fork"), "Concurrent isn't available on windows")
+    def test_concurrent(self):
+        with self.assertRaises(exceptions.CompositionError):
+            concurrent(mmap(self.square))
+
+        m = mmap(self.square, workers=2, chunksize=5, batch_size=2)
+        self.addCleanup(m.close)
+        self.assertEqual(m(range(10)), tuple(x * x for x in range(10)))
+
+
+class TestColumnar(BaseTestCase):
+    def test_lists(self):
+        m = mmap(a & b & len, columns=True)
+        self.assertIsInstance(m, ColumnarMergeMap)
+        self.assertEqual(str(m), "mmap((a & b & len))")
+        self.assertEqual(m(["x", "yy"]), (["xa", "yya"], ["xb", "yyb"], [1, 2]))
+        self.assertEqual(m(iter(["x"])), (["xa"], ["xb"], [1]))
+        self.assertEqual(m([]), ())
+
+    def test_typecodes(self):
+        m = mmap(lambda x: (x, x / 2), columns="qd")
+        ids, halves = m(range(4))
+        self.assertEqual(ids, array.array("q", [0, 1, 2, 3]))
+        self.assertEqual(halves, array.array("d", [0, 0.5, 1, 1.5]))
+        self.assertEqual(m([]), (array.array("q"), array.array("d")))
+        self.assertEqual(
+            repr(m),
+            "ColumnarMergeMap(<lambda>, merge_function={}, typecodes='qd')".format(
+                operators.concat
+            ),
+        )
+
+        with self.assertRaises(exceptions.CompositionError):
+            mmap(a, columns="qz")
+
+    def test_merge(self):
+        # Columns are passed to the merge function directly
+        m = mmap(lambda x: (x, x * 2), lambda xs, ys: sum(xs) + sum(ys), columns=True)
+        self.assertEqual(m([1, 2, 3]), 18)
+
+    def test_wrong_length(self):
+        m = mmap(lambda x: (x,) * x, columns=True)
+        with self.assertRaises(exceptions.CallError):
+            m([1, 2])
+        with self.assertRaises(exceptions.CallError):
+            mmap(lambda x: (x,), columns="qq")([1])
+
+    def test_composition_errors(self):
+        with self.assertRaises(exceptions.CompositionError):
+            mmap(a & b, columns=True, reduce=operator.add)
+        with self.assertRaises(exceptions.CompositionError):
+            mmap(a & b, columns=True, workers=2)
+
+        # Upgrading would merge the records, rather than collect them into columns
+        with self.assertRaises(exceptions.CompositionError):
+            threaded(mmap(a & b, columns=True))
+        if hasattr(os, "fork"):
+            with self.assertRaises(exceptions.CompositionError):
+                concurrent(mmap(a & b, columns="uu"))
+
+
+class TestArray(BaseTestCase):
+    @mock.patch.dict(sys.modules, {"numpy": None})
+    def test_requires_numpy(self):
+        with self.assertRaises(exceptions.CompositionError):
+            mmap(a, dtype=float)
+        # Other maps don't
+        self.assertEqual(mmap(a)("b"), ("ba",))
+
+    @unittest.skipIf(numpy is None, "numpy isn't installed")
+    def test_dtype(self):
+        m = mmap(lambda x: x * 2, dtype=numpy.int32)
+        self.assertIsInstance(m, ArrayMergeMap)
+        self.assertEqual(str(m), "mmap(<lambda>)")
+        for values in (range(5), iter(range(5)), numpy.arange(5)):
+            with self.subTest(values=values):
+                result = m(values)
+                self.assertIsInstance(result, numpy.ndarray)
+                self.assertEqual(result.dtype, numpy.int32)
+                self.assertEqual(result.tolist(), [0, 2, 4, 6, 8])
+        self.assertEqual(m([]).tolist(), [])
+
+        # Without a dtype, numpy chooses one that fits every result
+        self.assertEqual(mmap(float, vectorized=True)(iter([1, 2])).dtype, float)
+        half = mmap(lambda x: x / 2 if x > 1 else 1, vectorized=True)
+        for values in ([1, 3, 5], iter([1, 3, 5])):
+            with self.subTest(values=values):
+                self.assertEqual(half(values).tolist(), [1, 1.5, 2.5])
+        strings = mmap(lambda x: x * "ab", vectorized=True)
+        self.assertEqual(strings([1, 3]).tolist(), ["ab", "ababab"])
+        self.assertEqual(
+            mmap(lambda x: x if x else 0.5, vectorized=True)(range(3)).tolist(),
+            [0.5, 1, 2],
+        )
+
+        rows = mmap(lambda x: (x, -x), dtype=float)
+        for values in (range(3), iter(range(3))):
+            with self.subTest(values=values):
+                self.assertEqual(rows(values).tolist(), [[0, 0], [1, -1], [2, -2]])
+
+    @unittest.skipIf(numpy is None, "numpy isn't installed")
+    def test_vectorized(self):
+        calls = []
+
+        @node
+        def double(x):
+            calls.append(x)
+            return x * 2
+
+        m = mmap(double + 1, vectorized=True)
+        self.assertEqual(m(numpy.arange(4)).tolist(), [1, 3, 5, 7])
+        self.assertEqual(len(calls), 1)
+
+        # Anything that supports the buffer protocol is an array
+        self.assertEqual(m(array.array("d", [1, 2])).tolist(), [3.0, 5.0])
+        self.assertEqual(m(b"\x01\x02").tolist(), [3, 5])
+
+        # Other iterables are mapped an item at a time
+        calls.clear()
+        self.assertEqual(m([1, 2, 3]).tolist(), [3, 5, 7])
+        self.assertEqual(calls, [1, 2, 3])
+
+        calls.clear()
+        m = mmap(double, vectorized=True, batch_size=3, dtype=float)
+        result = m(numpy.arange(7))
+        self.assertEqual(result.dtype, float)
+        self.assertEqual(result.tolist(), [0, 2, 4, 6, 8, 10, 12])
+        self.assertEqual([len(c) for c in calls], [3, 3, 1])
+
+        # Later batches can widen the dtype
+        widen = mmap(lambda x: x if x[0] < 3 else x / 2, vectorized=True, batch_size=3)
+        result = widen(numpy.arange(5))
+        self.assertEqual(result.tolist(), [0, 1, 2, 1.5, 2])
+
+        add = mmap(numpy.add, vectorized=True)
+        self.assertEqual(add(numpy.arange(3), numpy.arange(4)).tolist(), [0, 2, 4])
+        self.assertEqual(add(numpy.arange(0), numpy.arange(0)).tolist(), [])
+
+        with self.assertRaises(exceptions.CallError):
+            mmap(numpy.sum, vectorized=True)(numpy.arange(3))
+
+    @unittest.skipIf(numpy is None, "numpy isn't installed")
+    def test_batched(self):
+        @node(batched=True)
+        def double(xs):
+            return xs * 2
+
+        self.assertEqual(
+            mmap(double, dtype=float, batch_size=2)(numpy.arange(5)).tolist(),
+            [0, 2, 4, 6, 8],
+        )
+
+    @unittest.skipIf(numpy is None, "numpy isn't installed")
+    def test_composition(self):
+        cmp = compile(mmap(node(numpy.sqrt) | numpy.negative, vectorized=True))
+        self.assertEqual(cmp(numpy.array([1.0, 4.0])).tolist(), [-1.0, -2.0])
+
+        with self.assertRaises(exceptions.CompositionError):
+            mmap(a, dtype=float, reduce=operator.add)
+        with self.assertRaises(exceptions.CompositionError):
+            mmap(a, dtype=float, workers=2)
+
+
+@unittest.skipUnless(hasattr(os, "fork"), "Parallel mmap isn't available on windows")
+class TestParallel(BaseTestCase):
+    def parallel(self, *args, **kwargs):
+        m = mmap(*args, **kwargs)
+        self.addCleanup(m.close)
+        return m
+
+    def test_basic(self):
+        @node
+        def square(x):
+            return x * x
+
+        expected = mmap(square)(range(100))
+        for chunksize in (None, 1, 7, 100, 1000):
+            with self.subTest(chunksize=chunksize):
+                m = self.parallel(square, workers=3, chunksize=chunksize)
+                self.assertIsInstance(m, ParallelMergeMap)
+                self.assertEqual(m(range(100)), expected)
+                self.assertEqual(m([]), ())
+
+    def test_merge(self):
+        m = self.parallel(a, lambda *r: "".join(r), workers=2, chunksize=2)
+        self.assertEqual(m("bnnn"), "bananana")
+
+        cmp = (b & c & "stoke") | self.parallel(a, workers=2)
+        self.assertEqual(cmp("_"), ("_ba", "_ca", "stokea"))
+
+    def test_multi_arg(self):
+        m = self.parallel(lambda *args: args, workers=2, chunksize=2)
+        self.assertEqual(m([1, 2, 3], [4, 5, 6, 7]), ((1, 4), (2, 5), (3, 6)))
+
+    def test_str_repr(self):
+        m = self.parallel(a, workers=2)
+        self.assertEqual(str(m), "mmap(a)")
+        self.assertEqual(
+            repr(m),
+            "ParallelMergeMap(a, merge_function={}, workers=2, chunksize=None)".format(
+                operators.concat
+            ),
+        )
+
+    def test_reduce(self):
+        for chunksize in (None, 1, 3, 100):
+            with self.subTest(chunksize=chunksize):
+                m = self.parallel(
+                    str, workers=3, chunksize=chunksize, reduce=operator.add
+                )
+                self.assertEqual(m(range(12)), "01234567891011")
+                with self.assertRaises(TypeError):
+                    m([])
+
+                m = self.parallel(
+                    float, workers=3, chunksize=chunksize, reduce=min, initial=-1
+                )
+                self.assertEqual(m(range(12)), -1)
+                self.assertEqual(m([]), -1)
+
+    def test_call_state(self):
+        cmp = self.parallel(store("x"), workers=2, chunksize=1) | recall("x")
+        self.assertEqual(cmp([1, 2, 3]), 3)
+
+    def test_error(self):
+        @node
+        def fail(x):
+            if x == "c":
+                1 / 0
+            return x
+
+        cmp = locate_error(c | self.parallel(fail, workers=2), use_color=False)
+        with self.assertRaises(exceptions.ConcurrentException) as e:
+            cmp("abcdefg")
+        self.assertIsInstance(e.exception.__cause__, ZeroDivisionError)
+        self.assertEqual(
+            str(e.exception),
+            "Caught exception in child process \n\nOccured in the following function: "
+            "(c | mmap(->fail<-))",
+        )
+
+    def test_upgrade(self):
+        # Our function is called on chunks, and its results are merged (or reduced) by us
+        for m in (
+            self.parallel(a, workers=2),
+            self.parallel(a, workers=2, reduce=operator.add),
+        ):
+            with self.subTest(m=repr(m)):
+                with self.assertRaises(exceptions.CompositionError):
+                    concurrent(m)
+                with self.assertRaises(exceptions.CompositionError):
+                    threaded(m)
+
+    def test_composition_errors(self):
+        with self.assertRaises(exceptions.CompositionError):
+            mmap(a, chunksize=10)
+        with self.assertRaises(exceptions.CompositionError):
+            mmap(a, workers=0)
+        with self.assertRaises(exceptions.CompositionError):
+            mmap(a, workers=2, chunksize=0)
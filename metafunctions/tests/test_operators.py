@@ -0,0 +1,85 @@
+import operator
+import functools
+import unittest
+import tracemalloc
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from metafunctions.tests.util import BaseTestCase
+from metafunctions.operators import fold
+from metafunctions.operators import merge_sum
+from metafunctions.operators import merge_prod
+from metafunctions.operators import concat
+
+
+class TestUnit(BaseTestCase):
+    def test_concat(self):
+        self.assertEqual(concat(1, 2, 3), (1, 2, 3))
+
+    def test_fold(self):
+        self.assertEqual(fold(operator.sub)(1, 2, 3), (1 - 2) - 3)
+        self.assertEqual(fold(operator.truediv)(8, 2, 2, 2), 1)
+        self.assertEqual(merge_sum(1, 2, 3, 4), 10)
+        self.assertEqual(merge_sum("a", "b"), "ab")
+        self.assertEqual(merge_sum(5), 5)
+        self.assertEqual(merge_prod(2, 3, 4), 24)
+        self.assertEqual(merge_sum([1], [2], [3]), [1, 2, 3])
+        self.assertEqual(fold(max)(1, 5, 3), 5)
+
+        self.assertEqual(merge_sum, fold(operator.add))
+        self.assertEqual(hash(merge_sum), hash(fold(operator.add)))
+        self.assertNotEqual(merge_sum, merge_prod)
+        self.assertEqual(repr(merge_sum), "fold(add)")
+
+    def test_inputs_unchanged(self):
+        # Lists would be extended by +=, but fold never modifies its arguments
+        first = [1]
+        self.assertEqual(merge_sum(first, [2], [3]), [1, 2, 3])
+        self.assertEqual(first, [1])
+        with self.assertRaises(TypeError):
+            merge_sum([1], [2], (3,))
+
+
+@unittest.skipIf(numpy is None, "numpy isn't installed")
+class TestArrays(BaseTestCase):
+    def test_results(self):
+        arrays = [numpy.arange(10, dtype=numpy.int64) + i for i in range(16)]
+        copies = [x.copy() for x in arrays]
+        for f in (merge_sum, merge_prod, fold(operator.sub), fold(operator.truediv)):
+            # The same result as creating a new array for each operation
+            expected = functools.reduce(f.operator, arrays)
+            with self.subTest(f=f):
+                result = f(*arrays)
+                numpy.testing.assert_array_equal(result, expected)
+                self.assertFalse(any(result is x for x in arrays))
+        for x, copy in zip(arrays, copies):
+            numpy.testing.assert_array_equal(x, copy)
+
+    def test_mixed(self):
+        # Results that can't be written to the accumulator are combined as usual
+        ints = numpy.arange(4, dtype=numpy.int32)
+        numpy.testing.assert_array_equal(
+            merge_sum(ints, ints, numpy.full(4, 0.5)), ints * 2 + 0.5
+        )
+        numpy.testing.assert_array_equal(
+            merge_sum(ints, 1, numpy.ones((2, 4), dtype=numpy.int32)),
+            numpy.ones((2, 4)) * ints + 2,
+        )
+        numpy.testing.assert_array_equal(
+            merge_sum(ints, ints, 1, [1, 1, 1, 1]), ints * 2 + 2
+        )
+        self.assertEqual(merge_sum(numpy.int64(1), 2, 3), 6)
+
+    def test_memory(self):
+        size = 10**6
+        arrays = [numpy.ones(size) for _ in range(16)]
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        result = merge_sum(*arrays)
+        peak = tracemalloc.get_traced_memory()[1]
+        self.assertEqual(result[0], 16)
+        # Only the result is allocated
+        self.assertLess(peak, arrays[0].nbytes * 1.5)
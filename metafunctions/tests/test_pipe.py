@@ -111,22 +111,49 @@ class TestIntegration(BaseTestCase):
         cmp = a | b | c | (lambda x: None)
         self.assertEqual(str(cmp), "(a | b | c | <lambda>)")
 
+    def test_str_repr_cached(self):
+        # Each MetaFunction is rendered once, no matter how often it or its parents are.
+        from metafunctions.core import MetaFunction, FunctionChain, FunctionMerge
+
+        render = mock.patch.object(
+            MetaFunction, "_render", autospec=True, side_effect=MetaFunction._render
+        )
+        chain_repr = mock.patch.object(
+            FunctionChain, "_repr", autospec=True, side_effect=FunctionChain._repr
+        )
+        merge_repr = mock.patch.object(
+            FunctionMerge, "_repr", autospec=True, side_effect=FunctionMerge._repr
+        )
+        with render as render, chain_repr as chain_repr, merge_repr as merge_repr:
+            cmp = x = node(lambda _: "x", name="x")
+            for i in range(20):
+                cmp = (cmp | x) + x
+                str(cmp)
+                repr(cmp)
+                locate_error(cmp)
+            self.assertEqual(render.call_count, 40)
+            self.assertEqual(chain_repr.call_count, 20)
+            self.assertEqual(merge_repr.call_count, 20)
+
+        self.assertEqual(str(cmp), "(" * 40 + "x | x) + x" + ") | x) + x" * 19 + ")")
+        self.assertTrue(repr(cmp).startswith("FunctionMerge(<built-in function add>"))
+
     def test_called_functions(self):
         # This made more sense back before call_state was a tree. Consider removing.
         @node
         @bind_call_state
         def parent_test(call_state, x):
-            return call_state
+            return call_state, call_state._child_counts[0]
 
         ab = a | b
         abc = ab + c
         abc_ = abc | parent_test
 
-        call_state = abc_("_")
+        call_state, count = abc_("_")
         self.assertIsInstance(call_state, CallState)
-        self.assertListEqual(
-            [n.function for n in call_state._children[(abc_, 0)]], [abc, parent_test]
-        )
+        self.assertEqual(count, 2)
+        self.assertEqual(abc_._child_span(count, parent_test), (17, 28))
+        self.assertEqual(str(abc_)[17:28], "parent_test")
 
     def test_pretty_exceptions(self):
         @node
@@ -51,3 +51,15 @@ def replace_nth(string, substring, occurance_index: int, new_substring):
     # There's probably a better regex for this.
     regex = "((?:.*?{0}.*?){{{1}}}.*?){0}(.*$)".format(escaped, occurance_index - 1)
     return re.sub(regex, r"\1{}\2".format(new_substring), string)
+
+
+def find_nth(string, substring, n: int):
+    """Return the (start, end) span of the `n`th occurance of substring in string, or None if there
+    aren't `n` occurances.
+    """
+    start = -1
+    for _ in range(max(n, 1)):
+        start = string.find(substring, start + 1)
+        if start < 0:
+            return None
+    return start, start + len(substring)
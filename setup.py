@@ -79,6 +79,7 @@ setup(
     packages=find_packages(),
     test_suite="metafunctions.tests",
     install_requires="ansicolors>=1.1.8",
+    extras_require={"numpy": ["numpy"]},
     # $ setup.py publish support.
     cmdclass={
         "upload": UploadCommand,